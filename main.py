@@ -1,32 +1,180 @@
 from fastapi import FastAPI, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.encoders import jsonable_encoder
 from typing import Optional, Dict, Any, List
 import uvicorn
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import openai
 import os
 from datetime import datetime
 import asyncio
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 import time
 import re
+import sys
+import traceback
+import tracemalloc
 import hashlib
+import html
+import ipaddress
+import fcntl
+import mmap
+import struct
+import tempfile
+import threading
+import sqlite3
+import uuid
+import secrets
+import socket
+from urllib.parse import urlsplit
+import heapq
+import math
+import itertools
+import random
+import contextvars
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
 from google.auth.transport.requests import Request as GoogleRequest
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
-app = FastAPI()
+try:
+    import orjson  # optional - faster response serialization, falls back to json
+except ImportError:
+    orjson = None
 
-# Add CORS middleware to allow requests from your website
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # In production, specify your domain
-    allow_credentials=True,
-    allow_methods=["GET", "POST"],
-    allow_headers=["*"],
-)
+# Startup/shutdown hooks registered by the sections below, run by the app lifespan
+app_startup_hooks = []
+app_shutdown_hooks = []
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    for hook in app_startup_hooks:
+        await hook()
+    await maintenance.start()
+    yield
+    await maintenance.stop()
+    for hook in reversed(app_shutdown_hooks):
+        await hook()
+
+class MaintenanceScheduler:
+    """
+    Runs housekeeping (expiry, eviction, purges, compaction, log flushes) on
+    each job's own cadence in one background task, so no request ever pays
+    for a cleanup pass. Blocking jobs (SQLite, file I/O) run in a worker
+    thread; jobs that touch in-memory request state run on the event loop,
+    where they cannot race the handlers using it. Every run is timed.
+    
+    A job returns a short summary of what it did (printed) or None; an async
+    job is awaited on the event loop.
+    """
+    
+    def __init__(self):
+        self.jobs = {}
+        self._task = None
+    
+    def register(self, name: str, interval: float, func, blocking: bool = False, run_at_start: bool = False):
+        self.jobs[name] = {
+            "interval": interval,
+            "func": func,
+            "blocking": blocking,
+            "run_at_start": run_at_start,
+            "next_due": None,
+            "runs": 0,
+            "failures": 0,
+            "total_seconds": 0.0,
+            "last_seconds": None,
+            "max_seconds": 0.0,
+            "last_run_at": None,
+            "last_result": None,
+            "last_error": None
+        }
+    
+    async def start(self):
+        now = time.monotonic()
+        for job in self.jobs.values():
+            job["next_due"] = now if job["run_at_start"] else now + job["interval"]
+        if self.jobs:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+    
+    async def _run(self):
+        while True:
+            next_due = min(job["next_due"] for job in self.jobs.values())
+            delay = next_due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            for name, job in self.jobs.items():
+                if job["next_due"] <= time.monotonic():
+                    await self.run_job(name)
+                    job["next_due"] = time.monotonic() + job["interval"]
+    
+    async def run_job(self, name: str):
+        job = self.jobs[name]
+        started = time.perf_counter()
+        try:
+            result = await asyncio.to_thread(job["func"]) if job["blocking"] else job["func"]()
+            if asyncio.iscoroutine(result):
+                result = await result
+            job["last_error"] = None
+        except Exception as e:
+            result = None
+            job["failures"] += 1
+            job["last_error"] = str(e)
+            print(f"MAINTENANCE: {name} failed: {e}")
+        elapsed = time.perf_counter() - started
+        
+        job["runs"] += 1
+        job["total_seconds"] += elapsed
+        job["last_seconds"] = elapsed
+        job["max_seconds"] = max(job["max_seconds"], elapsed)
+        job["last_run_at"] = datetime.now().isoformat()
+        job["last_result"] = result
+        if result:
+            print(f"MAINTENANCE: {name} {result} ({elapsed * 1000:.1f}ms)")
+    
+    def stats(self) -> dict:
+        def ms(value):
+            return round(value * 1000, 2) if value is not None else None
+        return {
+            name: {
+                "interval_seconds": job["interval"],
+                "runs": job["runs"],
+                "failures": job["failures"],
+                "last_ms": ms(job["last_seconds"]),
+                "avg_ms": ms(job["total_seconds"] / job["runs"]) if job["runs"] else None,
+                "max_ms": ms(job["max_seconds"]) if job["runs"] else None,
+                "last_run_at": job["last_run_at"],
+                "last_result": job["last_result"],
+                "last_error": job["last_error"]
+            }
+            for name, job in self.jobs.items()
+        }
+
+maintenance = MaintenanceScheduler()
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson when it is installed"""
+    
+    def render(self, content: Any) -> bytes:
+        if orjson is not None:
+            try:
+                return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+            except TypeError:
+                pass  # e.g. integers beyond 64 bits - let the stdlib handle it
+        return super().render(content)
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # Configure OpenAI client
 openai.api_key = os.getenv("OPENAI_API_KEY")
@@ -58,24 +206,650 @@ GOOGLE_SHEETS_SPREADSHEET_ID = os.getenv("GOOGLE_SHEETS_SPREADSHEET_ID")
 # Resend configuration
 RESEND_API_KEY = os.getenv("RESEND_API_KEY")
 GHL_WEBHOOK_API_KEY = os.getenv("GHL_WEBHOOK_API_KEY")
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")  # X-Admin-Key for /admin/* endpoints (disabled when unset)
 RESEND_FROM_EMAIL = os.getenv("RESEND_FROM_EMAIL")
 RESEND_FROM_NAME = os.getenv("RESEND_FROM_NAME", "Roth Davies Law Firm")
 FIRM_NOTIFICATION_EMAIL = os.getenv("FIRM_NOTIFICATION_EMAIL")
 
 # Webhook URL
 MAKE_WEBHOOK_URL = os.getenv("MAKE_WEBHOOK_URL")
+MAKE_WEBHOOK_MODE = os.getenv("MAKE_WEBHOOK_MODE", "form").lower()  # form (default), json, or batch (JSON batches)
+MAKE_BATCH_WINDOW_SECONDS = int(os.getenv("MAKE_BATCH_WINDOW_MS", "250")) / 1000
+MAKE_BATCH_MAX_SIZE = int(os.getenv("MAKE_BATCH_MAX_SIZE", "25"))
+MAKE_BATCH_MAX_ATTEMPTS = 3  # 5xx items are re-queued into the next batch up to this many sends
+
+# Upstream connection pre-warming (at startup and on /warm)
+UPSTREAM_PREWARM_ENABLED = os.getenv("UPSTREAM_PREWARM_ENABLED", "TRUE").upper() == "TRUE"
+UPSTREAM_PREWARM_TIMEOUT_SECONDS = 5
+UPSTREAM_WARM_COOLDOWN_SECONDS = float(os.getenv("UPSTREAM_WARM_COOLDOWN_SECONDS", "60"))  # /warm fans out to upstreams at most this often
+PREWARM_SHEETS_CLIENT = os.getenv("PREWARM_SHEETS_CLIENT", "TRUE").upper() == "TRUE"
+
+# Background upstream health probes (cached results served by /health?deep=true)
+UPSTREAM_PROBE_ENABLED = os.getenv("UPSTREAM_PROBE_ENABLED", "TRUE").upper() == "TRUE"
+UPSTREAM_PROBE_INTERVAL_SECONDS = int(os.getenv("UPSTREAM_PROBE_INTERVAL_SECONDS", "60"))
+UPSTREAM_PROBE_INTERVALS = {"openai": 120, "sheets": 300}  # per-upstream overrides of the default interval
+UPSTREAM_PROBE_TIMEOUT_SECONDS = 5
+UPSTREAM_PROBE_FAILURE_THRESHOLD = 2  # consecutive failed probes before an upstream is reported down
+# Upstreams the service can't take leads without - deep health answers 503 while one is down
+HEALTH_CRITICAL_UPSTREAMS = [name.strip() for name in os.getenv("HEALTH_CRITICAL_UPSTREAMS", "make").split(",") if name.strip()]
+
+# Unified /chat routing between DocsBot and Chatbase
+CHAT_HEDGING_ENABLED = os.getenv("CHAT_HEDGING_ENABLED", "TRUE").upper() == "TRUE"
+CHAT_HEDGE_PERCENTILE = float(os.getenv("CHAT_HEDGE_PERCENTILE", "95"))  # hedge once the primary is slower than this
+CHAT_HEDGE_MIN_SAMPLES = 20  # latency samples needed before the percentile is trusted
+CHAT_HEDGE_DEFAULT_DELAY_SECONDS = 3.0
+CHAT_HEDGE_MIN_DELAY_SECONDS = 0.25
+CHAT_EWMA_ALPHA = 0.2
+CHAT_ERROR_PENALTY = 4.0  # score multiplier per unit of error rate
+
+# Spam detection micro-batching (bursts of form posts share one OpenAI request)
+SPAM_BATCHING_ENABLED = os.getenv("SPAM_BATCHING_ENABLED", "TRUE").upper() == "TRUE"
+SPAM_BATCH_WINDOW_SECONDS = int(os.getenv("SPAM_BATCH_WINDOW_MS", "50")) / 1000
+SPAM_BATCH_MAX_SIZE = int(os.getenv("SPAM_BATCH_MAX_SIZE", "20"))
+SPAM_MAX_CASE_CHARS = int(os.getenv("SPAM_MAX_CASE_CHARS", "2000"))  # case description cap in the spam prompt
+SPAM_MAX_CONTACT_CHARS = 200  # name/phone/email cap in the spam prompt
+
+# Local contact validation (phone/email/name checks scored ahead of the LLM spam check)
+CONTACT_VALIDATION_ENABLED = os.getenv("CONTACT_VALIDATION_ENABLED", "TRUE").upper() == "TRUE"
+CONTACT_REJECT_SCORE = float(os.getenv("CONTACT_REJECT_SCORE", "1.5"))  # treat as spam without the LLM at this score (2+ signals)
+DISPOSABLE_DOMAINS_PATH = os.getenv(
+    "DISPOSABLE_DOMAINS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "disposable_email_domains.txt")
+)
+
+# Learned spam blocklist (Bloom filter in memory, exact confirmation in the lead store)
+SPAM_BLOCKLIST_ENABLED = os.getenv("SPAM_BLOCKLIST_ENABLED", "TRUE").upper() == "TRUE"
+SPAM_BLOCKLIST_CAPACITY = int(os.getenv("SPAM_BLOCKLIST_CAPACITY", "100000"))  # entries before the filter is resized
+SPAM_BLOCKLIST_FALSE_POSITIVE_RATE = 0.01
+SPAM_BLOCKLIST_DOMAIN_STRIKES = int(os.getenv("SPAM_BLOCKLIST_DOMAIN_STRIKES", "3"))  # distinct spam senders before a whole domain is denied
+SPAM_BLOCKLIST_STRIKES = max(2, int(os.getenv("SPAM_BLOCKLIST_STRIKES", "2")))  # spam verdicts before a phone, email or case text is denied
+SPAM_BLOCKLIST_AUTO_DENY = os.getenv("SPAM_BLOCKLIST_AUTO_DENY", "FALSE").upper() == "TRUE"  # FALSE: learned entries wait for review
+SPAM_BLOCKLIST_LEARNED_TTL_DAYS = int(os.getenv("SPAM_BLOCKLIST_LEARNED_TTL_DAYS", "30"))  # learned entries lapse without a new strike
+SPAM_BLOCKLIST_EXPIRY_INTERVAL = 3600  # seconds between lapsing stale learned entries
+SPAM_BLOCKLIST_MIN_CONTENT_CHARS = 40  # shorter case descriptions are too generic to fingerprint
+SPAM_BLOCKLIST_SYNC_INTERVAL = 30  # seconds between picking up entries learned by other workers
+# Shared mailbox providers - only individual addresses from these are ever blocked
+FREE_EMAIL_DOMAINS = {
+    "gmail.com", "googlemail.com", "yahoo.com", "ymail.com", "hotmail.com", "outlook.com", "live.com",
+    "msn.com", "aol.com", "icloud.com", "me.com", "mac.com", "protonmail.com", "proton.me", "gmx.com",
+    "mail.com", "zoho.com", "comcast.net", "att.net", "verizon.net", "sbcglobal.net", "cox.net"
+}
+
+# Async lead acceptance (202 Accepted + background pipeline)
+LEAD_ASYNC_MODE = os.getenv("LEAD_ASYNC_MODE", "FALSE").upper() == "TRUE"
+LEAD_STORE_PATH = os.getenv("LEAD_STORE_PATH", os.path.join(tempfile.gettempdir(), "roth-davies-leads.db"))
+LEAD_STATUS_RETENTION = 7 * 24 * 3600  # keep lead status for 7 days
+LEAD_RECOVERY_GRACE = 300  # leads still pending after 5 minutes are re-run (well past ASYNC_LEAD_DEADLINE_SECONDS)
+LEAD_RECOVERY_INTERVAL = 60  # seconds between sweeps for leads and stage emails orphaned by any worker
+
+# Submission archive (every lead with its verdict and outcomes, queried via /admin/submissions)
+SUBMISSION_ARCHIVE_ENABLED = os.getenv("SUBMISSION_ARCHIVE_ENABLED", "TRUE").upper() == "TRUE"
+SUBMISSION_ARCHIVE_PATH = os.getenv("SUBMISSION_ARCHIVE_PATH", os.path.join(tempfile.gettempdir(), "roth-davies-submissions.db"))
+SUBMISSION_ARCHIVE_RETENTION_DAYS = int(os.getenv("SUBMISSION_ARCHIVE_RETENTION_DAYS", "365"))
+
+# Lead analytics (rolling time-bucketed counters, served by /admin/analytics)
+LEAD_ANALYTICS_ENABLED = os.getenv("LEAD_ANALYTICS_ENABLED", "TRUE").upper() == "TRUE"
+ANALYTICS_BUCKET_SECONDS = 300  # counter granularity; series steps are multiples of this
+ANALYTICS_RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", "90"))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL_SECONDS", "5"))  # counters are summed in memory between writes
+
+# Lead notification digest (during bursts, later leads share one summary SMS + email)
+LEAD_DIGEST_ENABLED = os.getenv("LEAD_DIGEST_ENABLED", "FALSE").upper() == "TRUE"
+LEAD_DIGEST_WINDOW_SECONDS = int(os.getenv("LEAD_DIGEST_WINDOW_SECONDS", "300"))
+
+# Stage-change email batching (GHL bulk moves are acknowledged at once and sent via Resend's batch API)
+STAGE_EMAIL_BATCHING_ENABLED = os.getenv("STAGE_EMAIL_BATCHING_ENABLED", "TRUE").upper() == "TRUE"
+STAGE_EMAIL_BATCH_WINDOW_SECONDS = int(os.getenv("STAGE_EMAIL_BATCH_WINDOW_MS", "2000")) / 1000
+STAGE_EMAIL_BATCH_MAX_SIZE = min(int(os.getenv("STAGE_EMAIL_BATCH_MAX_SIZE", "100")), 100)  # Resend caps a batch at 100
+STAGE_EMAIL_MAX_ATTEMPTS = 3  # sends that were shed or ran out of time are re-queued this many times
+STAGE_EMAIL_RECOVERY_GRACE = 120  # emails still queued after 2 minutes are re-sent
 
 # Rate limiting storage (in production, use Redis)
-rate_limit_storage = defaultdict(list)
+rate_limit_storage = defaultdict(deque)  # key -> request timestamps, oldest first
 RATE_LIMIT_REQUESTS = 100  # requests per window
 RATE_LIMIT_WINDOW = 3600  # 1 hour in seconds
+RATE_LIMIT_CLEANUP_INTERVAL = 300  # evict idle keys every 5 minutes
+# Routes counted in their own bucket with their own limit instead of the shared per-IP one
+# (GHL delivers every webhook of a bulk move from the same few addresses)
+RATE_LIMIT_ROUTE_BUCKETS = {
+    "/webhook/opportunity-stage-change": ("ghl-webhook", int(os.getenv("WEBHOOK_RATE_LIMIT_REQUESTS", "2000")))
+}
+
+# Admission control (enforced in ASGI middleware, before any request body is read)
+RATE_LIMITED_PATHS = {
+    "/webhook/opportunity-stage-change",
+    "/submit-lead",
+    "/warm",
+    "/chat-docsbot",
+    "/get-resources",
+    "/chat-with-resources",
+    "/chat-chatbase",
+    "/chat"
+}
+MAX_REQUEST_BODY_BYTES = int(os.getenv("MAX_REQUEST_BODY_BYTES", "65536"))  # 64 KB for form posts
+ROUTE_BODY_LIMITS = {
+    # GHL stage change payloads carry full HTML email bodies
+    "/webhook/opportunity-stage-change": int(os.getenv("MAX_WEBHOOK_BODY_BYTES", "1048576"))
+}
+# Route priority classes (lower wins) - lead submissions earn money, chat traffic yields first
+PRIORITY_LEAD = 0
+PRIORITY_WEBHOOK = 1
+PRIORITY_CHAT = 2
+ROUTE_PRIORITIES = {
+    "/submit-lead": PRIORITY_LEAD,
+    "/webhook/opportunity-stage-change": PRIORITY_WEBHOOK,
+    "/warm": PRIORITY_WEBHOOK,
+    "/chat-docsbot": PRIORITY_CHAT,
+    "/get-resources": PRIORITY_CHAT,
+    "/chat-with-resources": PRIORITY_CHAT,
+    "/chat-chatbase": PRIORITY_CHAT,
+    "/chat": PRIORITY_CHAT
+}
+# Share of MAX_INFLIGHT_REQUESTS / UPSTREAM_MAX_QUEUE_DEPTH each class may use before being shed
+PRIORITY_CAPACITY_SHARE = {
+    PRIORITY_LEAD: 1.0,
+    PRIORITY_WEBHOOK: 0.8,
+    PRIORITY_CHAT: 0.5
+}
+MAX_INFLIGHT_REQUESTS = int(os.getenv("MAX_INFLIGHT_REQUESTS", "64"))  # per worker
+LOAD_SHED_RETRY_AFTER_SECONDS = int(os.getenv("LOAD_SHED_RETRY_AFTER_SECONDS", "5"))
+
+# Per-upstream concurrent call limits (per worker)
+UPSTREAM_CONCURRENCY_LIMITS = {
+    "openai": int(os.getenv("OPENAI_MAX_CONCURRENCY", "8")),
+    "docsbot": int(os.getenv("DOCSBOT_MAX_CONCURRENCY", "8")),
+    "chatbase": int(os.getenv("CHATBASE_MAX_CONCURRENCY", "8")),
+    "resend": int(os.getenv("RESEND_MAX_CONCURRENCY", "4")),
+    "twilio": int(os.getenv("TWILIO_MAX_CONCURRENCY", "4")),
+    "make": int(os.getenv("MAKE_MAX_CONCURRENCY", "4")),
+    "sheets": 1  # the googleapiclient service object is not thread-safe
+}
+UPSTREAM_MAX_QUEUE_DEPTH = int(os.getenv("UPSTREAM_MAX_QUEUE_DEPTH", "32"))
+
+# End-to-end deadline per route, set on arrival; upstream calls only get what is left of it
+CHAT_DEADLINE_SECONDS = float(os.getenv("CHAT_DEADLINE_SECONDS", "25"))
+ROUTE_DEADLINES = {
+    "/submit-lead": float(os.getenv("LEAD_DEADLINE_SECONDS", "20")),
+    "/webhook/opportunity-stage-change": float(os.getenv("WEBHOOK_DEADLINE_SECONDS", "20")),
+    "/warm": 10.0,
+    "/chat-docsbot": CHAT_DEADLINE_SECONDS,
+    "/get-resources": CHAT_DEADLINE_SECONDS,
+    "/chat-with-resources": CHAT_DEADLINE_SECONDS,
+    "/chat-chatbase": CHAT_DEADLINE_SECONDS,
+    "/chat": CHAT_DEADLINE_SECONDS
+}
+# Minimum budget each pipeline stage needs; non-critical stages are skipped or deferred below it
+STAGE_MIN_BUDGETS = {
+    "spam_check": 2.0,
+    "email": 2.0,
+    "sms": 2.0,
+    "error_alert": 1.0,
+    "webhook": 5.0
+}
+MIN_UPSTREAM_BUDGET_SECONDS = 0.5  # below this an upstream call is not worth starting
+DEFERRED_STAGE_DEADLINE_SECONDS = 30.0  # fresh budget for stages moved off the request path
+ASYNC_LEAD_DEADLINE_SECONDS = float(os.getenv("ASYNC_LEAD_DEADLINE_SECONDS", "60"))
+
+# Response shaping: ?lean=true drops bulky fields, ?fields=a,b keeps only those top-level keys
+LEAN_RESPONSES_DEFAULT = os.getenv("LEAN_RESPONSES_DEFAULT", "FALSE").upper() == "TRUE"
+LEAN_SOURCE_FIELDS = ("title", "url", "page", "type")  # what lean mode keeps of each DocsBot source
+GZIP_MINIMUM_SIZE = int(os.getenv("GZIP_MINIMUM_SIZE", "1024"))  # smaller bodies are not worth compressing
+
+# Idempotent retries for lead and GHL webhook posts (Idempotency-Key header or payload hash)
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))  # explicit keys
+IDEMPOTENCY_DERIVED_TTL_SECONDS = 600  # payload-derived keys only need to cover client retries
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))  # per worker
+
+# Event-loop lag monitor (a watchdog thread captures the stack of callbacks that block the loop)
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR_ENABLED", "TRUE").upper() == "TRUE"
+LOOP_MONITOR_INTERVAL_SECONDS = 0.1
+LOOP_BLOCK_THRESHOLD_MS = int(os.getenv("LOOP_BLOCK_THRESHOLD_MS", "250"))
+
+# On-demand sampling profiler (/admin/profile)
+PROFILER_MAX_SECONDS = 60.0
+PROFILER_TRACEMALLOC_FRAMES = 10
+PROFILER_MIN_INTERVAL_MS = 5.0  # finer sampling holds the GIL often enough to slow the requests being profiled
+
+# Comma-separated proxy addresses/CIDRs whose X-Forwarded-For entries we trust
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(proxy.strip(), strict=False)
+    for proxy in os.getenv("TRUSTED_PROXIES", "").split(",")
+    if proxy.strip()
+]
 
 # ============ NEW: DUPLICATE DETECTION STORAGE ============
 # Storage for duplicate detection (in production, use Redis with TTL)
 duplicate_detection_storage = {}  # {submission_hash: timestamp}
 DUPLICATE_DETECTION_WINDOW = 600  # 10 minutes in seconds
 DUPLICATE_CLEANUP_INTERVAL = 300  # Clean up old entries every 5 minutes
-last_cleanup_time = time.time()
+
+# ============ SHARED-MEMORY STATE (MULTI-WORKER MODE) ============
+# With more than one uvicorn worker, rate limits and duplicate detection must be
+# shared across processes, so both tables move into memory-mapped files.
+
+def get_worker_count() -> int:
+    """Resolve SERVER_WORKERS ("auto" uses every CPU this container may run on)"""
+    configured = os.getenv("SERVER_WORKERS", os.getenv("WEB_CONCURRENCY", "1")).strip().lower()
+    if configured == "auto":
+        try:
+            return max(1, len(os.sched_getaffinity(0)))
+        except AttributeError:
+            return max(1, os.cpu_count() or 1)
+    return max(1, int(configured))
+
+SERVER_WORKERS = get_worker_count()
+SHARED_STATE_ENABLED = SERVER_WORKERS > 1 or os.getenv("SHARED_STATE_ENABLED", "FALSE").upper() == "TRUE"
+SHARED_STATE_DIR = os.getenv("SHARED_STATE_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+SHARED_TABLE_SLOTS = int(os.getenv("SHARED_TABLE_SLOTS", "65536"))  # per table, 32 bytes each
+
+class SharedMemoryTable:
+    """
+    Fixed-size open-addressing hash table in a memory-mapped file, shared by
+    every worker process.
+    
+    Each slot holds a 16-byte key digest, a float64 timestamp and two uint32
+    counters. Read-modify-write cycles run under an exclusive fcntl lock on the
+    backing file, so updates are atomic across processes. Slots are never
+    emptied - expired slots are reused in place - so probe chains stay intact.
+    """
+    
+    SLOT = struct.Struct("<16sdII")
+    EMPTY_KEY = bytes(16)
+    MAX_PROBES = 64
+    
+    def __init__(self, path: str, slots: int):
+        self.path = path
+        self.slots = slots
+        size = self.SLOT.size * slots
+        
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            # Whichever worker gets here first sizes the file; it is zero-filled (all slots empty)
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        
+        self._map = mmap.mmap(self._fd, size)
+        # flock does not exclude threads sharing the same descriptor
+        self._thread_lock = threading.Lock()
+    
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+    
+    @staticmethod
+    def _digest(key: str) -> bytes:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        return digest if digest != SharedMemoryTable.EMPTY_KEY else b"\x01" + digest[1:]
+    
+    def _read(self, index: int):
+        return self.SLOT.unpack_from(self._map, index * self.SLOT.size)
+    
+    def _write(self, index: int, digest: bytes, timestamp: float, first: int, second: int):
+        self.SLOT.pack_into(self._map, index * self.SLOT.size, digest, timestamp, first, second)
+    
+    def _probe(self, digest: bytes, expires_before: float):
+        """
+        Walk the probe chain for a digest.
+        Returns (index_of_key, index_to_insert_at); index_of_key is None if absent.
+        """
+        home = int.from_bytes(digest[:8], "little") % self.slots
+        reusable = None
+        oldest_index, oldest_timestamp = home, None
+        
+        for offset in range(self.MAX_PROBES):
+            index = (home + offset) % self.slots
+            slot_key, timestamp, _, _ = self._read(index)
+            
+            if slot_key == digest:
+                return index, index
+            if slot_key == self.EMPTY_KEY:
+                return None, reusable if reusable is not None else index
+            if reusable is None and timestamp < expires_before:
+                reusable = index
+            if oldest_timestamp is None or timestamp < oldest_timestamp:
+                oldest_index, oldest_timestamp = index, timestamp
+        
+        # Chain is saturated with live entries - evict the oldest one
+        return None, reusable if reusable is not None else oldest_index
+    
+    def update(self, key: str, ttl: float, update_fn, now: Optional[float] = None):
+        """
+        Atomically apply update_fn to the entry for key.
+        update_fn receives (timestamp, first, second), or None when the key is
+        absent/expired, and returns (new_state, result); new_state of None
+        leaves the slot untouched. Returns result.
+        """
+        now = now if now is not None else time.time()
+        with self._locked():
+            return self._update_unlocked(key, ttl, update_fn, now)
+    
+    def update_many(self, updates, ttl: float):
+        """Apply (key, update_fn, now) updates under a single lock (bulk state reload)"""
+        with self._locked():
+            for key, update_fn, now in updates:
+                self._update_unlocked(key, ttl, update_fn, now)
+    
+    def _update_unlocked(self, key: str, ttl: float, update_fn, now: float):
+        digest = self._digest(key)
+        found, insert_at = self._probe(digest, now - ttl)
+        current = None
+        if found is not None:
+            _, timestamp, first, second = self._read(found)
+            if timestamp >= now - ttl:
+                current = (timestamp, first, second)
+        
+        new_state, result = update_fn(current)
+        if new_state is not None:
+            self._write(insert_at, digest, *new_state)
+        return result
+    
+    def clear(self):
+        """Empty every slot (only safe before workers start using the table)"""
+        with self._locked():
+            self._map[:] = bytes(len(self._map))
+    
+    def count_live(self, ttl: float, now: Optional[float] = None) -> int:
+        """Number of slots holding unexpired entries (full scan - for health reporting only)"""
+        cutoff = (now if now is not None else time.time()) - ttl
+        live = 0
+        for slot_key, timestamp, _, _ in self.SLOT.iter_unpack(self._map):
+            if slot_key != self.EMPTY_KEY and timestamp >= cutoff:
+                live += 1
+        return live
+
+# Event loop / HTTP parser tuning ("auto" picks uvloop/httptools when installed)
+UVICORN_LOOP = os.getenv("UVICORN_LOOP", "auto")
+UVICORN_HTTP = os.getenv("UVICORN_HTTP", "auto")
+UVICORN_BACKLOG = int(os.getenv("UVICORN_BACKLOG", "2048"))
+UVICORN_KEEP_ALIVE_SECONDS = int(os.getenv("UVICORN_KEEP_ALIVE_SECONDS", "75"))  # outlive typical LB idle timeouts
+
+if SHARED_STATE_ENABLED:
+    shared_rate_limit_table = SharedMemoryTable(
+        os.path.join(SHARED_STATE_DIR, "roth-davies-rate-limit.table"), SHARED_TABLE_SLOTS
+    )
+    shared_duplicate_table = SharedMemoryTable(
+        os.path.join(SHARED_STATE_DIR, "roth-davies-duplicates.table"), SHARED_TABLE_SLOTS
+    )
+else:
+    shared_rate_limit_table = None
+    shared_duplicate_table = None
+
+# ============ END SHARED-MEMORY STATE ============
+
+# ============ PERSISTENT STATE LOG (SURVIVES RESTARTS) ============
+# Duplicate-detection hashes and accepted rate-limited requests are appended
+# to a log as fixed-size binary records. Compaction folds the log into a
+# snapshot holding only unexpired records, and startup replays snapshot + log
+# (memory-mapped, unpacked in bulk) so a deploy neither forgets the dedupe
+# window nor hands abusive IPs a fresh rate-limit budget.
+
+STATE_PERSISTENCE_ENABLED = os.getenv("STATE_PERSISTENCE_ENABLED", "TRUE").upper() == "TRUE"
+STATE_DIR = os.getenv("STATE_DIR", tempfile.gettempdir())  # point at a persistent disk to survive redeploys
+STATE_COMPACT_INTERVAL = int(os.getenv("STATE_COMPACT_INTERVAL", "300"))  # seconds between compactions
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL_SECONDS", "1"))  # appends are buffered in memory for at most this long
+
+# Maintenance scheduler cadences (jobs with their own settings use those)
+RETENTION_PURGE_INTERVAL = 24 * 3600  # archive / status / delivery record purges (also run at startup)
+IDEMPOTENCY_TRIM_INTERVAL = 60
+LOG_FLUSH_INTERVAL_SECONDS = float(os.getenv("LOG_FLUSH_INTERVAL_SECONDS", "2"))  # stdout is block-buffered in containers
+
+# Tracked background tasks (audit rows, notifications, batches, async leads)
+BACKGROUND_TASK_LIMITS = {"sheets_log": 4, "archive_write": 4, "deferred_stage": 16}  # concurrent tasks per kind; others unbounded
+# Tasks allowed to wait behind a full limit before new ones are dropped (counted); only for work that is safe to lose
+BACKGROUND_QUEUE_LIMITS = {"sheets_log": 200, "archive_write": 1000}
+# Finish pending work on shutdown - keep below the container stop grace period (Docker: 10s) so nothing is SIGKILLed
+BACKGROUND_DRAIN_TIMEOUT_SECONDS = float(os.getenv("BACKGROUND_DRAIN_TIMEOUT_SECONDS", "7"))
+
+class PersistentStateLog:
+    """
+    Append-only log of (kind, key, timestamp) records plus a compacted snapshot.
+    Appends only queue the record in memory; flush() writes the queue from a
+    worker thread as one O_APPEND write under a shared flock, so every worker
+    can append at once and the event loop never touches the file. Compaction
+    builds the new snapshot without blocking appenders and takes the exclusive
+    lock only to swap it in and reset the log.
+    """
+    
+    RECORD = struct.Struct("<B64sd")
+    DUPLICATE = 1
+    RATE_LIMIT = 2
+    
+    def __init__(self, directory: str):
+        self.log_path = os.path.join(directory, "roth-davies-state.log")
+        self.snapshot_path = os.path.join(directory, "roth-davies-state.snapshot")
+        self.compaction_lock_path = os.path.join(directory, "roth-davies-state.compact.lock")
+        self._fd = None
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.records_appended = 0
+        self.append_errors = 0
+        self.last_load = None
+        self.last_compaction = None
+    
+    def append(self, kind: int, key: str, timestamp: float):
+        """Queue a record for the next flush - called on the event loop, so no I/O here"""
+        encoded = key.encode("utf-8")
+        if len(encoded) > 64:
+            return  # keys are hex digests and client IPs - never this long
+        record = self.RECORD.pack(kind, encoded, timestamp)
+        with self._buffer_lock:
+            self._buffer.append(record)
+    
+    def flush(self) -> int:
+        """Write the queued records to the log in one append. Blocking - run it in a worker thread."""
+        with self._flush_lock:
+            with self._buffer_lock:
+                pending, self._buffer = self._buffer, []
+            if not pending:
+                return 0
+            try:
+                if self._fd is None:
+                    self._fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                fcntl.flock(self._fd, fcntl.LOCK_SH)
+                try:
+                    os.write(self._fd, b"".join(pending))
+                finally:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+                self.records_appended += len(pending)
+            except OSError as e:
+                # Persistence is best effort - never fail a request over it
+                self.append_errors += len(pending)
+                print(f"STATE LOG: append failed: {e}")
+            return len(pending)
+    
+    def _read_file(self, path: str, limit: Optional[int] = None) -> List[tuple]:
+        try:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size if limit is None else limit
+                usable = size - size % self.RECORD.size  # ignore a torn final record
+                if usable == 0:
+                    return []
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return list(self.RECORD.iter_unpack(mapped[:usable]))
+        except FileNotFoundError:
+            return []
+    
+    def _read_all(self) -> List[tuple]:
+        return self._read_file(self.snapshot_path) + self._read_file(self.log_path)
+    
+    @contextmanager
+    def _flock(self, path: str, mode: int):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, mode)
+            try:
+                yield fd
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+    
+    def load(self) -> List[tuple]:
+        """All (kind, key, timestamp) records from the snapshot and the log, oldest first"""
+        with self._flock(self.log_path, fcntl.LOCK_SH):
+            records = self._read_all()
+        return [
+            (kind, key.rstrip(b"\0").decode("utf-8", errors="replace"), timestamp)
+            for kind, key, timestamp in records
+        ]
+    
+    def compact(self, ttls: Dict[int, float], now: Optional[float] = None) -> Optional[tuple]:
+        """
+        Rewrite the snapshot with only unexpired records and empty the log.
+        The snapshot is read, rebuilt and fsynced while workers keep
+        appending; the exclusive log lock is held only to carry over records
+        appended meanwhile, swap the snapshot in and reset the log.
+        Returns (kept, dropped), or None if another worker is compacting.
+        """
+        now = now if now is not None else time.time()
+        self.flush()
+        try:
+            with self._flock(self.compaction_lock_path, fcntl.LOCK_EX | fcntl.LOCK_NB):
+                # Only this compactor rewrites the snapshot, and the log only grows,
+                # so its first log_size bytes can be read without holding the log lock
+                log_size = os.stat(self.log_path).st_size if os.path.exists(self.log_path) else 0
+                log_size -= log_size % self.RECORD.size
+                records = self._read_file(self.snapshot_path) + self._read_file(self.log_path, log_size)
+                live = [record for record in records if record[2] >= now - ttls.get(record[0], 0)]
+                if len(live) == len(records) and log_size == 0:
+                    return len(live), 0  # snapshot is already compact
+                
+                temp_path = self.snapshot_path + ".tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(b"".join(
+                        self.RECORD.pack(*record) for record in live
+                    ))
+                    f.flush()
+                    os.fsync(f.fileno())
+                
+                with self._flock(self.log_path, fcntl.LOCK_EX) as fd:
+                    appended = os.pread(fd, os.fstat(fd).st_size - log_size, log_size)
+                    os.replace(temp_path, self.snapshot_path)
+                    os.ftruncate(fd, 0)
+                    if appended:
+                        os.pwrite(fd, appended, 0)
+        except BlockingIOError:
+            return None
+        
+        self.last_compaction = {"at": now, "kept": len(live), "dropped": len(records) - len(live)}
+        return len(live), len(records) - len(live)
+    
+    def stats(self) -> dict:
+        def file_size(path):
+            try:
+                return os.path.getsize(path)
+            except OSError:
+                return 0
+        return {
+            "enabled": True,
+            "log_bytes": file_size(self.log_path),
+            "snapshot_bytes": file_size(self.snapshot_path),
+            "records_appended": self.records_appended,
+            "records_buffered": len(self._buffer),
+            "append_errors": self.append_errors,
+            "last_load": self.last_load,
+            "last_compaction": self.last_compaction
+        }
+
+state_log = PersistentStateLog(STATE_DIR) if STATE_PERSISTENCE_ENABLED else None
+
+def record_state(kind: int, key: str, timestamp: float):
+    """Append a dedupe/rate-limit record to the persistent state log (if enabled)"""
+    if state_log is not None:
+        state_log.append(kind, key, timestamp)
+
+def persistent_state_ttls() -> Dict[int, float]:
+    return {
+        PersistentStateLog.DUPLICATE: DUPLICATE_DETECTION_WINDOW,
+        PersistentStateLog.RATE_LIMIT: RATE_LIMIT_WINDOW
+    }
+
+def load_persistent_state():
+    """
+    Replay the state log into the dedupe and rate-limit tables, then compact it.
+    In multi-worker mode this runs once in the master process, before workers
+    are spawned, and rebuilds the shared tables from scratch.
+    """
+    if state_log is None:
+        return
+    started = time.perf_counter()
+    now = time.time()
+    ttls = persistent_state_ttls()
+    records = [record for record in state_log.load() if record[2] >= now - ttls.get(record[0], 0)]
+    duplicates = [(key, timestamp) for kind, key, timestamp in records if kind == PersistentStateLog.DUPLICATE]
+    requests_seen = [(key, timestamp) for kind, key, timestamp in records if kind == PersistentStateLog.RATE_LIMIT]
+    
+    if shared_duplicate_table is not None:
+        shared_duplicate_table.clear()
+        shared_rate_limit_table.clear()
+        shared_duplicate_table.update_many(
+            ((key, lambda entry, timestamp=timestamp: ((timestamp, 0, 0), None), timestamp) for key, timestamp in duplicates),
+            DUPLICATE_DETECTION_WINDOW
+        )
+        shared_rate_limit_table.update_many(
+            ((key, sliding_window_counter(timestamp, enforce=False), timestamp) for key, timestamp in requests_seen),
+            2 * RATE_LIMIT_WINDOW
+        )
+    else:
+        for key, timestamp in duplicates:
+            duplicate_detection_storage[key] = timestamp
+        for key, timestamp in requests_seen:
+            rate_limit_storage[key].append(timestamp)
+    
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    state_log.last_load = {
+        "duplicates": len(duplicates),
+        "rate_limited_requests": len(requests_seen),
+        "elapsed_ms": round(elapsed_ms, 1)
+    }
+    print(f"STATE LOG: restored {len(duplicates)} duplicate hashes and {len(requests_seen)} rate-limit records in {elapsed_ms:.1f}ms")
+    
+    compacted = state_log.compact(ttls, now)
+    if compacted:
+        print(f"STATE LOG: compacted to {compacted[0]} records ({compacted[1]} expired)")
+
+async def restore_persistent_state():
+    """Startup hook: reload state in single-process mode (the master already did it for workers)"""
+    if state_log is None or (shared_duplicate_table is not None and SERVER_WORKERS > 1):
+        return
+    try:
+        await asyncio.to_thread(load_persistent_state)
+    except Exception as e:
+        print(f"STATE LOG: could not restore state: {e}")
+
+def flush_state_log():
+    state_log.flush()
+
+async def flush_state_log_on_shutdown():
+    await asyncio.to_thread(state_log.flush)
+
+def compact_state_log() -> Optional[str]:
+    compacted = state_log.compact(persistent_state_ttls())
+    if compacted:
+        return f"compacted the state log to {compacted[0]} records ({compacted[1]} expired)"
+
+app_startup_hooks.append(restore_persistent_state)
+if state_log is not None:
+    maintenance.register("state_log_flush", STATE_FLUSH_INTERVAL, flush_state_log, blocking=True)
+    maintenance.register("state_log_compaction", STATE_COMPACT_INTERVAL, compact_state_log, blocking=True)
+    app_shutdown_hooks.append(flush_state_log_on_shutdown)
+
+def flush_logs():
+    """Push buffered print() output to the container log (stdout is not line-buffered without a tty)"""
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+maintenance.register("log_flush", LOG_FLUSH_INTERVAL_SECONDS, flush_logs)
+
+# ============ END PERSISTENT STATE LOG ============
 
 def normalize_phone(phone: str) -> str:
     """
@@ -139,21 +913,13 @@ def generate_submission_hash(name: str, phone: str, email: str, about_case: str,
     # Generate SHA-256 hash
     return hashlib.sha256(combined.encode('utf-8')).hexdigest()
 
-def cleanup_old_duplicates():
+def cleanup_old_duplicates() -> Optional[str]:
     """
     Remove old entries from duplicate detection storage.
-    Called periodically to prevent memory buildup.
+    Run by the maintenance scheduler to prevent memory buildup.
     """
-    global last_cleanup_time
-    
-    current_time = time.time()
-    
-    # Only cleanup if enough time has passed
-    if current_time - last_cleanup_time < DUPLICATE_CLEANUP_INTERVAL:
-        return
-    
     # Remove entries older than the detection window
-    cutoff_time = current_time - DUPLICATE_DETECTION_WINDOW
+    cutoff_time = time.time() - DUPLICATE_DETECTION_WINDOW
     
     keys_to_remove = [
         key for key, timestamp in duplicate_detection_storage.items()
@@ -163,24 +929,26 @@ def cleanup_old_duplicates():
     for key in keys_to_remove:
         del duplicate_detection_storage[key]
     
-    last_cleanup_time = current_time
-    
     if keys_to_remove:
-        print(f"Cleaned up {len(keys_to_remove)} old duplicate detection entries")
+        return f"cleaned up {len(keys_to_remove)} old duplicate detection entries"
+
+# Shared tables reuse expired slots in place and need no sweeping
+if shared_duplicate_table is None:
+    maintenance.register("duplicate_expiry", DUPLICATE_CLEANUP_INTERVAL, cleanup_old_duplicates)
 
 def is_duplicate_submission(name: str, phone: str, email: str, about_case: str, source: str) -> bool:
     """
     Check if this submission is a duplicate of a recent submission.
     Returns True if it's a duplicate, False if it's new/unique.
     """
-    # Clean up old entries first
-    cleanup_old_duplicates()
-    
     # Generate hash for this submission
     submission_hash = generate_submission_hash(name, phone, email, about_case, source)
     
     current_time = time.time()
     
+    if shared_duplicate_table is not None:
+        return is_duplicate_submission_shared(submission_hash, current_time)
+    
     # Check if we've seen this submission recently
     if submission_hash in duplicate_detection_storage:
         last_seen = duplicate_detection_storage[submission_hash]
@@ -192,10 +960,41 @@ def is_duplicate_submission(name: str, phone: str, email: str, about_case: str,
     
     # Record this submission
     duplicate_detection_storage[submission_hash] = current_time
+    record_state(PersistentStateLog.DUPLICATE, submission_hash, current_time)
     print(f"NEW SUBMISSION: Recorded hash {submission_hash[:8]}... at {current_time}")
     
     return False
 
+def is_duplicate_submission_shared(submission_hash: str, current_time: float) -> bool:
+    """
+    Multi-worker variant of the duplicate check: the lookup and the insert
+    happen under one cross-process lock, so two workers cannot both accept
+    the same submission.
+    """
+    def check_and_record(entry):
+        if entry is not None:
+            # Seen within the window - keep the original timestamp
+            return None, current_time - entry[0]
+        return (current_time, 0, 0), None
+    
+    time_since_last = shared_duplicate_table.update(
+        submission_hash, DUPLICATE_DETECTION_WINDOW, check_and_record, now=current_time
+    )
+    
+    if time_since_last is not None:
+        print(f"DUPLICATE DETECTED: Submission hash {submission_hash[:8]}... last seen {time_since_last:.1f} seconds ago")
+        return True
+    
+    record_state(PersistentStateLog.DUPLICATE, submission_hash, current_time)
+    print(f"NEW SUBMISSION: Recorded hash {submission_hash[:8]}... at {current_time}")
+    return False
+
+def get_duplicate_entry_count() -> int:
+    """Number of submission hashes currently held for duplicate detection"""
+    if shared_duplicate_table is not None:
+        return shared_duplicate_table.count_live(DUPLICATE_DETECTION_WINDOW)
+    return len(duplicate_detection_storage)
+
 def log_duplicate_details(name: str, phone: str, email: str, about_case: str, source: str):
     """
     Log details about the duplicate submission for debugging.
@@ -352,123 +1151,869 @@ def get_chatbot_email_template(lead_name: str, lead_phone: str, lead_case_type:
     </html>
     """
 
-def check_rate_limit(client_ip: str) -> bool:
-    """Simple rate limiting check"""
+def check_rate_limit(client_ip: str, bucket: Optional[str] = None, limit: int = RATE_LIMIT_REQUESTS) -> bool:
+    """Simple rate limiting check (optionally in a named bucket with its own limit)"""
     now = time.time()
-    # Clean old requests
-    rate_limit_storage[client_ip] = [
-        req_time for req_time in rate_limit_storage[client_ip] 
-        if now - req_time < RATE_LIMIT_WINDOW
-    ]
+    key = f"{bucket}|{client_ip}" if bucket else client_ip
+    
+    if shared_rate_limit_table is not None:
+        allowed = check_rate_limit_shared(key, now, limit)
+        if allowed:
+            record_state(PersistentStateLog.RATE_LIMIT, key, now)
+        return allowed
+    
+    # Expire old requests from the front (idle keys are evicted by the maintenance scheduler)
+    timestamps = rate_limit_storage[key]
+    while timestamps and now - timestamps[0] >= RATE_LIMIT_WINDOW:
+        timestamps.popleft()
     
     # Check if under limit
-    if len(rate_limit_storage[client_ip]) >= RATE_LIMIT_REQUESTS:
+    if len(timestamps) >= limit:
         return False
     
     # Add current request
-    rate_limit_storage[client_ip].append(now)
+    timestamps.append(now)
+    record_state(PersistentStateLog.RATE_LIMIT, key, now)
     return True
 
-async def send_email_via_resend(
-    to_email: str,
-    subject: str,
-    html_content: str,
-    from_name: Optional[str] = None
-) -> dict:
+def evict_rate_limit_keys() -> Optional[str]:
+    """Drop keys whose newest request has left the window (check_rate_limit only trims within a key)"""
+    now = time.time()
+    idle_keys = [
+        key for key, timestamps in rate_limit_storage.items()
+        if not timestamps or now - timestamps[-1] >= RATE_LIMIT_WINDOW
+    ]
+    for key in idle_keys:
+        del rate_limit_storage[key]
+    if idle_keys:
+        return f"evicted {len(idle_keys)} idle rate-limit keys"
+
+if shared_rate_limit_table is None:
+    maintenance.register("rate_limit_eviction", RATE_LIMIT_CLEANUP_INTERVAL, evict_rate_limit_keys)
+
+def check_rate_limit_shared(client_ip: str, now: float, limit: int = RATE_LIMIT_REQUESTS) -> bool:
     """
-    Send email via Resend API.
+    Multi-worker rate limiting using a sliding window counter: the slot keeps
+    the current fixed window's start and count plus the previous window's
+    count, and the previous count is weighted by how much of it still overlaps
+    the sliding window. O(1) memory per IP instead of a timestamp list.
+    """
+    # Entries stay relevant for two windows (current + previous)
+    return shared_rate_limit_table.update(client_ip, 2 * RATE_LIMIT_WINDOW, sliding_window_counter(now, limit), now=now)
+
+def sliding_window_counter(now: float, limit: int = RATE_LIMIT_REQUESTS, enforce: bool = True):
+    """
+    Build the SharedMemoryTable update_fn that counts one request at `now`.
+    With enforce=False the request is always counted (state log replay).
+    """
+    window_start = now - (now % RATE_LIMIT_WINDOW)
     
-    Args:
-        to_email: Recipient email address
-        subject: Email subject
-        html_content: HTML content of the email
-        from_name: Custom sender name (optional)
+    def count_request(entry):
+        current_count, previous_count = 0, 0
+        if entry is not None:
+            stored_start, stored_current, stored_previous = entry
+            if stored_start == window_start:
+                current_count, previous_count = stored_current, stored_previous
+            elif stored_start == window_start - RATE_LIMIT_WINDOW:
+                previous_count = stored_current
+        
+        overlap = 1 - (now - window_start) / RATE_LIMIT_WINDOW
+        if enforce and previous_count * overlap + current_count >= limit:
+            return None, False
+        return (window_start, current_count + 1, previous_count), True
     
-    Returns:
-        dict: Response with success status and details
+    return count_request
+
+# ----- TRACKED BACKGROUND TASKS -----
+
+class BackgroundTaskRegistry:
     """
-    try:
-        if not RESEND_API_KEY:
-            raise Exception("RESEND_API_KEY not configured")
-        
-        if not RESEND_FROM_EMAIL:
-            raise Exception("RESEND_FROM_EMAIL not configured")
-        
-        # Prepare sender
-        sender_name = from_name or RESEND_FROM_NAME
-        from_address = f"{sender_name} <{RESEND_FROM_EMAIL}>"
-        
-        # Add debug prefix to subject if in debug mode
-        if is_debug_mode():
-            subject = f"[DEBUG] {subject}"
-        
-        # Prepare request payload
-        payload = {
-            "from": from_address,
-            "to": [to_email],
-            "subject": subject,
-            "html": html_content
-        }
+    Every fire-and-forget coroutine (audit logging, archive writes, deferred
+    stages, batch sends, async lead pipelines) is spawned through here. The
+    registry holds a strong reference until the task finishes, caps how many
+    of each kind run at once (the rest wait their turn, up to a queue limit
+    beyond which new work is dropped and counted), counts outcomes and
+    durations per kind, and on shutdown waits up to
+    BACKGROUND_DRAIN_TIMEOUT_SECONDS for pending work before cancelling it.
+    """
+    
+    def __init__(self, limits: Dict[str, int], queue_limits: Dict[str, int], drain_timeout: float):
+        self.limits = limits
+        self.queue_limits = queue_limits
+        self.drain_timeout = drain_timeout
+        self._tasks = {}  # task -> kind
+        self._semaphores = {}
+        self._stats = defaultdict(lambda: {
+            "spawned": 0, "pending": 0, "queued": 0, "running": 0, "completed": 0, "failed": 0, "cancelled": 0,
+            "dropped": 0, "runs": 0, "total_seconds": 0.0, "max_seconds": 0.0, "last_error": None
+        })
+    
+    def spawn(self, kind: str, coro, report_failures: bool = True) -> Optional[asyncio.Task]:
+        """Start coro in the background as a task of the given kind (None if its queue is full and it was dropped)"""
+        stats = self._stats[kind]
+        queue_limit = self.queue_limits.get(kind)
+        # pending counts tasks not yet started too; all but `limit` of them are waiting
+        if queue_limit is not None and stats["pending"] - self.limits.get(kind, 0) >= queue_limit:
+            coro.close()
+            stats["dropped"] += 1
+            if stats["dropped"] == 1 or stats["dropped"] % 100 == 0:
+                print(f"BACKGROUND TASKS: {kind} queue full ({queue_limit} waiting) - dropped {stats['dropped']} task(s) so far")
+            return None
+        stats["spawned"] += 1
+        stats["pending"] += 1
         
-        print(f"Sending email via Resend to: {to_email}")
-        print(f"Subject: {subject}")
-        if is_debug_mode():
-            print("DEBUG MODE: Email notification redirected to debug email")
+        async def run():
+            semaphore = self._semaphore(kind)
+            if semaphore is not None:
+                stats["queued"] += 1
+                try:
+                    await semaphore.acquire()
+                finally:
+                    stats["queued"] -= 1
+            stats["running"] += 1
+            started = time.perf_counter()
+            try:
+                return await coro
+            finally:
+                elapsed = time.perf_counter() - started
+                stats["running"] -= 1
+                stats["runs"] += 1
+                stats["total_seconds"] += elapsed
+                stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+                if semaphore is not None:
+                    semaphore.release()
         
-        # Send request to Resend API
-        response = requests.post(
-            "https://api.resend.com/emails",
-            headers={
-                "Authorization": f"Bearer {RESEND_API_KEY}",
-                "Content-Type": "application/json"
-            },
-            json=payload,
-            timeout=30
-        )
+        def on_done(task: asyncio.Task):
+            self._tasks.pop(task, None)
+            stats["pending"] -= 1
+            if task.cancelled():
+                stats["cancelled"] += 1
+                coro.close()  # never started if it was cancelled while queued
+                return
+            error = task.exception()  # also marks it retrieved
+            if error is None:
+                stats["completed"] += 1
+                return
+            stats["failed"] += 1
+            stats["last_error"] = f"{type(error).__name__}: {error}"
+            if report_failures:
+                print(f"BACKGROUND TASK {kind} failed: {error}")
         
-        # Check for success (any 2xx status code)
-        if 200 <= response.status_code < 300:
-            print("Email sent successfully via Resend")
-            return {
-                "success": True,
-                "message": "Email sent successfully",
-                "status_code": response.status_code,
-                "response_data": response.json() if response.text else None,
-                "timestamp": datetime.now().isoformat()
-            }
-        else:
-            error_msg = f"Resend API returned status {response.status_code}: {response.text}"
-            print(f"Email send error: {error_msg}")
-            return {
-                "success": False,
-                "error": error_msg,
-                "status_code": response.status_code,
-                "timestamp": datetime.now().isoformat()
+        task = asyncio.create_task(run())
+        self._tasks[task] = kind
+        task.add_done_callback(on_done)
+        return task
+    
+    def _semaphore(self, kind: str) -> Optional[asyncio.Semaphore]:
+        limit = self.limits.get(kind)
+        if limit is None:
+            return None
+        if kind not in self._semaphores:
+            self._semaphores[kind] = asyncio.Semaphore(limit)
+        return self._semaphores[kind]
+    
+    def pending(self) -> Dict[str, int]:
+        counts = defaultdict(int)
+        for kind in self._tasks.values():
+            counts[kind] += 1
+        return dict(counts)
+    
+    async def drain(self):
+        """Shutdown hook (runs after the batchers flushed): let pending work finish, cancel what can't"""
+        deadline = time.monotonic() + self.drain_timeout
+        # Loop because finishing tasks may spawn follow-up work (e.g. re-queued batches)
+        while self._tasks and time.monotonic() < deadline:
+            print(f"BACKGROUND TASKS: waiting for {len(self._tasks)} task(s) before shutdown {self.pending()}")
+            await asyncio.wait(list(self._tasks), timeout=deadline - time.monotonic())
+        if self._tasks:
+            print(f"BACKGROUND TASKS: cancelling {len(self._tasks)} unfinished task(s) after {self.drain_timeout:g}s {self.pending()}")
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+    
+    def stats(self) -> dict:
+        summary = {}
+        for kind, stats in self._stats.items():
+            summary[kind] = {
+                "spawned": stats["spawned"],
+                "queued": stats["queued"],
+                "running": stats["running"],
+                "completed": stats["completed"],
+                "failed": stats["failed"],
+                "cancelled": stats["cancelled"],
+                "dropped": stats["dropped"],
+                "limit": self.limits.get(kind),
+                "queue_limit": self.queue_limits.get(kind),
+                "avg_ms": round(stats["total_seconds"] / stats["runs"] * 1000, 1) if stats["runs"] else None,
+                "max_ms": round(stats["max_seconds"] * 1000, 1),
+                "last_error": stats["last_error"]
             }
-            
-    except Exception as e:
-        error_msg = f"Error sending email via Resend: {str(e)}"
-        print(error_msg)
-        return {
-            "success": False,
-            "error": error_msg,
-            "timestamp": datetime.now().isoformat()
-        }
+        return summary
 
-async def send_error_alert(error_message: str, endpoint: str):
-    """Send SMS alert when API errors occur"""
-    try:
-        alert_message = f"Roth Davies Chatbot Error Alert: {error_message} at endpoint {endpoint}. Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-        
-        # Always send error alerts to the alert phone number (not affected by debug mode)
-        alert_phone = ALERT_PHONE_NUMBER
-        
-        if is_debug_mode():
-            alert_message = f"[DEBUG] {alert_message}"
-            print(f"DEBUG MODE: Error alert would be sent to {alert_phone}")
+background_tasks = BackgroundTaskRegistry(BACKGROUND_TASK_LIMITS, BACKGROUND_QUEUE_LIMITS, BACKGROUND_DRAIN_TIMEOUT_SECONDS)
+
+# Registered first so it runs last - after every batcher has flushed into it
+app_shutdown_hooks.append(background_tasks.drain)
+
+# ----- SQLITE STORES -----
+
+class SQLiteStore:
+    """
+    Base for the SQLite-backed stores: one lazily opened WAL connection per
+    worker (synchronous=NORMAL), shared by its threads under self._lock -
+    callers hold the lock around every use. Subclasses list their CREATE
+    statements in SCHEMA.
+    """
+    
+    SCHEMA = ()
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+# ----- MICRO-BATCHING -----
+
+class MicroBatcher(ABC):
+    """
+    Collect-then-flush core shared by the batchers: items wait in _pending
+    until the window_seconds window closes or max_batch_size are waiting
+    (None: window only), then the whole batch goes to _send_batch as one
+    background task of kind TASK_KIND.
+    """
+    
+    TASK_KIND = "batch"
+    
+    def __init__(self, window_seconds: float, max_batch_size: Optional[int] = None):
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self._pending = []
+        self._window_task = None
+    
+    def _enqueue(self, item):
+        self._pending.append(item)
+        if self.max_batch_size is not None and len(self._pending) >= self.max_batch_size:
+            self._cancel_window()
+            self._flush()
+        else:
+            self._open_window()
+    
+    def _open_window(self):
+        if self._window_task is None:
+            self._window_task = asyncio.create_task(self._flush_after_window())
+    
+    def _cancel_window(self):
+        if self._window_task is not None:
+            self._window_task.cancel()
+            self._window_task = None
+    
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window_seconds)
+        self._window_task = None
+        self._flush()
+    
+    def _flush(self):
+        batch, self._pending = self._pending, []
+        if batch:
+            background_tasks.spawn(self.TASK_KIND, self._send_batch(batch))
+    
+    @abstractmethod
+    async def _send_batch(self, batch: list):
+        """Send one flushed batch (runs as a background task)"""
+    
+    async def drain(self):
+        """Shutdown hook: send whatever is still waiting for its window (the task registry waits for the send)"""
+        self._cancel_window()
+        self._flush()
+
+# ----- UPSTREAM CONCURRENCY LIMITS & LOAD SHEDDING -----
+
+# Priority class, deadline (time.monotonic()) and arrival time (time.time()) of
+# the request being served; set by AdmissionControlMiddleware and inherited by
+# every upstream call and background task it starts
+request_priority = contextvars.ContextVar("request_priority", default=PRIORITY_LEAD)
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+request_received_at = contextvars.ContextVar("request_received_at", default=None)
+
+class UpstreamUnavailable(HTTPException):
+    """Base for upstream calls refused locally (shed or out of time) without reaching the upstream"""
+    
+    def __init__(self, upstream: str, status_code: int, detail: str, headers: Optional[dict] = None):
+        super().__init__(status_code=status_code, detail=detail, headers=headers)
+        self.upstream = upstream
+
+class UpstreamOverloaded(UpstreamUnavailable):
+    """Fast 503 raised when work is shed instead of queued"""
+    
+    def __init__(self, upstream: str):
+        super().__init__(
+            upstream,
+            status_code=503,
+            detail="Service temporarily unavailable",
+            headers={"Retry-After": str(LOAD_SHED_RETRY_AFTER_SECONDS)}
+        )
+
+class DeadlineExceeded(UpstreamUnavailable):
+    """504 raised when the request's deadline leaves too little time for an upstream call"""
+    
+    def __init__(self, upstream: str):
+        super().__init__(upstream, status_code=504, detail="Request deadline exceeded")
+
+def remaining_budget() -> Optional[float]:
+    """Seconds left before the current request's deadline (None if it has none)"""
+    deadline = request_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def has_budget_for(stage: str, reserve_for: Optional[str] = None) -> bool:
+    """
+    Check if the deadline still covers a stage's minimum budget, optionally
+    keeping another (critical) stage's budget in reserve.
+    """
+    remaining = remaining_budget()
+    if remaining is None:
+        return True
+    reserve = STAGE_MIN_BUDGETS[reserve_for] if reserve_for else 0
+    return remaining - reserve >= STAGE_MIN_BUDGETS[stage]
+
+@contextmanager
+def reserving_budget_for(stage: str):
+    """
+    Pull the deadline seen by upstream calls in this block forward by a later
+    stage's minimum budget, so a slow non-critical call (whose timeout
+    call_upstream clamps to the remaining budget) cannot eat that reserve.
+    """
+    deadline = request_deadline.get()
+    if deadline is None:
+        yield
+        return
+    token = request_deadline.set(deadline - STAGE_MIN_BUDGETS[stage])
+    try:
+        yield
+    finally:
+        request_deadline.reset(token)
+
+def defer_stage(stage: str, coro_factory, reason: Optional[str] = None):
+    """Run a non-critical stage after the response, under its own fresh deadline"""
+    async def run_deferred():
+        request_deadline.set(time.monotonic() + DEFERRED_STAGE_DEADLINE_SECONDS)
+        try:
+            await coro_factory()
+        except Exception as e:
+            print(f"DEFERRED STAGE {stage} failed: {e}")
+    
+    if reason is None:
+        remaining = remaining_budget()
+        reason = f"not enough request budget left ({remaining:.1f}s)" if remaining is not None else "no request budget"
+    print(f"DEADLINE: Deferring {stage} - {reason}")
+    background_tasks.spawn("deferred_stage", run_deferred())
+
+class UpstreamLimiter:
+    """
+    Concurrency limit for one upstream with a priority wait queue.
+    Freed slots go to the most important waiter first, and each priority
+    class may only queue up to its share of the queue depth - past that the
+    call is shed with UpstreamOverloaded, so chat bursts can't starve leads.
+    """
+    
+    def __init__(self, name: str, max_concurrency: int, max_queue_depth: int):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.active = 0
+        self.shed_count = 0
+        self.peak_queue_depth = 0
+        self._waiters = []  # heap of (priority, sequence, future)
+        self._sequence = itertools.count()
+    
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, waiter in self._waiters if not waiter.done())
+    
+    async def acquire(self, priority: int):
+        if self.active < self.max_concurrency and self.queue_depth == 0:
+            self.active += 1
+            return
+        
+        queue_depth = self.queue_depth
+        if queue_depth >= self.max_queue_depth * PRIORITY_CAPACITY_SHARE.get(priority, 1.0):
+            self.shed_count += 1
+            print(f"LOAD SHED: {self.name} queue full ({queue_depth} waiting) for priority {priority}")
+            raise UpstreamOverloaded(self.name)
+        
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), waiter))
+        self.peak_queue_depth = max(self.peak_queue_depth, queue_depth + 1)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # Slot was handed to us just as we were cancelled - pass it on
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+    
+    def release(self):
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                # Hand the slot straight to the next waiter; active count is unchanged
+                waiter.set_result(None)
+                return
+        self.active -= 1
+    
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "queued": self.queue_depth,
+            "peak_queued": self.peak_queue_depth,
+            "shed": self.shed_count
+        }
+
+upstream_limiters = {
+    name: UpstreamLimiter(name, limit, UPSTREAM_MAX_QUEUE_DEPTH)
+    for name, limit in UPSTREAM_CONCURRENCY_LIMITS.items()
+}
+
+def create_upstream_session(pool_size: int) -> requests.Session:
+    """requests.Session whose keep-alive pool holds one connection per concurrency slot"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Pooled HTTP sessions per upstream, so calls reuse warm TCP/TLS connections
+upstream_sessions = {
+    name: create_upstream_session(UPSTREAM_CONCURRENCY_LIMITS[name])
+    for name in ("resend", "twilio", "make", "docsbot", "chatbase")
+}
+
+async def call_upstream(upstream: str, func, *args, **kwargs):
+    """
+    Run a blocking upstream call (requests/openai/googleapiclient) in a worker
+    thread, holding one of the upstream's concurrency slots. Waiters are
+    served by the priority class of the request that made the call.
+    
+    Under a request deadline, queueing for a slot is bounded by the remaining
+    budget and a `timeout` kwarg is clamped to whatever is left of it.
+    """
+    limiter = upstream_limiters[upstream]
+    priority = request_priority.get()
+    
+    remaining = remaining_budget()
+    if remaining is None:
+        await limiter.acquire(priority)
+    else:
+        if remaining < MIN_UPSTREAM_BUDGET_SECONDS:
+            raise DeadlineExceeded(upstream)
+        try:
+            await asyncio.wait_for(limiter.acquire(priority), timeout=remaining - MIN_UPSTREAM_BUDGET_SECONDS)
+        except asyncio.TimeoutError:
+            print(f"DEADLINE: Gave up waiting for a {upstream} slot")
+            raise DeadlineExceeded(upstream)
+    
+    try:
+        remaining = remaining_budget()
+        if remaining is not None:
+            if remaining < MIN_UPSTREAM_BUDGET_SECONDS:
+                raise DeadlineExceeded(upstream)
+            if "timeout" in kwargs:
+                kwargs["timeout"] = min(kwargs["timeout"], remaining)
+        return await asyncio.to_thread(func, *args, **kwargs)
+    finally:
+        limiter.release()
+
+async def configure_upstream_executor():
+    """Startup hook: size the default thread pool so every upstream slot gets a thread"""
+    max_workers = sum(UPSTREAM_CONCURRENCY_LIMITS.values()) + 4
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upstream")
+    )
+
+app_startup_hooks.append(configure_upstream_executor)
+
+# In-flight requests per priority class, for route-level load shedding
+inflight_requests = defaultdict(int)
+
+def should_shed_request(priority: int) -> bool:
+    """Shed a new request when the worker is busier than its priority class allows"""
+    total_inflight = sum(inflight_requests.values())
+    return total_inflight >= MAX_INFLIGHT_REQUESTS * PRIORITY_CAPACITY_SHARE.get(priority, 1.0)
+
+# ----- ADMISSION CONTROL MIDDLEWARE -----
+
+def is_trusted_proxy(address: str) -> bool:
+    """Check if an address belongs to one of the configured TRUSTED_PROXIES"""
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+def resolve_client_ip(scope: dict) -> str:
+    """
+    Resolve the real client IP for an ASGI scope.
+    X-Forwarded-For is only honored when the direct peer is a trusted proxy;
+    the chain is walked right-to-left and the first untrusted hop is the client.
+    """
+    client = scope.get("client")
+    peer_ip = client[0] if client else "unknown"
+    
+    if not TRUSTED_PROXIES or not is_trusted_proxy(peer_ip):
+        return peer_ip
+    
+    forwarded_chain = []
+    for header_name, header_value in scope.get("headers", []):
+        if header_name == b"x-forwarded-for":
+            forwarded_chain.extend(
+                hop.strip() for hop in header_value.decode("latin-1").split(",") if hop.strip()
+            )
+    
+    for hop in reversed(forwarded_chain):
+        if not is_trusted_proxy(hop):
+            return hop
+    
+    # Every hop is a trusted proxy - the left-most entry is the best we have
+    return forwarded_chain[0] if forwarded_chain else peer_ip
+
+def get_client_ip(request: Request) -> str:
+    """Client IP as resolved by the admission control middleware"""
+    return getattr(request.state, "client_ip", None) or request.client.host
+
+# /submit-lead requests turned away before the body is read, by reason (per worker, since start)
+ADMISSION_REJECTION_REASONS = {400: "bad_request", 413: "body_too_large", 429: "rate_limited", 503: "shed"}
+lead_admission_rejections = defaultdict(int)
+
+class AdmissionControlMiddleware:
+    """
+    Pure ASGI middleware that rejects rate-limited clients, oversized bodies
+    and (under overload) lower-priority routes using only the request line and
+    headers, before FastAPI buffers and parses the multipart/URL-encoded form body.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        request_received_at.set(time.time())
+        client_ip = resolve_client_ip(scope)
+        scope.setdefault("state", {})["client_ip"] = client_ip
+        
+        path = scope.get("path", "")
+        body_limit = ROUTE_BODY_LIMITS.get(path, MAX_REQUEST_BODY_BYTES)
+        
+        content_length = None
+        for header_name, header_value in scope.get("headers", []):
+            if header_name == b"content-length":
+                try:
+                    content_length = int(header_value)
+                except ValueError:
+                    await self._reject(send, 400, "Invalid Content-Length header", path=path)
+                    return
+                break
+        
+        if content_length is not None and content_length > body_limit:
+            print(f"ADMISSION: Rejected {content_length} byte body from {client_ip} on {path} (limit {body_limit})")
+            await self._reject(send, 413, "Request body too large", path=path)
+            return
+        
+        if scope.get("method") == "POST" and path in RATE_LIMITED_PATHS:
+            bucket, limit = RATE_LIMIT_ROUTE_BUCKETS.get(path, (None, RATE_LIMIT_REQUESTS))
+            if not check_rate_limit(client_ip, bucket, limit):
+                print(f"ADMISSION: Rate limit exceeded for {client_ip} on {path}")
+                await self._reject(send, 429, "Rate limit exceeded", path=path)
+                return
+        
+        priority = ROUTE_PRIORITIES.get(path, PRIORITY_LEAD)
+        if path in ROUTE_PRIORITIES and should_shed_request(priority):
+            print(f"LOAD SHED: Rejected {path} from {client_ip} ({sum(inflight_requests.values())} requests in flight)")
+            await self._reject(
+                send, 503, "Service temporarily unavailable",
+                headers=[(b"retry-after", str(LOAD_SHED_RETRY_AFTER_SECONDS).encode("latin-1"))], path=path
+            )
+            return
+        
+        request_priority.set(priority)
+        if path in ROUTE_DEADLINES:
+            request_deadline.set(time.monotonic() + ROUTE_DEADLINES[path])
+        inflight_requests[priority] += 1
+        try:
+            await self._admit(scope, receive, send, content_length, body_limit, client_ip, path)
+        finally:
+            inflight_requests[priority] -= 1
+    
+    async def _admit(self, scope, receive, send, content_length, body_limit, client_ip, path):
+        if content_length is not None:
+            await self.app(scope, receive, send)
+            return
+        
+        # No Content-Length (chunked upload) - count bytes as they stream in
+        # and cut the body off as soon as it crosses the limit
+        received_bytes = 0
+        body_too_large = False
+        response_started = False
+        
+        async def limited_receive():
+            nonlocal received_bytes, body_too_large
+            if body_too_large:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received_bytes += len(message.get("body", b""))
+                if received_bytes > body_limit:
+                    body_too_large = True
+                    return {"type": "http.disconnect"}
+            return message
+        
+        async def tracking_send(message):
+            nonlocal response_started
+            if body_too_large and not response_started:
+                # Drop the app's own parse-error response in favour of our 413
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+        
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except Exception:
+            if not body_too_large:
+                raise
+        
+        if body_too_large and not response_started:
+            print(f"ADMISSION: Rejected chunked body over {body_limit} bytes from {client_ip} on {path}")
+            await self._reject(send, 413, "Request body too large", path=path)
+    
+    @staticmethod
+    async def _reject(send, status_code: int, detail: str, headers: Optional[list] = None, path: Optional[str] = None):
+        """Send a JSON error response shaped like FastAPI's HTTPException output"""
+        if path == "/submit-lead":
+            # Counted in memory only - a rejection flood must not turn into a flood of archive writes
+            reason = ADMISSION_REJECTION_REASONS.get(status_code, "rejected")
+            lead_admission_rejections[reason] += 1
+            if lead_analytics is not None:
+                lead_analytics.record(time.time(), [("early_rejection", reason)])
+        body = json.dumps({"detail": detail}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("latin-1"))
+            ] + (headers or [])
+        })
+        await send({"type": "http.response.body", "body": body})
+
+# Compress large responses (chat answers with full sources) for clients that accept gzip
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
+
+app.add_middleware(AdmissionControlMiddleware)
+
+# Add CORS middleware to allow requests from your website
+# (registered after admission control so it wraps it and rejections still carry CORS headers)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  # In production, specify your domain
+    allow_credentials=True,
+    allow_methods=["GET", "POST"],
+    allow_headers=["*"],
+)
+
+# ----- RESPONSE SHAPING -----
+
+def wants_lean_response(request: Request) -> bool:
+    """?lean=true (or LEAN_RESPONSES_DEFAULT) asks for the lean response body"""
+    lean = request.query_params.get("lean")
+    if lean is None:
+        return LEAN_RESPONSES_DEFAULT
+    return lean.lower() in ("1", "true", "yes")
+
+def lean_sources(value: Any) -> Any:
+    """Trim every DocsBot source list in a response down to LEAN_SOURCE_FIELDS"""
+    if isinstance(value, list):
+        return [lean_sources(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    
+    lean = {}
+    for key, item in value.items():
+        if key == "sources" and isinstance(item, list):
+            lean[key] = [
+                {field: source[field] for field in LEAN_SOURCE_FIELDS if field in source} if isinstance(source, dict) else source
+                for source in item
+            ]
+        else:
+            lean[key] = lean_sources(item)
+    return lean
+
+def lean_chat_response(payload: dict) -> dict:
+    """Chat answers without the raw provider reply or full source documents"""
+    lean = {key: value for key, value in payload.items() if key != "raw_chatbase_response"}
+    if "data" in lean:
+        lean["data"] = lean_sources(lean["data"])
+    return lean
+
+def lean_chat_with_resources_response(payload: dict) -> dict:
+    lean = lean_chat_response(payload)
+    if lean.get("resources"):
+        lean["resources"] = lean_sources({"sources": lean["resources"]})["sources"]
+    return lean
+
+def lean_lead_response(payload: dict) -> dict:
+    """Lead results without the Make webhook's headers and body echoed back"""
+    webhook_response = payload.get("webhook_response")
+    if not isinstance(webhook_response, dict):
+        return payload
+    return {
+        **payload,
+        "webhook_response": {
+            key: webhook_response[key]
+            for key in ("status_code", "elapsed_seconds", "error")
+            if key in webhook_response
+        }
+    }
+
+def shape_response(request: Request, payload: dict, lean_fn=None) -> dict:
+    """Apply lean mode and ?fields=a,b top-level field selection to a response body"""
+    if lean_fn is not None and wants_lean_response(request):
+        payload = lean_fn(payload)
+    
+    fields = request.query_params.get("fields")
+    if fields:
+        selected = {field.strip() for field in fields.split(",") if field.strip()}
+        payload = {key: value for key, value in payload.items() if key in selected}
+    return payload
+
+def build_resend_email(to_email: str, subject: str, html_content: str, from_name: Optional[str] = None) -> dict:
+    """Build a Resend email object (shared by single sends and batch sends)"""
+    if not RESEND_API_KEY:
+        raise Exception("RESEND_API_KEY not configured")
+    
+    if not RESEND_FROM_EMAIL:
+        raise Exception("RESEND_FROM_EMAIL not configured")
+    
+    # Prepare sender
+    sender_name = from_name or RESEND_FROM_NAME
+    from_address = f"{sender_name} <{RESEND_FROM_EMAIL}>"
+    
+    # Add debug prefix to subject if in debug mode
+    if is_debug_mode():
+        subject = f"[DEBUG] {subject}"
+    
+    return {
+        "from": from_address,
+        "to": [to_email],
+        "subject": subject,
+        "html": html_content
+    }
+
+async def send_email_via_resend(
+    to_email: str,
+    subject: str,
+    html_content: str,
+    from_name: Optional[str] = None
+) -> dict:
+    """
+    Send email via Resend API.
+    
+    Args:
+        to_email: Recipient email address
+        subject: Email subject
+        html_content: HTML content of the email
+        from_name: Custom sender name (optional)
+    
+    Returns:
+        dict: Response with success status and details
+    """
+    try:
+        # Prepare request payload
+        payload = build_resend_email(to_email, subject, html_content, from_name)
+        
+        print(f"Sending email via Resend to: {to_email}")
+        print(f"Subject: {payload['subject']}")
+        if is_debug_mode():
+            print("DEBUG MODE: Email notification redirected to debug email")
+        
+        # Send request to Resend API
+        response = await call_upstream(
+            "resend",
+            upstream_sessions["resend"].post,
+            "https://api.resend.com/emails",
+            headers={
+                "Authorization": f"Bearer {RESEND_API_KEY}",
+                "Content-Type": "application/json"
+            },
+            json=payload,
+            timeout=30
+        )
+        
+        # Check for success (any 2xx status code)
+        if 200 <= response.status_code < 300:
+            print("Email sent successfully via Resend")
+            return {
+                "success": True,
+                "message": "Email sent successfully",
+                "status_code": response.status_code,
+                "response_data": response.json() if response.text else None,
+                "timestamp": datetime.now().isoformat()
+            }
+        else:
+            error_msg = f"Resend API returned status {response.status_code}: {response.text}"
+            print(f"Email send error: {error_msg}")
+            return {
+                "success": False,
+                "error": error_msg,
+                "status_code": response.status_code,
+                "timestamp": datetime.now().isoformat()
+            }
+            
+    except UpstreamUnavailable:
+        raise
+    except Exception as e:
+        error_msg = f"Error sending email via Resend: {str(e)}"
+        print(error_msg)
+        return {
+            "success": False,
+            "error": error_msg,
+            "timestamp": datetime.now().isoformat()
+        }
+
+async def send_error_alert(error_message: str, endpoint: str):
+    """Send SMS alert when API errors occur"""
+    if not has_budget_for("error_alert"):
+        # Alerts never hold up the response - send it once the request is done
+        defer_stage("error_alert", lambda: send_error_alert(error_message, endpoint))
+        return
+    
+    try:
+        alert_message = f"Roth Davies Chatbot Error Alert: {error_message} at endpoint {endpoint}. Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+        
+        # Always send error alerts to the alert phone number (not affected by debug mode)
+        alert_phone = ALERT_PHONE_NUMBER
+        
+        if is_debug_mode():
+            alert_message = f"[DEBUG] {alert_message}"
+            print(f"DEBUG MODE: Error alert would be sent to {alert_phone}")
         
         # Send SMS to alert phone number
-        response = requests.post(
+        response = await call_upstream(
+            "twilio",
+            upstream_sessions["twilio"].post,
             f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json",
             auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN),
             data={
@@ -487,24 +2032,15 @@ async def send_error_alert(error_message: str, endpoint: str):
     except Exception as e:
         print(f"Failed to send error alert: {e}")
 
-def get_spam_detection_prompt(name: str, phone: str, email: str, about_case: str) -> str:
-    """
-    Comprehensive prompt for spam detection tailored to a law firm context.
-    """
-    return f"""You are an expert spam detection system for a law firm specializing in personal injury, criminal law, and divorce law. Your job is to analyze incoming form submissions and determine if they are legitimate potential client inquiries or spam.
+# Instruction text shared by the single and batched spam prompts
+SPAM_DETECTION_INTRO = """You are an expert spam detection system for a law firm specializing in personal injury, criminal law, and divorce law. Your job is to analyze incoming form submissions and determine if they are legitimate potential client inquiries or spam.
 
 FIRM CONTEXT:
 - Personal injury law (car accidents, slip and fall, medical malpractice, workplace injuries)
 - Criminal law (DUI, drug charges, assault, theft, domestic violence, traffic violations)
-- Divorce law (divorce proceedings, custody disputes, alimony, property division)
+- Divorce law (divorce proceedings, custody disputes, alimony, property division)"""
 
-ANALYZE THIS SUBMISSION:
-Name: "{name}"
-Phone: "{phone}" 
-Email: "{email}"
-Case Description: "{about_case}"
-
-SPAM INDICATORS TO CHECK FOR:
+SPAM_DETECTION_GUIDELINES = """SPAM INDICATORS TO CHECK FOR:
 1. **Irrelevant Services**: Mentions of SEO, marketing, web design, crypto, investments, business loans, insurance sales, etc.
 2. **Generic Templates**: Obviously copy-pasted text, excessive keywords, unnatural language patterns
 3. **Fake Personal Info**: Obviously fake names (like "Test User", nonsensical names), invalid phone formats, suspicious email patterns
@@ -530,52 +2066,361 @@ DECISION CRITERIA:
 IMPORTANT NOTES:
 - Be conservative - it's better to let through a borderline case than reject a real client
 - Focus on the case description content more than contact info formatting
-- Consider that real people may have typos, brief descriptions, or unusual circumstances
-
-Respond with ONLY one word: "SPAM" or "LEGITIMATE"
+- Consider that real people may have typos, brief descriptions, or unusual circumstances"""
 
-Examples:
+SPAM_DETECTION_EXAMPLES = """Examples:
 - "I was in a car accident last week and need help" → LEGITIMATE
 - "We offer SEO services to grow your law firm" → SPAM  
 - "My husband filed for divorce, need attorney" → LEGITIMATE
 - "Make money from home with crypto trading" → SPAM
 - "Got arrested for DUI last night" → LEGITIMATE
-- Random gibberish or foreign spam → SPAM
+- Random gibberish or foreign spam → SPAM"""
+
+# Restates the examples against the guidelines above - no rules of its own
+SPAM_DETECTION_EXAMPLE_NOTES = """HOW THE EXAMPLES MAP TO THE GUIDELINES:
+- The car accident example is a Relevant Legal Issue in personal injury law, written in Natural Language with a Specific Request for help → LEGITIMATE
+- The SEO example offers Irrelevant Services to the firm itself and is Promotional Content; it describes no legal problem → SPAM
+- The divorce example is a Relevant Legal Issue in divorce law with a Specific Request for an attorney; its brevity does not matter → LEGITIMATE
+- The crypto example is Promotional Content about Irrelevant Services and is Off-topic for a law firm → SPAM
+- The DUI example is a Relevant Legal Issue in criminal law with Personal Details about when it happened → LEGITIMATE
+- Random gibberish matches the Gibberish indicator and carries no legal context → SPAM"""
+
+# Describes what the model receives and how it answers - no rules of its own
+SPAM_DETECTION_FORMAT = """SUBMISSION FORMAT:
+Each submission has a name, a phone number, an email address and a case description, exactly as the visitor
+typed them into the website form. Very long fields are cut by this system before they reach you and end with a
+marker such as "[truncated 1200 characters]"; the marker is added by the system, not by the visitor.
+A submission may also carry a contact check: warnings from automated structural checks of the name, phone and
+email, for example an invalid area code, a disposable email domain or a link inside the name. It is not a
+verdict; weigh it with the case description as the guidelines above describe for contact info.
+Submissions arrive either one at a time, as labelled Name / Phone / Email / Case Description / Contact Check
+lines, or several at once, as a JSON array whose items have the fields id, name, phone, email,
+case_description and, when present, contact_check.
+
+RESPONSE FORMAT:
+The exact response format is given after these instructions and depends on how the submissions arrive.
+A single submission is answered with one word. A JSON array is answered with a JSON object holding one verdict
+per submission id. Every verdict is exactly "SPAM" or "LEGITIMATE" in capital letters, with no explanation,
+reasoning, punctuation or extra text around it."""
+
+# Stable instruction prefix shared by every spam request (single and batched).
+# It must stay byte-identical across calls and come first, so the provider's
+# prompt prefix cache can serve it; everything per-submission goes after it.
+# OpenAI only caches prompts of 1024+ tokens, so the prefix has to stay above that.
+SPAM_DETECTION_INSTRUCTIONS = f"""{SPAM_DETECTION_INTRO}
+
+{SPAM_DETECTION_GUIDELINES}
+
+{SPAM_DETECTION_EXAMPLES}
+
+{SPAM_DETECTION_EXAMPLE_NOTES}
+
+{SPAM_DETECTION_FORMAT}"""
+SPAM_PROMPT_CACHE_MIN_TOKENS = 1024
+
+def estimate_prompt_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token for English) - enough to tell if caching can apply"""
+    return len(text) // 4
+
+if estimate_prompt_tokens(SPAM_DETECTION_INSTRUCTIONS) < SPAM_PROMPT_CACHE_MIN_TOKENS:
+    print(f"WARNING: spam prompt prefix is ~{estimate_prompt_tokens(SPAM_DETECTION_INSTRUCTIONS)} tokens - below the {SPAM_PROMPT_CACHE_MIN_TOKENS}-token prompt caching minimum")
+
+SPAM_SINGLE_SYSTEM_PROMPT = f"""{SPAM_DETECTION_INSTRUCTIONS}
+
+Respond with ONLY one word: "SPAM" or "LEGITIMATE\""""
+
+SPAM_BATCH_SYSTEM_PROMPT = f"""{SPAM_DETECTION_INSTRUCTIONS}
+
+You will receive several submissions as a JSON array. Analyze each one independently.
+Respond with ONLY a JSON object of the form:
+{{"verdicts": [{{"id": 0, "verdict": "SPAM"}}, {{"id": 1, "verdict": "LEGITIMATE"}}]}}
+with exactly one entry per submission id, each verdict being "SPAM" or "LEGITIMATE"."""
+
+def truncate_for_prompt(text: str, limit: int) -> str:
+    """Cap a submitted field before it goes into the spam prompt"""
+    if not text or len(text) <= limit:
+        return text or ""
+    return f"{text[:limit]}... [truncated {len(text) - limit} characters]"
+
+def get_spam_detection_prompt(name: str, phone: str, email: str, about_case: str, contact_check: str = "") -> str:
+    """
+    Variable suffix of the spam prompt: the submission itself, with every
+    field capped so an arbitrarily long case description can't inflate the request.
+    """
+    contact_line = f'\nContact Check: "{contact_check}" (structural warnings only - weigh them with the case)' if contact_check else ""
+    return f"""ANALYZE THIS SUBMISSION:
+Name: "{truncate_for_prompt(name, SPAM_MAX_CONTACT_CHARS)}"
+Phone: "{truncate_for_prompt(phone, SPAM_MAX_CONTACT_CHARS)}" 
+Email: "{truncate_for_prompt(email, SPAM_MAX_CONTACT_CHARS)}"
+Case Description: "{truncate_for_prompt(about_case, SPAM_MAX_CASE_CHARS)}"{contact_line}
 
 Your response (one word only):"""
 
-async def check_for_spam(name: str, phone: str, email: str, about_case: str) -> bool:
+# Structured output for batched verdicts: the model can only return well-formed
+# {"verdicts": [{"id", "verdict"}]} objects, so a reply either parses or was cut off
+SPAM_BATCH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "spam_verdicts",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "verdicts": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "integer"},
+                            "verdict": {"type": "string", "enum": ["SPAM", "LEGITIMATE"]}
+                        },
+                        "required": ["id", "verdict"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["verdicts"],
+            "additionalProperties": False
+        }
+    }
+}
+SPAM_BATCH_TOKENS_PER_ITEM = 40  # a verdict object is ~15 tokens; the rest is headroom for whitespace
+
+def parse_batch_verdicts(content: str) -> dict:
     """
-    Use GPT-4o-mini to determine if the submission is spam.
-    Returns True if spam, False if legitimate.
+    id -> verdict from a batch reply. A reply cut off by max_tokens is not
+    valid JSON, so the complete verdict objects before the cut are salvaged
+    and only the items after it count as missing.
     """
     try:
-        prompt = get_spam_detection_prompt(name, phone, email, about_case)
-        
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system", 
-                    "content": "You are a spam detection expert for a law firm. Respond with only 'SPAM' or 'LEGITIMATE'."
-                },
-                {
-                    "role": "user", 
-                    "content": prompt
-                }
-            ],
-            max_tokens=10,
-            temperature=0.1  # Low temperature for consistent results
-        )
-        
-        result = response.choices[0].message.content.strip().upper()
-        print(f"Spam detection result: {result}")
-        
-        # Log the analysis for monitoring
-        print(f"Analyzed submission - Name: {name}, Email: {email}, Result: {result}")
+        items = json.loads(content).get("verdicts", [])
+    except (TypeError, ValueError, AttributeError):
+        items = [
+            {"id": item_id, "verdict": verdict}
+            for item_id, verdict in re.findall(r'\{\s*"id"\s*:\s*(\d+)\s*,\s*"verdict"\s*:\s*"(\w+)"\s*\}', content or "")
+        ]
+    verdicts = {}
+    for item in items:
+        try:
+            verdicts[int(item.get("id"))] = str(item.get("verdict", "")).strip().upper()
+        except (TypeError, ValueError, AttributeError):
+            continue
+    return verdicts
+
+def get_batch_spam_detection_prompt(submissions: List[dict]) -> str:
+    """Variable suffix of the batched spam prompt: the submissions as a JSON array"""
+    items = [
+        {
+            "id": index,
+            "name": truncate_for_prompt(submission["name"], SPAM_MAX_CONTACT_CHARS),
+            "phone": truncate_for_prompt(submission["phone"], SPAM_MAX_CONTACT_CHARS),
+            "email": truncate_for_prompt(submission["email"], SPAM_MAX_CONTACT_CHARS),
+            "case_description": truncate_for_prompt(submission["about_case"], SPAM_MAX_CASE_CHARS),
+            **({"contact_check": submission["contact_check"]} if submission.get("contact_check") else {})
+        }
+        for index, submission in enumerate(submissions)
+    ]
+    
+    return f"""ANALYZE EACH OF THESE {len(items)} SUBMISSIONS (JSON array):
+{json.dumps(items, indent=2, ensure_ascii=False)}"""
+
+# Token and latency accounting for spam detection calls
+llm_usage_stats = {
+    "calls": 0,
+    "submissions": 0,
+    "prompt_tokens": 0,
+    "cached_tokens": 0,
+    "completion_tokens": 0,
+    "latency_seconds": 0.0
+}
+recent_llm_calls = deque(maxlen=100)
+
+def record_llm_usage(kind: str, response, latency_seconds: float, submissions: int):
+    """Record prompt/cached/completion tokens and latency of one spam detection call"""
+    usage = getattr(response, "usage", None)
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", 0) or 0
+    
+    llm_usage_stats["calls"] += 1
+    llm_usage_stats["submissions"] += submissions
+    llm_usage_stats["prompt_tokens"] += prompt_tokens
+    llm_usage_stats["cached_tokens"] += cached_tokens
+    llm_usage_stats["completion_tokens"] += completion_tokens
+    llm_usage_stats["latency_seconds"] += latency_seconds
+    
+    recent_llm_calls.append({
+        "kind": kind,
+        "submissions": submissions,
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": cached_tokens,
+        "completion_tokens": completion_tokens,
+        "latency_ms": round(latency_seconds * 1000, 1),
+        "timestamp": datetime.now().isoformat()
+    })
+    print(f"LLM USAGE ({kind}, {submissions} submission(s)): prompt={prompt_tokens} cached={cached_tokens} completion={completion_tokens} latency={latency_seconds * 1000:.0f}ms")
+
+def get_llm_usage_summary() -> dict:
+    """Totals plus per-submission averages, so LLM cost and latency per lead are visible"""
+    submissions = llm_usage_stats["submissions"] or 1
+    calls = llm_usage_stats["calls"] or 1
+    return {
+        **{key: round(value, 3) if isinstance(value, float) else value for key, value in llm_usage_stats.items()},
+        "avg_prompt_tokens_per_submission": round(llm_usage_stats["prompt_tokens"] / submissions, 1),
+        "avg_completion_tokens_per_submission": round(llm_usage_stats["completion_tokens"] / submissions, 1),
+        "cache_hit_ratio": round(llm_usage_stats["cached_tokens"] / (llm_usage_stats["prompt_tokens"] or 1), 3),
+        "avg_latency_ms": round(llm_usage_stats["latency_seconds"] / calls * 1000, 1),
+        "recent_calls": list(recent_llm_calls)[-10:]
+    }
+
+async def classify_submission(name: str, phone: str, email: str, about_case: str, contact_check: str = "") -> bool:
+    """Single-submission OpenAI spam classification. Returns True if spam."""
+    prompt = get_spam_detection_prompt(name, phone, email, about_case, contact_check)
+    
+    started = time.perf_counter()
+    response = await call_upstream(
+        "openai",
+        openai.chat.completions.create,
+        model="gpt-4o-mini",
+        messages=[
+            {
+                "role": "system", 
+                "content": SPAM_SINGLE_SYSTEM_PROMPT
+            },
+            {
+                "role": "user", 
+                "content": prompt
+            }
+        ],
+        max_tokens=10,
+        temperature=0.1,  # Low temperature for consistent results
+        timeout=15
+    )
+    record_llm_usage("single", response, time.perf_counter() - started, 1)
+    
+    result = response.choices[0].message.content.strip().upper()
+    print(f"Spam detection result: {result}")
+    
+    # Log the analysis for monitoring
+    print(f"Analyzed submission - Name: {name}, Email: {email}, Result: {result}")
+    
+    return result == "SPAM"
+
+async def classify_submissions_batch(submissions: List[dict]) -> List[bool]:
+    """
+    Classify several submissions with one OpenAI request.
+    Returns one spam flag per submission; a verdict missing from the
+    response counts as legitimate (same fail-open rule as errors).
+    """
+    prompt = get_batch_spam_detection_prompt(submissions)
+    
+    started = time.perf_counter()
+    response = await call_upstream(
+        "openai",
+        openai.chat.completions.create,
+        model="gpt-4o-mini",
+        messages=[
+            {
+                "role": "system",
+                "content": SPAM_BATCH_SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ],
+        response_format=SPAM_BATCH_RESPONSE_FORMAT,
+        max_tokens=50 + SPAM_BATCH_TOKENS_PER_ITEM * len(submissions),
+        temperature=0.1,
+        timeout=15
+    )
+    record_llm_usage("batch", response, time.perf_counter() - started, len(submissions))
+    
+    choice = response.choices[0]
+    if choice.finish_reason == "length":
+        print(f"Batch spam detection: reply cut off at max_tokens for a batch of {len(submissions)}")
+    verdicts = parse_batch_verdicts(choice.message.content)
+    
+    results = []
+    for index, submission in enumerate(submissions):
+        verdict = verdicts.get(index)
+        if verdict is None:
+            print(f"Batch spam detection: no verdict for item {index}, allowing submission through")
+        print(f"Analyzed submission (batch of {len(submissions)}) - Name: {submission['name']}, Email: {submission['email']}, Result: {verdict}")
+        results.append(verdict == "SPAM")
+    return results
+
+class SpamBatcher(MicroBatcher):
+    """
+    Micro-batches spam checks during submission bursts.
+    The first submission opens a short collection window; everything that
+    arrives before it closes (or until the batch is full) goes out as one
+    classification request, and each waiting request gets its own verdict.
+    A lone submission still uses the single-item prompt.
+    """
+    
+    TASK_KIND = "spam_batch"
+    
+    def __init__(self, window_seconds: float, max_batch_size: int):
+        super().__init__(window_seconds, max_batch_size)  # _pending: [(submission, future)]
+        self.batches_sent = 0
+        self.submissions_batched = 0
+    
+    async def classify(self, name: str, phone: str, email: str, about_case: str, contact_check: str = "") -> bool:
+        future = asyncio.get_running_loop().create_future()
+        submission = {"name": name, "phone": phone, "email": email, "about_case": about_case, "contact_check": contact_check}
+        self._enqueue((submission, future))
+        return await future
+    
+    async def _send_batch(self, batch: list):
+        submissions = [submission for submission, _ in batch]
+        try:
+            if len(submissions) == 1:
+                results = [await classify_submission(**submissions[0])]
+            else:
+                print(f"SPAM BATCH: Classifying {len(submissions)} submissions in one request")
+                results = await classify_submissions_batch(submissions)
+                self.batches_sent += 1
+                self.submissions_batched += len(submissions)
+        except UpstreamUnavailable as e:
+            # Let each waiting request handle the shed/deadline on its own
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except Exception as e:
+            print(f"Error in spam detection: {e}")
+            await send_error_alert(f"OpenAI spam detection failed: {str(e)}", "/submit-lead")
+            # If OpenAI fails, err on the side of caution and allow the submissions
+            print(f"Spam detection failed, allowing {len(batch)} submission(s) through")
+            results = [False] * len(batch)
         
-        return result == "SPAM"
+        for (_, future), is_spam in zip(batch, results):
+            if not future.done():
+                future.set_result(is_spam)
+
+spam_batcher = SpamBatcher(SPAM_BATCH_WINDOW_SECONDS, SPAM_BATCH_MAX_SIZE)
+
+async def check_for_spam(name: str, phone: str, email: str, about_case: str, contact_check: str = "") -> bool:
+    """
+    Use GPT-4o-mini to determine if the submission is spam.
+    contact_check summarises contact validation signals that were too weak to reject on.
+    Returns True if spam, False if legitimate.
+    """
+    if not has_budget_for("spam_check", reserve_for="webhook"):
+        print("DEADLINE: Not enough budget for spam detection, allowing submission through")
+        return False
+    
+    try:
+        if SPAM_BATCHING_ENABLED:
+            return await spam_batcher.classify(name, phone, email, about_case, contact_check)
+        return await classify_submission(name, phone, email, about_case, contact_check)
         
+    except UpstreamUnavailable:
+        # Shed under load or out of time - fail open like any other spam detection failure, without alerting
+        print("Spam detection skipped (overloaded or out of time budget), allowing submission through")
+        return False
     except Exception as e:
         print(f"Error in spam detection: {e}")
         await send_error_alert(f"OpenAI spam detection failed: {str(e)}", "/submit-lead")
@@ -583,6 +2428,605 @@ async def check_for_spam(name: str, phone: str, email: str, about_case: str) ->
         print("Spam detection failed, allowing submission through")
         return False
 
+# ----- LOCAL CONTACT VALIDATION -----
+
+EMAIL_PATTERN = re.compile(
+    r"(?P<local>[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*)"
+    r"@(?P<domain>(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,63})"
+)
+NAME_LINK_PATTERN = re.compile(r"https?://|www\.|@|\.(?:com|net|org|io|biz|info|ru|xyz)\b", re.IGNORECASE)
+PHONE_EXTENSION_PATTERN = re.compile(r"\s*(?:x|ext\.?|extension|#)\s*\d{1,6}\s*$", re.IGNORECASE)
+SEQUENTIAL_DIGITS = "01234567890123456789"
+
+class ContactValidator:
+    """
+    Structural checks of a submission's phone, email and name - pure string
+    work, no network. Each problem found is a weighted signal; the summed
+    score lets obviously fake contact details be rejected before the paid
+    LLM spam check, Twilio or the webhook ever see them. Rejection needs
+    CONTACT_REJECT_SCORE from at least two signals, so one weak signal (e.g.
+    an international number) never rejects on its own; lower scores are
+    passed to the LLM as context. Things real people commonly type - an
+    extension, a number without its area code - are parse issues, not signals.
+    """
+    
+    def __init__(self, disposable_domains_path: str):
+        self.disposable_domains = self._load_domains(disposable_domains_path)
+        self.checked = 0
+        self.rejected = 0
+        self.signal_counts = defaultdict(int)
+    
+    @staticmethod
+    def _load_domains(path: str) -> set:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return {line.strip().lower() for line in f if line.strip() and not line.startswith("#")}
+        except OSError as e:
+            print(f"CONTACT VALIDATION: could not load disposable domains from {path}: {e}")
+            return set()
+    
+    def is_disposable(self, domain: str) -> bool:
+        """Match the domain or any parent domain (mail.tempmail.com -> tempmail.com)"""
+        labels = domain.split(".")
+        return any(".".join(labels[i:]) in self.disposable_domains for i in range(len(labels) - 1))
+    
+    @staticmethod
+    def phone_parse_issue(phone: str) -> Optional[str]:
+        """A harmless formatting quirk worth noting, but never scored"""
+        if not phone or not phone.strip():
+            return None
+        if PHONE_EXTENSION_PATTERN.search(phone):
+            return "phone_extension"
+        if len(normalize_phone(phone)) == 7:
+            return "phone_missing_area_code"
+        return None
+    
+    @staticmethod
+    def phone_signal(phone: str) -> Optional[tuple]:
+        """NANP structure: NXX area code and exchange, no N11 / X9X codes, no 555-01XX or filler digits"""
+        if not phone or not phone.strip():
+            return None  # presence is checked by field validation
+        phone = PHONE_EXTENSION_PATTERN.sub("", phone)
+        digits = normalize_phone(phone)
+        if len(digits) == 7:
+            return None  # local number without an area code - a parse issue
+        if len(digits) != 10:
+            if phone.strip().startswith("+") and not phone.strip().startswith("+1") and 8 <= len(digits) <= 15:
+                return ("phone_international", 0.1)
+            return ("phone_not_nanp", 0.4)
+        area, exchange, line = digits[:3], digits[3:6], digits[6:]
+        if area[0] in "01" or area[1] == "9" or area[1:] == "11":
+            return ("phone_invalid_area_code", 0.6)
+        if exchange[0] in "01" or exchange[1:] == "11":
+            return ("phone_invalid_exchange", 0.6)
+        if exchange == "555" and line.startswith("01"):
+            return ("phone_fictional", 0.6)
+        if len(set(digits)) <= 2 or digits in SEQUENTIAL_DIGITS or digits in SEQUENTIAL_DIGITS[::-1]:
+            return ("phone_filler_digits", 0.6)
+        return None
+    
+    def email_signal(self, email: str) -> Optional[tuple]:
+        address = normalize_email(email)
+        if not address:
+            return None
+        match = EMAIL_PATTERN.fullmatch(address)
+        if match is None or len(address) > 254 or len(match.group("local")) > 64:
+            return ("email_malformed", 0.6)
+        if self.is_disposable(match.group("domain")):
+            return ("email_disposable", 0.5)
+        return None
+    
+    @staticmethod
+    def name_signals(name: str) -> List[tuple]:
+        name = (name or "").strip()
+        if not name:
+            return []
+        signals = []
+        if NAME_LINK_PATTERN.search(name):
+            signals.append(("name_contains_link", 0.8))
+        if any(char.isdigit() for char in name):
+            signals.append(("name_contains_digits", 0.3))
+        if len(name) > 60:
+            signals.append(("name_too_long", 0.3))
+        tokens = re.findall(r"[a-z]+", name.lower())
+        if any(len(token) >= 5 and not re.search(r"[aeiouy]", token) for token in tokens):
+            signals.append(("name_keyboard_mash", 0.4))
+        elif re.search(r"(.)\1{3,}", name.lower()):
+            signals.append(("name_repeated_characters", 0.3))
+        return signals
+    
+    def validate(self, name: str, phone: str, email: str) -> dict:
+        """
+        {"score": summed signal weights, "signals": [names], "parse_issues": [names],
+        "reject": bool} - higher scores are more likely fake
+        """
+        signals = self.name_signals(name)
+        for signal in (self.phone_signal(phone), self.email_signal(email)):
+            if signal is not None:
+                signals.append(signal)
+        parse_issue = self.phone_parse_issue(phone)
+        score = round(sum(weight for _, weight in signals), 2)
+        
+        self.checked += 1
+        for signal_name, _ in signals:
+            self.signal_counts[signal_name] += 1
+        if parse_issue:
+            self.signal_counts[parse_issue] += 1
+        return {
+            "score": score,
+            "signals": [signal_name for signal_name, _ in signals],
+            "parse_issues": [parse_issue] if parse_issue else [],
+            "reject": len(signals) >= 2 and score >= CONTACT_REJECT_SCORE
+        }
+    
+    @staticmethod
+    def describe(check: Optional[dict]) -> str:
+        """One-line summary for the LLM prompt; empty when nothing was flagged"""
+        if not check or not check["signals"]:
+            return ""
+        return f"score {check['score']} of {CONTACT_REJECT_SCORE} ({', '.join(check['signals'])})"
+    
+    def stats(self) -> dict:
+        return {
+            "enabled": True,
+            "reject_score": CONTACT_REJECT_SCORE,
+            "disposable_domains": len(self.disposable_domains),
+            "checked": self.checked,
+            "rejected": self.rejected,
+            "signals": dict(self.signal_counts)
+        }
+
+contact_validator = ContactValidator(DISPOSABLE_DOMAINS_PATH) if CONTACT_VALIDATION_ENABLED else None
+
+# ----- LEARNED SPAM BLOCKLIST -----
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings (double hashing from one blake2b digest)"""
+    
+    def __init__(self, capacity: int, false_positive_rate: float):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+    
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first, second = struct.unpack("<QQ", digest)
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.size
+    
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+    
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+    
+    def false_positive_rate(self) -> float:
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+class SpamBlocklist(SQLiteStore):
+    """
+    Phone numbers, email addresses, email domains and case-text fingerprints
+    learned from LLM spam verdicts (plus manual allow/deny entries), kept in
+    the lead store so every worker shares them.
+    
+    Each worker holds the active deny entries in a Bloom filter, so a clean
+    submission is cleared in memory without touching the database; only a
+    filter hit is confirmed with an exact lookup. Rows are never deleted
+    (removal is a status), which lets workers pick up each other's changes
+    by polling updated_at.
+    
+    Learned entries are "watch" until they collect enough strikes
+    (SPAM_BLOCKLIST_STRIKES, or SPAM_BLOCKLIST_DOMAIN_STRIKES distinct spam
+    senders for a domain - shared mailbox providers are never blocked as a
+    whole). A domain strike needs a sender whose email address and phone
+    number were both new for that domain, so one sender resubmitting never
+    counts twice. Entries then wait as "review" for an admin to deny them,
+    unless SPAM_BLOCKLIST_AUTO_DENY is set, and lapse after
+    SPAM_BLOCKLIST_LEARNED_TTL_DAYS without a new strike or a blocked
+    submission. Manual entries never lapse.
+    """
+    
+    KINDS = ("phone", "email", "domain", "content")
+    
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS spam_blocklist (
+            kind TEXT NOT NULL,
+            value TEXT NOT NULL,
+            action TEXT NOT NULL,
+            origin TEXT NOT NULL,
+            strikes INTEGER NOT NULL DEFAULT 0,
+            hits INTEGER NOT NULL DEFAULT 0,
+            sample TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            last_hit_at REAL,
+            PRIMARY KEY (kind, value)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_spam_blocklist_updated ON spam_blocklist (updated_at)",
+        # Phone numbers and addresses already counted as spam senders for a domain
+        """
+        CREATE TABLE IF NOT EXISTS spam_blocklist_domain_senders (
+            domain TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            seen_at REAL NOT NULL,
+            PRIMARY KEY (domain, sender)
+        )
+        """
+    )
+    
+    def __init__(self, path: str, capacity: int, false_positive_rate: float):
+        super().__init__(path)
+        self.false_positive_rate = false_positive_rate
+        self.bloom = BloomFilter(capacity, false_positive_rate)
+        self.allowed = set()
+        self.synced_until = 0.0
+        self.checks = 0
+        self.filter_hits = 0
+        self.rejections = 0
+        self.learned = 0
+        self.lapsed = 0
+    
+    @staticmethod
+    def entry_key(kind: str, value: str) -> str:
+        return f"{kind}:{value}"
+    
+    @staticmethod
+    def content_fingerprint(text: str) -> Optional[str]:
+        normalized = normalize_text(text)
+        if len(normalized) < SPAM_BLOCKLIST_MIN_CONTENT_CHARS:
+            return None
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:32]
+    
+    @classmethod
+    def submission_entries(cls, phone: str, email: str, about_case: str) -> List[tuple]:
+        """The (kind, value) pairs a submission is checked against and would teach"""
+        entries = []
+        digits = normalize_phone(phone)
+        if len(digits) >= 10:
+            entries.append(("phone", digits))
+        address = normalize_email(email)
+        if "@" in address:
+            entries.append(("email", address))
+            domain = address.rsplit("@", 1)[1]
+            if domain and domain not in FREE_EMAIL_DOMAINS:
+                entries.append(("domain", domain))
+        fingerprint = cls.content_fingerprint(about_case)
+        if fingerprint:
+            entries.append(("content", fingerprint))
+        return entries
+    
+    @classmethod
+    def normalize_entry(cls, kind: str, value: str) -> str:
+        """Normalize a manually entered value the same way submissions are"""
+        if kind == "phone":
+            return normalize_phone(value)
+        if kind == "email":
+            return normalize_email(value)
+        if kind == "domain":
+            return value.strip().lower().lstrip("@")
+        if re.fullmatch(r"[0-9a-f]{32}", value.strip().lower()):
+            return value.strip().lower()  # already a fingerprint
+        return cls.content_fingerprint(value) or ""
+    
+    def _apply(self, kind: str, value: str, action: str):
+        """Reflect one row in this worker's filter / allow set"""
+        key = self.entry_key(kind, value)
+        if action == "allow":
+            self.allowed.add(key)
+            return
+        self.allowed.discard(key)
+        if action == "deny" and key not in self.bloom:
+            if self.bloom.count >= self.bloom.capacity:
+                self._rebuild(self.bloom.capacity * 2)
+            self.bloom.add(key)
+    
+    def _rebuild(self, capacity: int):
+        rows = self._connect().execute("SELECT kind, value FROM spam_blocklist WHERE action = 'deny'").fetchall()
+        bloom = BloomFilter(max(capacity, len(rows) * 2), self.false_positive_rate)
+        for kind, value in rows:
+            bloom.add(self.entry_key(kind, value))
+        self.bloom = bloom
+        print(f"SPAM BLOCKLIST: filter rebuilt for {bloom.capacity} entries ({len(rows)} denied)")
+    
+    def sync(self) -> int:
+        """Pick up entries changed since the last sync (by this or any other worker)"""
+        with self._lock:
+            conn = self._connect()
+            # Small overlap so rows committed by another worker in the same instant are not missed
+            rows = conn.execute(
+                "SELECT kind, value, action, updated_at FROM spam_blocklist WHERE updated_at >= ?",
+                (self.synced_until - 1,)
+            ).fetchall()
+            for kind, value, action, updated_at in rows:
+                self._apply(kind, value, action)
+                self.synced_until = max(self.synced_until, updated_at)
+            return len(rows)
+    
+    def candidates(self, entries: List[tuple]) -> Optional[List[tuple]]:
+        """
+        In-memory pass: None if any entry is allow-listed, otherwise the
+        entries the filter says may be denied (usually none).
+        """
+        self.checks += 1
+        keys = [self.entry_key(kind, value) for kind, value in entries]
+        if any(key in self.allowed for key in keys):
+            return None
+        hits = [entry for entry, key in zip(entries, keys) if key in self.bloom]
+        if hits:
+            self.filter_hits += 1
+        return hits
+    
+    def confirm(self, entries: List[tuple]) -> Optional[dict]:
+        """Exact lookup of filter hits; records the hit on the first entry that is really denied"""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            for kind, value in entries:
+                row = conn.execute(
+                    "SELECT origin, strikes FROM spam_blocklist WHERE kind = ? AND value = ? AND action = 'deny'",
+                    (kind, value)
+                ).fetchone()
+                if row is None:
+                    continue  # Bloom false positive, or since removed
+                # A hit keeps an entry that is still blocking spam from lapsing
+                conn.execute(
+                    "UPDATE spam_blocklist SET hits = hits + 1, last_hit_at = ?, updated_at = ? WHERE kind = ? AND value = ?",
+                    (now, now, kind, value)
+                )
+                conn.commit()
+                self.rejections += 1
+                return {"kind": kind, "value": value, "origin": row[0], "strikes": row[1]}
+        return None
+    
+    @staticmethod
+    def _new_domain_sender(conn, domain: str, senders: List[str], now: float) -> bool:
+        """Remember a spam sender for a domain; False if its address or phone was already counted"""
+        known = conn.execute(
+            f"SELECT 1 FROM spam_blocklist_domain_senders WHERE domain = ? AND sender IN ({', '.join('?' * len(senders))}) LIMIT 1",
+            (domain, *senders)
+        ).fetchone()
+        conn.executemany(
+            "INSERT OR IGNORE INTO spam_blocklist_domain_senders (domain, sender, seen_at) VALUES (?, ?, ?)",
+            [(domain, sender, now) for sender in senders]
+        )
+        return known is None
+    
+    @staticmethod
+    def _forget_domain_senders(conn, kind: str, value: str):
+        if kind == "domain":
+            conn.execute("DELETE FROM spam_blocklist_domain_senders WHERE domain = ?", (value,))
+    
+    def learn(self, entries: List[tuple], sample: str):
+        """Add a strike to every entry of a submission the LLM flagged as spam"""
+        now = time.time()
+        promoted = "deny" if SPAM_BLOCKLIST_AUTO_DENY else "review"
+        senders = [self.entry_key(kind, value) for kind, value in entries if kind in ("phone", "email")]
+        with self._lock:
+            conn = self._connect()
+            for kind, value in entries:
+                if kind == "domain" and not self._new_domain_sender(conn, value, senders, now):
+                    continue  # a sender already counted against this domain
+                required = SPAM_BLOCKLIST_DOMAIN_STRIKES if kind == "domain" else SPAM_BLOCKLIST_STRIKES
+                conn.execute(
+                    """INSERT INTO spam_blocklist (kind, value, action, origin, strikes, sample, created_at, updated_at)
+                       VALUES (?, ?, CASE WHEN ? <= 1 THEN ? ELSE 'watch' END, 'learned', 1, ?, ?, ?)
+                       ON CONFLICT (kind, value) DO UPDATE SET
+                           strikes = strikes + 1,
+                           action = CASE WHEN action IN ('allow', 'deny', 'review') THEN action
+                                         WHEN strikes + 1 >= ? THEN ? ELSE 'watch' END,
+                           updated_at = excluded.updated_at""",
+                    (kind, value, required, promoted, sample if kind == "content" else None, now, now, required, promoted)
+                )
+                action = conn.execute(
+                    "SELECT action FROM spam_blocklist WHERE kind = ? AND value = ?", (kind, value)
+                ).fetchone()[0]
+                self._apply(kind, value, action)
+            conn.commit()
+            self.learned += 1
+    
+    def set_manual(self, kind: str, value: str, action: str) -> dict:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                """INSERT INTO spam_blocklist (kind, value, action, origin, created_at, updated_at)
+                   VALUES (?, ?, ?, 'manual', ?, ?)
+                   ON CONFLICT (kind, value) DO UPDATE SET
+                       action = excluded.action, origin = 'manual', updated_at = excluded.updated_at""",
+                (kind, value, action, now, now)
+            )
+            conn.commit()
+            self._apply(kind, value, action)
+        return {"kind": kind, "value": value, "action": action}
+    
+    def remove(self, kind: str, value: str) -> bool:
+        """Forget an entry (strikes reset); the filter bit stays until the next rebuild and is caught by confirm"""
+        with self._lock:
+            conn = self._connect()
+            cursor = conn.execute(
+                """UPDATE spam_blocklist SET action = 'removed', origin = 'manual', strikes = 0, updated_at = ?
+                   WHERE kind = ? AND value = ? AND action != 'removed'""",
+                (time.time(), kind, value)
+            )
+            self._forget_domain_senders(conn, kind, value)
+            conn.commit()
+            self._apply(kind, value, "removed")
+            return cursor.rowcount > 0
+    
+    def expire_learned(self) -> int:
+        """Lapse learned entries with no new strike or hit within the TTL (strikes reset, like a removal)"""
+        cutoff = time.time() - SPAM_BLOCKLIST_LEARNED_TTL_DAYS * 86400
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(
+                """SELECT kind, value FROM spam_blocklist
+                   WHERE origin = 'learned' AND action IN ('watch', 'review', 'deny') AND updated_at < ?""",
+                (cutoff,)
+            ).fetchall()
+            now = time.time()
+            for kind, value in rows:
+                conn.execute(
+                    "UPDATE spam_blocklist SET action = 'removed', strikes = 0, updated_at = ? WHERE kind = ? AND value = ?",
+                    (now, kind, value)
+                )
+                self._forget_domain_senders(conn, kind, value)
+                self._apply(kind, value, "removed")
+            conn.commit()
+            self.lapsed += len(rows)
+            return len(rows)
+    
+    def review_count(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM spam_blocklist WHERE action = 'review'").fetchone()[0]
+    
+    def entries(self, action: Optional[str], kind: Optional[str], limit: int) -> List[dict]:
+        clauses, params = [], []
+        for column, value in (("action", action), ("kind", kind)):
+            if value:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            conn = self._connect()
+            cursor = conn.execute(
+                f"SELECT * FROM spam_blocklist {where} ORDER BY updated_at DESC LIMIT ?", (*params, limit)
+            )
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+    
+    def stats(self) -> dict:
+        return {
+            "enabled": True,
+            "denied_in_filter": self.bloom.count,
+            "allowed": len(self.allowed),
+            "filter_bytes": len(self.bloom.bits),
+            "filter_false_positive_rate": round(self.bloom.false_positive_rate(), 6),
+            "checks": self.checks,
+            "filter_hits": self.filter_hits,
+            "rejections": self.rejections,
+            "spam_learned": self.learned,
+            "learned_lapsed": self.lapsed,
+            "auto_deny": SPAM_BLOCKLIST_AUTO_DENY
+        }
+
+spam_blocklist = SpamBlocklist(
+    LEAD_STORE_PATH, SPAM_BLOCKLIST_CAPACITY, SPAM_BLOCKLIST_FALSE_POSITIVE_RATE
+) if SPAM_BLOCKLIST_ENABLED else None
+
+async def check_spam_blocklist(phone: str, email: str, about_case: str) -> Optional[dict]:
+    """The blocklist entry a submission matches, if any - no upstream call either way"""
+    if spam_blocklist is None:
+        return None
+    candidates = spam_blocklist.candidates(SpamBlocklist.submission_entries(phone, email, about_case))
+    if not candidates:
+        return None
+    try:
+        return await asyncio.to_thread(spam_blocklist.confirm, candidates)
+    except Exception as e:
+        print(f"SPAM BLOCKLIST: lookup failed, falling back to spam detection: {e}")
+        return None
+
+async def learn_spam_submission(phone: str, email: str, about_case: str):
+    """Remember an LLM-confirmed spammer so the next attempt is rejected before any upstream call"""
+    if spam_blocklist is None:
+        return
+    entries = SpamBlocklist.submission_entries(phone, email, about_case)
+    if spam_blocklist.candidates(entries) is None:
+        return  # allow-listed - never learn from it
+    try:
+        await asyncio.to_thread(spam_blocklist.learn, entries, about_case[:200])
+    except Exception as e:
+        print(f"SPAM BLOCKLIST: could not record spam submission: {e}")
+
+async def load_spam_blocklist():
+    """Startup hook: load the blocklist into this worker's filter (kept in sync by the maintenance scheduler)"""
+    if spam_blocklist is None:
+        return
+    try:
+        loaded = await asyncio.to_thread(spam_blocklist.sync)
+        print(f"SPAM BLOCKLIST: loaded {loaded} entries ({spam_blocklist.bloom.count} denied)")
+    except Exception as e:
+        print(f"SPAM BLOCKLIST: could not load entries: {e}")
+
+def sync_spam_blocklist() -> Optional[str]:
+    changed = spam_blocklist.sync()
+    if changed:
+        return f"picked up {changed} changed blocklist entries"
+
+def expire_spam_blocklist() -> Optional[str]:
+    lapsed = spam_blocklist.expire_learned()
+    if lapsed:
+        return f"lapsed {lapsed} learned blocklist entries"
+
+app_startup_hooks.append(load_spam_blocklist)
+if spam_blocklist is not None:
+    maintenance.register("spam_blocklist_sync", SPAM_BLOCKLIST_SYNC_INTERVAL, sync_spam_blocklist, blocking=True)
+    maintenance.register("spam_blocklist_expiry", SPAM_BLOCKLIST_EXPIRY_INTERVAL, expire_spam_blocklist, blocking=True)
+
+def blocklist_entry_or_400(kind: str, value: str) -> str:
+    if spam_blocklist is None:
+        raise HTTPException(status_code=503, detail="Spam blocklist disabled")
+    if kind not in SpamBlocklist.KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {', '.join(SpamBlocklist.KINDS)}")
+    normalized = SpamBlocklist.normalize_entry(kind, value or "")
+    if not normalized:
+        raise HTTPException(status_code=400, detail=f"Invalid {kind} value")
+    return normalized
+
+@app.get("/admin/blocklist")
+async def list_blocklist(request: Request, action: Optional[str] = None, kind: Optional[str] = None, limit: int = 100):
+    """
+    Blocklist entries, most recently changed first (action: deny, watch,
+    review, allow or removed). action=review lists learned entries waiting
+    for approval - POST them as deny to enforce, or DELETE / allow them.
+    """
+    require_admin_key(request)
+    if spam_blocklist is None:
+        raise HTTPException(status_code=503, detail="Spam blocklist disabled")
+    rows = await asyncio.to_thread(spam_blocklist.entries, action, kind, max(1, min(limit, 1000)))
+    return {
+        "status": "success",
+        "count": len(rows),
+        "awaiting_review": await asyncio.to_thread(spam_blocklist.review_count),
+        "entries": rows,
+        "stats": spam_blocklist.stats(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.post("/admin/blocklist")
+async def update_blocklist(request: Request, kind: str, value: str, action: str = "deny"):
+    """
+    Manually deny or allow a phone, email, domain or case text (content
+    accepts the text itself or its fingerprint). Allow entries exempt a
+    submission from the blocklist and from learning; the LLM check still runs.
+    """
+    require_admin_key(request)
+    if action not in ("deny", "allow"):
+        raise HTTPException(status_code=400, detail="action must be deny or allow")
+    normalized = blocklist_entry_or_400(kind, value)
+    if kind == "domain" and action == "deny" and normalized in FREE_EMAIL_DOMAINS:
+        raise HTTPException(status_code=400, detail=f"{normalized} is a shared mailbox provider - block the address instead")
+    entry = await asyncio.to_thread(spam_blocklist.set_manual, kind, normalized, action)
+    print(f"SPAM BLOCKLIST: manual {action} for {kind} {normalized}")
+    return {"status": "success", "entry": entry, "timestamp": datetime.now().isoformat()}
+
+@app.delete("/admin/blocklist")
+async def remove_blocklist_entry(request: Request, kind: str, value: str):
+    """Forget a denied, watched, pending-review or allowed entry"""
+    require_admin_key(request)
+    normalized = blocklist_entry_or_400(kind, value)
+    if not await asyncio.to_thread(spam_blocklist.remove, kind, normalized):
+        raise HTTPException(status_code=404, detail="No such blocklist entry")
+    print(f"SPAM BLOCKLIST: removed {kind} {normalized}")
+    return {"status": "success", "removed": {"kind": kind, "value": normalized}, "timestamp": datetime.now().isoformat()}
+
 def parse_error_code_from_content(content: str) -> int:
     """
     Parse error code from webhook response content.
@@ -599,6 +3043,186 @@ def parse_error_code_from_content(content: str) -> int:
     
     return None
 
+class MakeWebhookBatcher(MicroBatcher):
+    """
+    Batched JSON forwarding to Make (MAKE_WEBHOOK_MODE=batch).
+    Leads queue for up to MAKE_BATCH_WINDOW_MS or until MAKE_BATCH_MAX_SIZE
+    are waiting, then go out as one JSON request:
+        {"batch": true, "count": n, "leads": [{"item_id": ..., ...lead fields}]}
+    The scenario iterates "leads" and answers with a webhook response of
+        {"results": [{"item_id": ..., "status": 200, "message": "..."}]}
+    Each waiting request gets its own item's result. Items that failed with a
+    5xx (or whose whole request failed) are re-queued into the next batch
+    until MAKE_BATCH_MAX_ATTEMPTS; 4xx results are final. A plain 200
+    without a results list counts as success for every item.
+    
+    When a request's deadline runs out, an item still waiting for its batch
+    is withdrawn and the request fails with 504; an item already posted is
+    reported as pending (202) - it was forwarded and is still settled
+    (and retried) in the background.
+    """
+    
+    TASK_KIND = "make_batch"
+    
+    def __init__(self, window_seconds: float, max_batch_size: int):
+        super().__init__(window_seconds, max_batch_size)  # _pending: [(item_id, webhook_data, future, attempt)]
+        self.batches_sent = 0
+        self.items_sent = 0
+        self.items_requeued = 0
+        self.items_withdrawn = 0
+        self.items_pending = 0
+    
+    async def submit(self, webhook_data: dict) -> dict:
+        item_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue((item_id, webhook_data, future, 1))
+        
+        budget = remaining_budget()
+        try:
+            # Shielded so a timed-out request doesn't cancel the item for the rest of the batch
+            return await asyncio.wait_for(asyncio.shield(future), timeout=budget)
+        except asyncio.TimeoutError:
+            if self._withdraw(item_id):
+                # Never posted (or waiting for a retry) - the lead really was not forwarded
+                self.items_withdrawn += 1
+                raise DeadlineExceeded("make")
+        
+        # Already posted to Make - the lead was forwarded, only its result is late
+        self.items_pending += 1
+        print(f"MAKE BATCH: result for {webhook_data.get('name')} still pending at the deadline")
+        return {
+            'success': True,
+            'response': {
+                'status_code': 202,
+                'content': 'Forwarded in a batch; result pending',
+                'pending': True
+            },
+            'message': 'Sent to webhook (batched), result pending'
+        }
+    
+    def _withdraw(self, item_id: str) -> bool:
+        """Take an item out of the batch being collected; False if it was already sent"""
+        for index, item in enumerate(self._pending):
+            if item[0] == item_id:
+                del self._pending[index]
+                return True
+        return False
+    
+    async def _send_batch(self, batch: list):
+        # Not tied to any one lead's deadline - each waiter enforces its own
+        request_deadline.set(time.monotonic() + DEFERRED_STAGE_DEADLINE_SECONDS)
+        payload = {
+            "batch": True,
+            "count": len(batch),
+            "leads": [{"item_id": item_id, **webhook_data} for item_id, webhook_data, _, _ in batch]
+        }
+        print(f"MAKE BATCH: Forwarding {len(batch)} lead(s) in one request")
+        
+        try:
+            response = await call_upstream(
+                "make",
+                upstream_sessions["make"].post,
+                MAKE_WEBHOOK_URL,
+                json=payload,
+                timeout=30
+            )
+        except UpstreamUnavailable as e:
+            await self._settle(batch, {}, request_status=e.status_code, request_error=str(e.detail))
+            return
+        except requests.exceptions.RequestException as e:
+            print(f"MAKE BATCH: request failed: {e}")
+            await self._settle(batch, {}, request_status=503, request_error=str(e))
+            return
+        
+        self.batches_sent += 1
+        results = {}
+        try:
+            body = response.json()
+            for result in body.get("results") or []:
+                if isinstance(result, dict) and result.get("item_id"):
+                    results[result["item_id"]] = result
+        except ValueError:
+            pass  # not JSON - fall back to the request's own status
+        
+        if response.status_code == 200:
+            await self._settle(batch, results, request_status=200, elapsed=response.elapsed.total_seconds())
+        else:
+            status = parse_error_code_from_content(response.text) or response.status_code
+            await self._settle(
+                batch, results, request_status=status, request_error=response.text[:500],
+                elapsed=response.elapsed.total_seconds()
+            )
+    
+    async def _settle(
+        self,
+        batch: list,
+        results: dict,
+        request_status: int,
+        request_error: Optional[str] = None,
+        elapsed: Optional[float] = None
+    ):
+        """Resolve each item from its own result, re-queueing retryable failures"""
+        server_failures = []
+        for item_id, webhook_data, future, attempt in batch:
+            # Settled even if its request stopped waiting (reported pending) - it may still need a retry
+            result = results.get(item_id, {})
+            try:
+                status = int(result.get("status", request_status))
+            except (TypeError, ValueError):
+                status = request_status
+            message = result.get("message") or request_error or "OK"
+            
+            if status >= 500 and attempt < MAKE_BATCH_MAX_ATTEMPTS:
+                self.items_requeued += 1
+                self._enqueue((item_id, webhook_data, future, attempt + 1))
+                continue
+            
+            response_details = {
+                'status_code': status,
+                'content': message,
+                'batch_size': len(batch),
+                'attempts': attempt,
+                'elapsed_seconds': elapsed
+            }
+            self.items_sent += 1
+            if 200 <= status < 300:
+                future.set_result({
+                    'success': True,
+                    'response': response_details,
+                    'message': 'Successfully sent to webhook (batched)'
+                })
+            else:
+                print(f"MAKE BATCH: item for {webhook_data.get('name')} failed with {status}: {message[:200]}")
+                if status >= 500:
+                    server_failures.append(f"{webhook_data.get('name')}: {status} {message[:100]}")
+                future.set_result({
+                    'success': False,
+                    'response': response_details,
+                    'effective_status_code': status,
+                    'message': f'Webhook failed with status {status}'
+                })
+        
+        # Only server errors alert, as on the single-request path
+        if server_failures:
+            await send_error_alert(
+                f"Batched webhook server errors for {len(server_failures)} lead(s): " + "; ".join(server_failures[:5]),
+                "/submit-lead"
+            )
+    
+    def stats(self) -> dict:
+        return {
+            "mode": MAKE_WEBHOOK_MODE,
+            "batch_window_ms": int(self.window_seconds * 1000),
+            "queued": len(self._pending),
+            "batches_sent": self.batches_sent,
+            "items_sent": self.items_sent,
+            "items_requeued": self.items_requeued,
+            "items_withdrawn": self.items_withdrawn,
+            "items_pending": self.items_pending
+        }
+
+make_webhook_batcher = MakeWebhookBatcher(MAKE_BATCH_WINDOW_SECONDS, MAKE_BATCH_MAX_SIZE)
+
 async def send_to_webhook(webhook_data: dict) -> dict:
     """
     Send the submission data to the webhook in a unified format.
@@ -622,11 +3246,17 @@ async def send_to_webhook(webhook_data: dict) -> dict:
         
         print(f"Sending to webhook: {webhook_data}")
         
-        # Send POST request to make.com webhook
-        response = requests.post(
+        if MAKE_WEBHOOK_MODE == "batch":
+            return await make_webhook_batcher.submit(webhook_data)
+        
+        # Send POST request to make.com webhook (form-encoded unless JSON mode is on)
+        body = {"json": webhook_data} if MAKE_WEBHOOK_MODE == "json" else {"data": webhook_data}
+        response = await call_upstream(
+            "make",
+            upstream_sessions["make"].post,
             MAKE_WEBHOOK_URL,
-            data=webhook_data,
-            timeout=30
+            timeout=30,
+            **body
         )
         
         # Capture response details
@@ -675,6 +3305,8 @@ async def send_to_webhook(webhook_data: dict) -> dict:
                 'message': f'Webhook failed with status {effective_status_code}'
             }
             
+    except UpstreamUnavailable:
+        raise
     except requests.exceptions.Timeout as e:
         error_msg = f"Webhook request timed out: {str(e)}"
         print(error_msg)
@@ -710,19 +3342,23 @@ async def send_to_webhook(webhook_data: dict) -> dict:
 
 async def send_sms_notification(phone_number: str, user_name: str, source: str, case_info: str, is_referral: bool = False):
     """Send SMS notification via Twilio"""
+    # Format the message based on source
+    if source == "form":
+        message_body = f"Roth Davies Form - New Lead: {user_name} - {case_info}. Phone: {phone_number}"
+    else:  # chatbot
+        message_body = f"Roth Davies Chatbot - New Lead: {user_name} - {case_info}. Phone: {phone_number}"
+    
+    if is_referral:
+        message_body += " (Referral Request)"
+    
+    return await send_sms_message(message_body)
+
+async def send_sms_message(message_body: str) -> bool:
+    """Send an SMS to the intake (or debug) phone via Twilio"""
     try:
         # Get the appropriate phone number based on debug mode
         notification_phone = get_notification_phone()
         
-        # Format the message based on source
-        if source == "form":
-            message_body = f"Roth Davies Form - New Lead: {user_name} - {case_info}. Phone: {phone_number}"
-        else:  # chatbot
-            message_body = f"Roth Davies Chatbot - New Lead: {user_name} - {case_info}. Phone: {phone_number}"
-        
-        if is_referral:
-            message_body += " (Referral Request)"
-        
         # Add debug prefix if in debug mode
         if is_debug_mode():
             message_body = f"[DEBUG] {message_body}"
@@ -733,7 +3369,9 @@ async def send_sms_notification(phone_number: str, user_name: str, source: str,
             print("DEBUG MODE: SMS notification redirected to debug phone number")
         
         # Send SMS via Twilio
-        response = requests.post(
+        response = await call_upstream(
+            "twilio",
+            upstream_sessions["twilio"].post,
             f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json",
             auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN),
             data={
@@ -753,6 +3391,8 @@ async def send_sms_notification(phone_number: str, user_name: str, source: str,
             await send_error_alert(error_msg, "/submit-lead")
             return False
             
+    except UpstreamUnavailable:
+        raise
     except requests.exceptions.RequestException as e:
         error_msg = f"Twilio API request failed: {str(e)}"
         print(error_msg)
@@ -764,41 +3404,595 @@ async def send_sms_notification(phone_number: str, user_name: str, source: str,
         await send_error_alert(error_msg, "/submit-lead")
         return False
     
-# ----- HANDLE GO HIGH LEVEL PIPELINE STAGE CHANGE EMAIL ENDPOINT -----
+# ----- LEAD NOTIFICATION DIGEST -----
 
-@app.post("/webhook/opportunity-stage-change")
-async def handle_opportunity_stage_change(request: Request):
-    """Handle GoHighLevel opportunity stage change webhook and send email"""
-    client_ip = request.client.host
+class LeadNotificationDigest(MicroBatcher):
+    """
+    Burst-aware lead notifications.
+    The first lead after a quiet period is notified immediately and opens a
+    LEAD_DIGEST_WINDOW_SECONDS window; leads arriving inside the window are
+    only collected, and when it closes they go out as one summary SMS and
+    one summary email. A non-empty digest opens the next window, so a
+    sustained burst costs one SMS per window. Each lead still reaches the
+    webhook individually. Per worker - each worker batches its own leads.
+    """
     
-    if not check_rate_limit(client_ip):
-        raise HTTPException(status_code=429, detail="Rate limit exceeded")
+    MAX_SMS_NAMES = 8
+    TASK_KIND = "lead_digest"
     
-    try:
-        payload = await request.json()
-        
-        # Extract email data from customData
-        custom_data = payload.get('customData', {})
-        to_email = custom_data.get('to_email')
-        subject = custom_data.get('subject') 
-        html_content = custom_data.get('html_content')
-        api_key = custom_data.get('api_key')
+    def __init__(self, window_seconds: float):
+        super().__init__(window_seconds)  # no size limit - a digest holds every lead of its window
+        self.digests_sent = 0
+        self.leads_digested = 0
+    
+    def window_open(self) -> bool:
+        return self._window_task is not None
+    
+    def open_window(self):
+        """Called when a lead was notified immediately"""
+        self._open_window()
+    
+    def add(self, lead: dict):
+        self._pending.append(lead)
+        print(f"LEAD DIGEST: holding notifications for {lead['name']} ({len(self._pending)} lead(s) in this window)")
+    
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window_seconds)
+        self._window_task = None
+        if not self._pending:
+            return  # quiet again - the next lead is notified immediately
+        self._open_window()
+        self._flush()
+    
+    async def _send_batch(self, batch: list):
+        # Runs after the leads' responses went out, so it gets its own deadline
+        request_deadline.set(time.monotonic() + DEFERRED_STAGE_DEADLINE_SECONDS)
+        print(f"LEAD DIGEST: sending summary for {len(batch)} lead(s)")
+        try:
+            sms_sent = await send_sms_message(self._sms_body(batch))
+            email_result = {"success": False, "error": "notification email not configured"}
+            notification_email = get_notification_email()
+            if notification_email:
+                email_result = await send_email_via_resend(
+                    to_email=notification_email,
+                    subject=f"{len(batch)} New Lead{'s' if len(batch) != 1 else ''} (digest)",
+                    html_content=self._email_html(batch)
+                )
+        except UpstreamUnavailable as e:
+            # Shed or out of time - fold these leads into the next digest
+            print(f"LEAD DIGEST: notifications unavailable ({e.detail}), holding {len(batch)} lead(s) for the next window")
+            self._pending = batch + self._pending
+            self._open_window()
+            return
         
-        # Validate required fields
-        if not all([to_email, subject, html_content, api_key]):
-            missing = [k for k, v in {
-                'to_email': to_email, 'subject': subject, 
-                'html_content': html_content, 'api_key': api_key
-            }.items() if not v]
-            raise HTTPException(status_code=400, detail=f"Missing required fields in customData: {missing}")
+        if not email_result["success"]:
+            await send_error_alert(f"Lead digest email failed: {email_result.get('error', 'Unknown error')}", "/submit-lead")
+        self.digests_sent += 1
+        self.leads_digested += len(batch)
+        print(f"LEAD DIGEST: {len(batch)} lead(s) summarised - SMS sent: {sms_sent}, email sent: {email_result['success']}")
+    
+    def _sms_body(self, batch: list) -> str:
+        minutes = max(1, round(self.window_seconds / 60))
+        names = [
+            f"{lead['name']} ({lead['source']}{', referral' if lead['is_referral'] else ''})"
+            for lead in batch[:self.MAX_SMS_NAMES]
+        ]
+        if len(batch) > self.MAX_SMS_NAMES:
+            names.append(f"+{len(batch) - self.MAX_SMS_NAMES} more")
+        plural = "s" if len(batch) != 1 else ""
+        return f"Roth Davies - {len(batch)} new lead{plural} in the last {minutes} min: {', '.join(names)}. Details in email/GHL."
+    
+    def _email_html(self, batch: list) -> str:
+        rows = "".join(
+            f"""
+                <tr>
+                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{html.escape(lead['received_at'])}</td>
+                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{html.escape(lead['name'])}{' <strong>(Referral)</strong>' if lead['is_referral'] else ''}</td>
+                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{html.escape(lead['source'].title())}</td>
+                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{html.escape(lead['phone'] or 'Not provided')}</td>
+                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{html.escape(lead['email'] or '')}</td>
+                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{html.escape(lead['summary'])}</td>
+                </tr>"""
+            for lead in batch
+        )
+        debug_banner = '<p style="color: #c00;"><strong>DEBUG MODE</strong> - digest sent to debug contacts</p>' if is_debug_mode() else ""
+        return f"""
+    <html>
+    <body style="font-family: Arial, sans-serif; color: #333;">
+        {debug_banner}
+        <h2>{len(batch)} new leads arrived during a burst</h2>
+        <p>These leads were collected into one notification. Each one was forwarded to GoHighLevel individually.</p>
+        <table style="border-collapse: collapse; width: 100%;">
+            <tr style="background: #f5f5f5; text-align: left;">
+                <th style="padding: 8px;">Received</th><th style="padding: 8px;">Name</th><th style="padding: 8px;">Source</th>
+                <th style="padding: 8px;">Phone</th><th style="padding: 8px;">Email</th><th style="padding: 8px;">Case</th>
+            </tr>{rows}
+        </table>
+    </body>
+    </html>
+    """
+    
+    def stats(self) -> dict:
+        return {
+            "enabled": LEAD_DIGEST_ENABLED,
+            "window_seconds": self.window_seconds,
+            "window_open": self.window_open(),
+            "held": len(self._pending),
+            "digests_sent": self.digests_sent,
+            "leads_digested": self.leads_digested
+        }
+
+lead_digest = LeadNotificationDigest(LEAD_DIGEST_WINDOW_SECONDS)
+
+# Flush every batcher on shutdown. Hooks run in reverse, so spam verdicts go
+# first (they release webhook forwards), then Make, then the digest.
+app_shutdown_hooks.append(lead_digest.drain)
+app_shutdown_hooks.append(make_webhook_batcher.drain)
+app_shutdown_hooks.append(spam_batcher.drain)
+
+# ----- IDEMPOTENT REQUEST HANDLING -----
+
+class IdempotencyCache:
+    """
+    Bounded TTL store of responses keyed by idempotency key.
+    The first request for a key runs the handler; retries that arrive while
+    it is still running await the same future, and later retries get the
+    stored response replayed. Client errors (4xx) are stored like successes,
+    server errors are not, so a retry after a 5xx does the work again.
+    Each entry remembers a fingerprint of the payload that created it; a key
+    reused with a different payload is rejected with 422 instead of replayed.
+    Per worker - cross-worker repeats of a lead are still caught by duplicate detection.
+    """
+    
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.replays = 0
+        self.waits = 0
+        self.mismatches = 0
+        self._entries = OrderedDict()  # key -> (expires_at, future, fingerprint)
+    
+    async def run(self, key: str, ttl: float, handler, fingerprint: str = ""):
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            if entry[2] != fingerprint:
+                self.mismatches += 1
+                print(f"IDEMPOTENCY: key {key[:24]}... reused with a different payload")
+                raise HTTPException(status_code=422, detail="Idempotency-Key reused with a different payload")
+            future = entry[1]
+            if future.done():
+                self.replays += 1
+            else:
+                self.waits += 1
+                print(f"IDEMPOTENCY: waiting on in-flight request for key {key[:24]}...")
+            outcome = await asyncio.shield(future)
+            return self._replay(outcome)
         
-        # Validate API key (security check)
-        if api_key != GHL_WEBHOOK_API_KEY:
-            print(f"Invalid API key in webhook: {api_key}")
-            raise HTTPException(status_code=401, detail="Invalid API key")
+        future = asyncio.get_running_loop().create_future()
+        self._entries[key] = (now + ttl, future, fingerprint)
+        self._entries.move_to_end(key)
+        self._evict(now)
         
-        print(f"Sending opportunity stage change email to: {to_email}")
-        print(f"Subject: {subject}")
+        try:
+            response = await handler()
+        except HTTPException as e:
+            if e.status_code >= 500:
+                self._forget(key, future, e)
+            else:
+                future.set_result(e)
+            raise
+        except BaseException as e:
+            self._forget(key, future, e)
+            raise
+        
+        if isinstance(response, JSONResponse):
+            outcome = (response.status_code, json.loads(response.body))
+        else:
+            outcome = (200, jsonable_encoder(response))
+        if outcome[0] >= 500:
+            self._forget(key, future, HTTPException(status_code=outcome[0], detail=outcome[1]))
+        else:
+            future.set_result(outcome)
+        return response
+    
+    def _replay(self, outcome):
+        if isinstance(outcome, HTTPException):
+            raise HTTPException(
+                status_code=outcome.status_code,
+                detail=outcome.detail,
+                headers={**(outcome.headers or {}), "Idempotent-Replayed": "true"}
+            )
+        status_code, content = outcome
+        return JSONResponse(status_code=status_code, content=content, headers={"Idempotent-Replayed": "true"})
+    
+    def _forget(self, key: str, future: asyncio.Future, error: BaseException):
+        """Drop a failed attempt so the next retry runs again; waiters get the error"""
+        if self._entries.get(key, (None, None, None))[1] is future:
+            del self._entries[key]
+        if isinstance(error, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(error)
+            future.exception()  # mark retrieved - there may be no waiters
+    
+    def _evict(self, now: float):
+        # Expired entries at the old end go first, then the oldest beyond the bound
+        while self._entries:
+            oldest_key, (expires_at, future, _) = next(iter(self._entries.items()))
+            if len(self._entries) > self.max_entries or (expires_at <= now and future.done()):
+                del self._entries[oldest_key]
+            else:
+                break
+    
+    def trim(self) -> int:
+        """Drop every expired, settled entry - not just those at the old end that _evict reaches"""
+        now = time.monotonic()
+        expired = [key for key, (expires_at, future, _) in self._entries.items() if expires_at <= now and future.done()]
+        for key in expired:
+            del self._entries[key]
+        return len(expired)
+    
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "in_flight": sum(1 for _, future, _ in self._entries.values() if not future.done()),
+            "replays": self.replays,
+            "waits": self.waits,
+            "mismatches": self.mismatches
+        }
+
+idempotency_cache = IdempotencyCache(IDEMPOTENCY_MAX_ENTRIES)
+
+def trim_idempotency_cache() -> Optional[str]:
+    trimmed = idempotency_cache.trim()
+    if trimmed:
+        return f"trimmed {trimmed} expired idempotency entries"
+
+maintenance.register("idempotency_trim", IDEMPOTENCY_TRIM_INTERVAL, trim_idempotency_cache)
+
+def get_idempotency_key(request: Request, payload_material: str, derive_from_payload: bool = True) -> tuple:
+    """
+    Key, TTL and payload fingerprint for a request. A client's Idempotency-Key
+    header is scoped to that client, so two callers picking the same key never
+    share a response. Without a header the key is the payload hash when
+    derive_from_payload is set, otherwise None (no idempotency handling).
+    """
+    route = request.url.path
+    fingerprint = hashlib.sha256(payload_material.encode("utf-8")).hexdigest()
+    header_key = request.headers.get("idempotency-key", "").strip()
+    if header_key:
+        digest = hashlib.sha256(f"{get_client_ip(request)}|{header_key}".encode("utf-8")).hexdigest()
+        return f"{route}|key|{digest}", IDEMPOTENCY_TTL_SECONDS, fingerprint
+    if not derive_from_payload:
+        return None, 0, fingerprint
+    return f"{route}|payload|{fingerprint}", IDEMPOTENCY_DERIVED_TTL_SECONDS, fingerprint
+
+# ----- BATCHED STAGE CHANGE EMAILS -----
+
+class StageEmailStore(SQLiteStore):
+    """
+    SQLite record of every queued stage-change email and its delivery status.
+    Lives in the lead store database so all workers share it and queued
+    emails survive a restart.
+    """
+    
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS stage_emails (
+            message_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            resend_id TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_stage_emails_status_updated ON stage_emails (status, updated_at)"
+    )
+    
+    def create(self, message_id: str, email: dict):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT INTO stage_emails (message_id, status, payload, created_at, updated_at) VALUES (?, 'queued', ?, ?, ?)",
+                (message_id, json.dumps(email), now, now)
+            )
+            conn.commit()
+    
+    def set_statuses(self, updates: List[tuple]):
+        """Apply (message_id, status, resend_id, error) updates in one transaction"""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                """UPDATE stage_emails
+                   SET status = ?, resend_id = COALESCE(?, resend_id), error = ?, updated_at = ?,
+                       attempts = attempts + CASE WHEN ? = 'sending' THEN 1 ELSE 0 END
+                   WHERE message_id = ?""",
+                [(status, resend_id, error, now, status, message_id) for message_id, status, resend_id, error in updates]
+            )
+            conn.commit()
+    
+    def get(self, message_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT status, resend_id, error, attempts, created_at, updated_at FROM stage_emails WHERE message_id = ?",
+                (message_id,)
+            ).fetchone()
+        if not row:
+            return None
+        status, resend_id, error, attempts, created_at, updated_at = row
+        return {
+            "status": status,
+            "resend_id": resend_id,
+            "error": error,
+            "attempts": attempts,
+            "created_at": created_at,
+            "updated_at": updated_at
+        }
+    
+    def claim_stale(self, older_than: float) -> List[tuple]:
+        """
+        Claim emails that were queued but never sent (crash/deploy mid-window).
+        An email caught mid-send may already have gone out, so recovery can
+        re-send it; a duplicate status email beats a lost one.
+        """
+        claimed = []
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(
+                "SELECT message_id, payload, updated_at FROM stage_emails WHERE status IN ('queued', 'sending') AND updated_at < ?",
+                (older_than,)
+            ).fetchall()
+            for message_id, payload, updated_at in rows:
+                cursor = conn.execute(
+                    "UPDATE stage_emails SET status = 'queued', updated_at = ? WHERE message_id = ? AND updated_at = ?",
+                    (time.time(), message_id, updated_at)
+                )
+                if cursor.rowcount == 1:
+                    claimed.append((message_id, json.loads(payload)))
+            conn.commit()
+        return claimed
+    
+    def purge(self, older_than: float) -> int:
+        with self._lock:
+            conn = self._connect()
+            cursor = conn.execute(
+                "DELETE FROM stage_emails WHERE status IN ('sent', 'failed') AND updated_at < ?",
+                (older_than,)
+            )
+            conn.commit()
+            return cursor.rowcount
+
+stage_email_store = StageEmailStore(LEAD_STORE_PATH)
+
+class StageEmailBatcher(MicroBatcher):
+    """
+    Collects stage-change emails for a short window and sends them through
+    Resend's batch endpoint, so a GHL bulk move costs one upstream call per
+    100 emails instead of one per webhook. Unlike SpamBatcher nobody waits
+    on the result: outcomes are written to stage_email_store.
+    """
+    
+    TASK_KIND = "stage_email_batch"
+    
+    def __init__(self, window_seconds: float, max_batch_size: int):
+        super().__init__(window_seconds, max_batch_size)  # _pending: [(message_id, email, attempt)]
+        self.batches_sent = 0
+        self.emails_sent = 0
+        self.emails_failed = 0
+    
+    def enqueue(self, message_id: str, email: dict, attempt: int = 1):
+        self._enqueue((message_id, email, attempt))
+    
+    async def _send_batch(self, batch: list):
+        # Runs after the webhooks were acknowledged, so it gets its own deadline
+        request_deadline.set(time.monotonic() + DEFERRED_STAGE_DEADLINE_SECONDS)
+        message_ids = [message_id for message_id, _, _ in batch]
+        
+        try:
+            await asyncio.to_thread(
+                stage_email_store.set_statuses,
+                [(message_id, "sending", None, None) for message_id in message_ids]
+            )
+            results = await self._post_batch([email for _, email, _ in batch])
+        except UpstreamUnavailable as e:
+            # Shed or out of time - give the emails another window rather than dropping them
+            requeued = [(message_id, email, attempt + 1) for message_id, email, attempt in batch if attempt < STAGE_EMAIL_MAX_ATTEMPTS]
+            print(f"STAGE EMAIL BATCH: Resend unavailable ({e.detail}), re-queueing {len(requeued)} of {len(batch)} email(s)")
+            results = [(False, None, f"Resend unavailable: {e.detail}")] * len(batch)
+            requeued_ids = {message_id for message_id, _, _ in requeued}
+            await self._record(batch, results, skip=requeued_ids)
+            for message_id, email, attempt in requeued:
+                self.enqueue(message_id, email, attempt)
+            return
+        except Exception as e:
+            results = [(False, None, f"Error sending stage change emails: {str(e)}")] * len(batch)
+        
+        await self._record(batch, results)
+    
+    async def _post_batch(self, emails: list) -> List[tuple]:
+        """Send emails through Resend and return (success, resend_id, error) per email"""
+        if len(emails) == 1:
+            email = emails[0]
+            result = await send_email_via_resend(email["to_email"], email["subject"], email["html_content"])
+            resend_id = (result.get("response_data") or {}).get("id") if result["success"] else None
+            return [(result["success"], resend_id, result.get("error"))]
+        
+        payload = [
+            build_resend_email(email["to_email"], email["subject"], email["html_content"])
+            for email in emails
+        ]
+        print(f"STAGE EMAIL BATCH: Sending {len(payload)} emails in one Resend request")
+        response = await call_upstream(
+            "resend",
+            upstream_sessions["resend"].post,
+            "https://api.resend.com/emails/batch",
+            headers={
+                "Authorization": f"Bearer {RESEND_API_KEY}",
+                "Content-Type": "application/json"
+            },
+            json=payload,
+            timeout=30
+        )
+        
+        if not 200 <= response.status_code < 300:
+            error_msg = f"Resend batch API returned status {response.status_code}: {response.text}"
+            return [(False, None, error_msg)] * len(emails)
+        
+        self.batches_sent += 1
+        # Resend returns one {"id": ...} per email, in request order
+        data = (response.json() or {}).get("data") or []
+        results = []
+        for index in range(len(emails)):
+            resend_id = data[index].get("id") if index < len(data) and isinstance(data[index], dict) else None
+            results.append((True, resend_id, None))
+        return results
+    
+    async def _record(self, batch: list, results: list, skip: set = frozenset()):
+        updates = []
+        failures = []
+        for (message_id, email, _), (success, resend_id, error) in zip(batch, results):
+            if message_id in skip:
+                # Re-queued for another window; the error explains the wait
+                updates.append((message_id, "queued", None, error))
+                continue
+            updates.append((message_id, "sent" if success else "failed", resend_id, error))
+            if success:
+                self.emails_sent += 1
+            else:
+                self.emails_failed += 1
+                failures.append(f"{email['to_email']}: {error}")
+        
+        if updates:
+            try:
+                await asyncio.to_thread(stage_email_store.set_statuses, updates)
+            except Exception as e:
+                print(f"STAGE EMAIL BATCH: could not record delivery status: {e}")
+        
+        sent = len(updates) - len(skip) - len(failures)
+        print(f"STAGE EMAIL BATCH: {sent} sent, {len(failures)} failed")
+        if failures:
+            # One alert per batch, not one per email
+            await send_error_alert(
+                f"{len(failures)} opportunity stage change email(s) failed:\n" + "\n".join(failures[:10]),
+                "/webhook/opportunity-stage-change"
+            )
+    
+    def stats(self) -> dict:
+        return {
+            "batching_enabled": STAGE_EMAIL_BATCHING_ENABLED,
+            "batch_window_ms": int(self.window_seconds * 1000),
+            "queued": len(self._pending),
+            "batches_sent": self.batches_sent,
+            "emails_sent": self.emails_sent,
+            "emails_failed": self.emails_failed
+        }
+
+stage_email_batcher = StageEmailBatcher(STAGE_EMAIL_BATCH_WINDOW_SECONDS, STAGE_EMAIL_BATCH_MAX_SIZE)
+
+async def recover_queued_stage_emails() -> Optional[str]:
+    """
+    Re-queue emails orphaned by a crash or deploy. Runs at startup and then
+    periodically, so emails left behind by a worker that died while the
+    others kept running are picked up too.
+    """
+    stale_emails = await asyncio.to_thread(stage_email_store.claim_stale, time.time() - STAGE_EMAIL_RECOVERY_GRACE)
+    for message_id, email in stale_emails:
+        print(f"STAGE EMAIL {message_id}: re-queueing unsent email from a previous run")
+        stage_email_batcher.enqueue(message_id, email)
+    if stale_emails:
+        return f"re-queued {len(stale_emails)} orphaned stage change emails"
+
+def purge_stage_email_records() -> Optional[str]:
+    purged = stage_email_store.purge(time.time() - LEAD_STATUS_RETENTION)
+    if purged:
+        return f"purged {purged} old stage change email records"
+
+app_shutdown_hooks.append(stage_email_batcher.drain)
+maintenance.register("stage_email_recovery", LEAD_RECOVERY_INTERVAL, recover_queued_stage_emails, run_at_start=True)
+maintenance.register("stage_email_purge", RETENTION_PURGE_INTERVAL, purge_stage_email_records, blocking=True, run_at_start=True)
+
+@app.get("/email-status/{message_id}")
+async def get_email_status(message_id: str):
+    """Report the delivery status of a queued stage change email"""
+    record = await asyncio.to_thread(stage_email_store.get, message_id)
+    if not record:
+        raise HTTPException(status_code=404, detail="Email not found")
+    
+    return {
+        "message_id": message_id,
+        "status": record["status"],
+        "resend_id": record["resend_id"],
+        "attempts": record["attempts"],
+        "error": record["error"],
+        "queued_at": datetime.fromtimestamp(record["created_at"]).isoformat(),
+        "updated_at": datetime.fromtimestamp(record["updated_at"]).isoformat(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+# ----- HANDLE GO HIGH LEVEL PIPELINE STAGE CHANGE EMAIL ENDPOINT -----
+
+@app.post("/webhook/opportunity-stage-change")
+async def handle_opportunity_stage_change(request: Request):
+    """Handle GoHighLevel opportunity stage change webhook (retries replay the first response)"""
+    body = await request.body()
+    key, ttl, fingerprint = get_idempotency_key(request, body.decode("utf-8", errors="replace"))
+    return await idempotency_cache.run(key, ttl, lambda: process_opportunity_stage_change(request), fingerprint)
+
+async def process_opportunity_stage_change(request: Request):
+    """Validate a GoHighLevel opportunity stage change webhook and send its email"""
+    try:
+        payload = await request.json()
+        
+        # Extract email data from customData
+        custom_data = payload.get('customData', {})
+        to_email = custom_data.get('to_email')
+        subject = custom_data.get('subject') 
+        html_content = custom_data.get('html_content')
+        api_key = custom_data.get('api_key')
+        
+        # Validate required fields
+        if not all([to_email, subject, html_content, api_key]):
+            missing = [k for k, v in {
+                'to_email': to_email, 'subject': subject, 
+                'html_content': html_content, 'api_key': api_key
+            }.items() if not v]
+            raise HTTPException(status_code=400, detail=f"Missing required fields in customData: {missing}")
+        
+        # Validate API key (security check)
+        if api_key != GHL_WEBHOOK_API_KEY:
+            print(f"Invalid API key in webhook: {api_key}")
+            raise HTTPException(status_code=401, detail="Invalid API key")
+        
+        if STAGE_EMAIL_BATCHING_ENABLED:
+            # Acknowledge right away; the email goes out with the next Resend batch
+            message_id = uuid.uuid4().hex
+            email = {"to_email": to_email, "subject": subject, "html_content": html_content}
+            try:
+                await asyncio.to_thread(stage_email_store.create, message_id, email)
+            except Exception as e:
+                print(f"STAGE EMAIL: could not persist email ({e}) - sending synchronously")
+            else:
+                stage_email_batcher.enqueue(message_id, email)
+                print(f"STAGE EMAIL {message_id}: queued opportunity stage change email to {to_email}")
+                return JSONResponse(
+                    status_code=202,
+                    content={
+                        "status": "accepted",
+                        "message": "Email queued for delivery",
+                        "email_queued": True,
+                        "message_id": message_id,
+                        "status_url": f"/email-status/{message_id}",
+                        "timestamp": datetime.now().isoformat()
+                    }
+                )
+        
+        print(f"Sending opportunity stage change email to: {to_email}")
+        print(f"Subject: {subject}")
         
         # Send email using existing Resend function
         email_result = await send_email_via_resend(
@@ -827,219 +4021,703 @@ async def handle_opportunity_stage_change(request: Request):
         await send_error_alert(error_msg, "/webhook/opportunity-stage-change")
         raise HTTPException(status_code=500, detail="Internal server error")
 
-# ----- CONSOLIDATED LEAD SUBMISSION ENDPOINT -----
-
-@app.post("/submit-lead")
-async def submit_lead(
-    request: Request,
-    source: str = Form(...),  # "form" or "chatbot"
-    name: str = Form(...),
-    email: str = Form(...),
-    phone: Optional[str] = Form(None),
-    # Unified case description field for both form and chatbot
-    about_case: Optional[str] = Form(None),  # Now used by both form and chatbot
-    # Chatbot-specific fields (kept for backward compatibility)
-    case_type: Optional[str] = Form(None),  # Chatbot case type
-    case_state: Optional[str] = Form(None),  # Chatbot case state/location
-    # Optional fields
-    is_referral: bool = Form(False)
+def validate_lead_fields(
+    source: str,
+    email: Optional[str],
+    about_case: Optional[str],
+    case_type: Optional[str],
+    case_state: Optional[str],
+    request_data: dict
 ):
+    """Detailed lead validation - raises HTTPException(400) on the first problem"""
+    # Email is only required for form submissions
+    if source == "form" and not email:
+        print(f"VALIDATION ERROR: Email missing for form submission. Request data: {request_data}")
+        raise HTTPException(status_code=400, detail="Email is required for form submissions")
+    
+    # about_case is now required for both sources
+    if not about_case:
+        print(f"VALIDATION ERROR: Case description missing. Request data: {request_data}")
+        raise HTTPException(status_code=400, detail="Case description is required for all submissions")
+    
+    # Chatbot-specific validation (still need case_type and case_state for chatbot)
+    if source == "chatbot" and (not case_type or not case_state):
+        print(f"VALIDATION ERROR: Missing chatbot fields. case_type='{case_type}', case_state='{case_state}'. Request data: {request_data}")
+        raise HTTPException(status_code=400, detail="case_type and case_state are required for chatbot submissions")
+
+# ----- SUBMISSION ARCHIVE -----
+
+class SubmissionArchive(SQLiteStore):
     """
-    Consolidated endpoint that handles both form and chatbot lead submissions.
-    Now includes intelligent duplicate detection to prevent multiple notifications
-    for the same lead within a 10-minute window.
+    SQLite archive of every lead submission with its verdict, dedupe hash,
+    stage timings and upstream outcomes. Indexed on time, normalized phone,
+    normalized email and verdict so audits are plain indexed queries.
     """
-    client_ip = request.client.host
     
-    if not check_rate_limit(client_ip):
-        raise HTTPException(status_code=429, detail="Rate limit exceeded")
+    COLUMNS = (
+        "id", "submitted_at", "source", "name", "email", "phone", "about_case", "case_type",
+        "case_state", "is_referral", "verdict", "submission_hash", "status_code", "email_sent",
+        "sms_sent", "email_deferred", "sms_deferred", "webhook_success", "webhook_status",
+        "error", "total_ms", "timings"
+    )
     
-    try:
-        print(f"Received {source} submission from {name} ({email})")
-        if is_debug_mode():
-            print(f"DEBUG MODE ACTIVE: {DEBUG_MODE}")
-        
-        # BASIC validation first (only the absolute minimum to prevent crashes)
-        if not name or source not in ["form", "chatbot"]:
-            raise HTTPException(status_code=400, detail="Missing required fields: name and valid source are required")
-        
-        # SPAM DETECTION FIRST - before detailed validation
-        # This prevents spam from causing validation errors in logs
-        if source == "form":
-            # For spam detection, treat missing fields as empty strings to avoid crashes
-            spam_name = name or ""
-            spam_phone = phone or ""
-            spam_email = email or ""
-            spam_case = about_case or ""
-            
-            is_spam = await check_for_spam(spam_name, spam_phone, spam_email, spam_case)
-            
-            if is_spam:
-                print(f"SPAM DETECTED: Form submission from {name} ({email}) - rejected silently")
-                # Return fake success to avoid giving spammers feedback about detection
-                # ============ NEW: LOG SPAM TO GOOGLE SHEETS ============ 
-                # Log spam leads for auditing purposes
-                print(f"SPAM AUDIT: Logging spam submission to Google Sheets for {name} ({email})")
-                
-                # Log to Google Sheets asynchronously (won't block main flow)
-                # Log to Google Sheets asynchronously (won't block main flow)
-                asyncio.create_task(log_to_google_sheets(
-                    name=name,
-                    email=email or "",
-                    phone=phone or "",
-                    case_description=about_case,  # Remove the [SPAM DETECTED] prefix
-                    source=source
-                ))
-                
-                # ============ END SPAM LOGGING ============
-                return {
-                    "status": "success",  # Lie to the spammer
-                    "message": "Form submitted successfully",
-                    "timestamp": datetime.now().isoformat()
-                }
-                
-            
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS submissions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            submitted_at REAL NOT NULL,
+            source TEXT NOT NULL,
+            name TEXT,
+            email TEXT,
+            email_normalized TEXT,
+            phone TEXT,
+            phone_normalized TEXT,
+            about_case TEXT,
+            case_type TEXT,
+            case_state TEXT,
+            is_referral INTEGER,
+            verdict TEXT NOT NULL,
+            submission_hash TEXT,
+            status_code INTEGER,
+            email_sent INTEGER,
+            sms_sent INTEGER,
+            email_deferred INTEGER,
+            sms_deferred INTEGER,
+            webhook_success INTEGER,
+            webhook_status INTEGER,
+            error TEXT,
+            total_ms REAL,
+            timings TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_submissions_time ON submissions (submitted_at)",
+        "CREATE INDEX IF NOT EXISTS idx_submissions_phone ON submissions (phone_normalized, submitted_at)",
+        "CREATE INDEX IF NOT EXISTS idx_submissions_email ON submissions (email_normalized, submitted_at)",
+        "CREATE INDEX IF NOT EXISTS idx_submissions_verdict ON submissions (verdict, submitted_at)"
+    )
+    
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.records_written = 0
+        self.write_errors = 0
+    
+    def record(self, entry: dict):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                """INSERT INTO submissions (
+                       submitted_at, source, name, email, email_normalized, phone, phone_normalized,
+                       about_case, case_type, case_state, is_referral, verdict, submission_hash,
+                       status_code, email_sent, sms_sent, email_deferred, sms_deferred,
+                       webhook_success, webhook_status, error, total_ms, timings
+                   ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    entry["submitted_at"], entry["source"], entry["name"], entry["email"],
+                    normalize_email(entry["email"] or ""), entry["phone"], normalize_phone(entry["phone"] or ""),
+                    entry["about_case"], entry["case_type"], entry["case_state"], entry["is_referral"],
+                    entry["verdict"], entry.get("submission_hash"), entry.get("status_code"),
+                    entry.get("email_sent"), entry.get("sms_sent"), entry.get("email_deferred"),
+                    entry.get("sms_deferred"), entry.get("webhook_success"), entry.get("webhook_status"),
+                    entry.get("error"), entry.get("total_ms"), json.dumps(entry.get("timings") or {})
+                )
+            )
+            conn.commit()
+        self.records_written += 1
+    
+    def query(
+        self,
+        verdict: Optional[str] = None,
+        source: Optional[str] = None,
+        email: Optional[str] = None,
+        phone: Optional[str] = None,
+        submission_hash: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        before_id: Optional[int] = None,
+        limit: int = 50
+    ) -> List[dict]:
+        """Newest first; pass the last row's id as before_id for the next page"""
+        clauses, params = [], []
+        for column, value in (
+            ("verdict", verdict),
+            ("source", source),
+            ("email_normalized", normalize_email(email) if email else None),
+            ("phone_normalized", normalize_phone(phone) if phone else None),
+            ("submission_hash", submission_hash)
+        ):
+            if value:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            clauses.append("submitted_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("submitted_at < ?")
+            params.append(until)
+        if before_id is not None:
+            clauses.append("id < ?")
+            params.append(before_id)
         
-        # DETAILED VALIDATION ONLY AFTER spam filtering
-        # Now we know it's legitimate, so validation errors represent real issues
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM submissions {where} ORDER BY id DESC LIMIT ?",
+                (*params, limit)
+            ).fetchall()
         
-        # Log the complete request data for debugging legitimate submissions
-        request_data = {
-            "source": source,
-            "name": name,
-            "email": email,
-            "phone": phone,
-            "about_case": about_case,
-            "case_type": case_type,
-            "case_state": case_state,
-            "is_referral": is_referral
+        results = []
+        for row in rows:
+            item = dict(zip(self.COLUMNS, row))
+            item["submitted_at"] = datetime.fromtimestamp(item["submitted_at"]).isoformat()
+            item["timings"] = json.loads(item["timings"]) if item["timings"] else {}
+            for flag in ("is_referral", "email_sent", "sms_sent", "email_deferred", "sms_deferred", "webhook_success"):
+                if item[flag] is not None:
+                    item[flag] = bool(item[flag])
+            results.append(item)
+        return results
+    
+    def purge(self, older_than: float) -> int:
+        with self._lock:
+            conn = self._connect()
+            cursor = conn.execute("DELETE FROM submissions WHERE submitted_at < ?", (older_than,))
+            conn.commit()
+            return cursor.rowcount
+    
+    def stats(self) -> dict:
+        return {
+            "enabled": True,
+            "records_written": self.records_written,
+            "write_errors": self.write_errors
         }
-        print(f"Processing legitimate {source} submission with data: {request_data}")
-        
-        # Email is only required for form submissions
-        if source == "form" and not email:
-            print(f"VALIDATION ERROR: Email missing for form submission. Request data: {request_data}")
-            raise HTTPException(status_code=400, detail="Email is required for form submissions")
-        
-        # about_case is now required for both sources
-        if not about_case:
-            print(f"VALIDATION ERROR: Case description missing. Request data: {request_data}")
-            raise HTTPException(status_code=400, detail="Case description is required for all submissions")
-        
-        # Chatbot-specific validation (still need case_type and case_state for chatbot)
-        if source == "chatbot" and (not case_type or not case_state):
-            print(f"VALIDATION ERROR: Missing chatbot fields. case_type='{case_type}', case_state='{case_state}'. Request data: {request_data}")
-            raise HTTPException(status_code=400, detail="case_type and case_state are required for chatbot submissions")
-        
-        # ============ NEW: DUPLICATE DETECTION CHECK ============
-        # Check if this is a duplicate submission before processing
-        is_duplicate = is_duplicate_submission(
-            name=name,
-            phone=phone or "",
-            email=email or "",
-            about_case=about_case,
-            source=source
+
+submission_archive = SubmissionArchive(SUBMISSION_ARCHIVE_PATH) if SUBMISSION_ARCHIVE_ENABLED else None
+
+class LeadAnalytics(SQLiteStore):
+    """
+    Rolling lead counters in fixed time buckets, kept next to the archive.
+    Each finished submission bumps a handful of (bucket, metric, label)
+    counters in memory - O(1) per submission, never dropped under load - and
+    flush() adds them to SQLite with one UPSERT batch, so the counters are
+    shared by every worker and kept across restarts. Reads sum at most
+    window / bucket rows per counter.
+    """
+    
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS lead_counters (
+            bucket_start INTEGER NOT NULL,
+            metric TEXT NOT NULL,
+            label TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (bucket_start, metric, label)
         )
+        """,
+    )
+    
+    def __init__(self, path: str, bucket_seconds: int):
+        super().__init__(path)
+        self.bucket_seconds = bucket_seconds
+        self._pending = defaultdict(int)  # (bucket_start, metric, label) -> count not yet written
+        self._pending_lock = threading.Lock()
+        self.flush_errors = 0
+    
+    def record(self, at: float, increments: List[tuple]):
+        """Bump counters in memory - safe to call on the event loop"""
+        bucket_start = int(at // self.bucket_seconds) * self.bucket_seconds
+        with self._pending_lock:
+            for metric, label in increments:
+                self._pending[(bucket_start, metric, label)] += 1
+    
+    def flush(self) -> int:
+        """Add the in-memory counts to SQLite. Blocking - run it in a worker thread."""
+        with self._pending_lock:
+            pending, self._pending = self._pending, defaultdict(int)
+        if not pending:
+            return 0
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.executemany(
+                    """INSERT INTO lead_counters (bucket_start, metric, label, count) VALUES (?, ?, ?, ?)
+                       ON CONFLICT (bucket_start, metric, label) DO UPDATE SET count = count + excluded.count""",
+                    [(bucket_start, metric, label, count) for (bucket_start, metric, label), count in pending.items()]
+                )
+                conn.commit()
+        except Exception:
+            # Keep the counts for the next flush
+            self.flush_errors += 1
+            with self._pending_lock:
+                for counter, count in pending.items():
+                    self._pending[counter] += count
+            raise
+        return len(pending)
+    
+    def totals(self, since: float) -> Dict[str, Dict[str, int]]:
+        """{metric: {label: count}} summed over every bucket since the given time"""
+        self.flush()  # include this worker's latest counts
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT metric, label, SUM(count) FROM lead_counters WHERE bucket_start >= ? GROUP BY metric, label",
+                (int(since // self.bucket_seconds) * self.bucket_seconds,)
+            ).fetchall()
+        totals = defaultdict(dict)
+        for metric, label, count in rows:
+            totals[metric][label] = count
+        return totals
+    
+    def series(self, since: float, metric: str, step_seconds: int) -> Dict[int, Dict[str, int]]:
+        """{step_start: {label: count}} for one metric, in step_seconds steps"""
+        self.flush()
+        with self._lock:
+            rows = self._connect().execute(
+                """SELECT (bucket_start / ?) * ?, label, SUM(count) FROM lead_counters
+                   WHERE metric = ? AND bucket_start >= ? GROUP BY 1, label""",
+                (step_seconds, step_seconds, metric, int(since // self.bucket_seconds) * self.bucket_seconds)
+            ).fetchall()
+        series = defaultdict(dict)
+        for step_start, label, count in rows:
+            series[step_start][label] = count
+        return series
+    
+    def purge(self, older_than: float) -> int:
+        with self._lock:
+            conn = self._connect()
+            cursor = conn.execute("DELETE FROM lead_counters WHERE bucket_start < ?", (older_than,))
+            conn.commit()
+            return cursor.rowcount
+
+lead_analytics = LeadAnalytics(SUBMISSION_ARCHIVE_PATH, ANALYTICS_BUCKET_SECONDS) if LEAD_ANALYTICS_ENABLED else None
+
+def analytics_label(value: Optional[str]) -> str:
+    """Free-text chatbot answers become a bounded, case-insensitive label"""
+    return (value or "").strip().lower()[:64] or "unknown"
+
+def analytics_increments(entry: dict) -> List[tuple]:
+    """The (metric, label) counters one finished submission bumps"""
+    if entry["source"] not in ("form", "chatbot"):
+        # Turned away by the basic checks - not a lead, so kept out of the submission totals
+        return [("early_rejection", "invalid_request")]
+    increments = [
+        ("submissions", entry["source"]),
+        ("verdict", f"{entry['source']}:{entry['verdict']}")
+    ]
+    if entry["source"] == "chatbot":
+        increments.append(("case_type", analytics_label(entry["case_type"])))
+        increments.append(("case_state", analytics_label(entry["case_state"])))
+    if entry["verdict"] == "spam":
+        increments.append(("spam_detection", entry.get("spam_detected_by") or "llm"))
+    if entry.get("webhook_success") is not None:
+        increments.append(("webhook", "success" if entry["webhook_success"] else "failure"))
+    return increments
+
+@contextmanager
+def timed_stage(trace: dict, stage: str):
+    """Record how long a pipeline stage took in trace["timings_ms"]"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.setdefault("timings_ms", {})[stage] = round((time.perf_counter() - started) * 1000, 1)
+
+async def write_archive_entry(entry: dict):
+    try:
+        await asyncio.to_thread(submission_archive.record, entry)
+    except Exception as e:
+        submission_archive.write_errors += 1
+        print(f"SUBMISSION ARCHIVE: could not record submission: {e}")
+
+def archive_submission(lead: dict, trace: dict, started: float, result: Optional[dict] = None, error: Optional[HTTPException] = None):
+    """Bump the analytics counters and queue the archive row for a finished pipeline run (written off the request path)"""
+    if submission_archive is None and lead_analytics is None:
+        return
+    
+    outcome = result if result is not None else (error.detail if error is not None and isinstance(error.detail, dict) else {})
+    webhook_response = outcome.get("webhook_response") or (outcome.get("webhook_error") or {}).get("response") or {}
+    if trace.get("verdict"):
+        verdict = trace["verdict"]
+    elif error is None:
+        verdict = "accepted"
+    else:
+        verdict = "rejected" if error.status_code < 500 and "webhook_error" not in outcome else "failed"
+    
+    if error is None:
+        error_message = None
+    elif isinstance(error.detail, dict):
+        error_message = error.detail.get("message")
+    else:
+        error_message = str(error.detail)
+    
+    if "webhook_success" in outcome:
+        webhook_success = outcome["webhook_success"]
+    elif "webhook_error" in outcome:
+        webhook_success = False
+    else:
+        webhook_success = True if "webhook_response" in outcome else None
+    
+    entry = {
+        **lead,
+        "submitted_at": request_received_at.get() or time.time(),
+        "verdict": verdict,
+        "submission_hash": trace.get("submission_hash"),
+        "status_code": error.status_code if error is not None else 200,
+        "email_sent": outcome.get("email_sent"),
+        "sms_sent": outcome.get("sms_sent"),
+        "email_deferred": outcome.get("email_deferred"),
+        "sms_deferred": outcome.get("sms_deferred"),
+        "webhook_success": webhook_success,
+        "webhook_status": webhook_response.get("status_code") if isinstance(webhook_response, dict) else None,
+        "error": error_message,
+        "total_ms": round((time.perf_counter() - started) * 1000, 1),
+        "timings": trace.get("timings_ms"),
+        "spam_detected_by": trace.get("spam_detected_by")
+    }
+    if lead_analytics is not None:
+        # In memory, so a full archive_write queue never loses counts
+        lead_analytics.record(entry["submitted_at"], analytics_increments(entry))
+    if submission_archive is not None:
+        background_tasks.spawn("archive_write", write_archive_entry(entry))
+
+def archive_rejected_submission(status_code: int, detail: str, lead: dict):
+    """
+    Archive a /submit-lead request whose form was parsed but failed the basic
+    checks before the pipeline ran. Admission-control rejections are only
+    counted (lead_admission_rejections), not archived.
+    """
+    archive_submission(lead, {}, time.perf_counter(), error=HTTPException(status_code=status_code, detail=detail))
+
+async def process_lead_submission(
+    source: str,
+    name: str,
+    email: str,
+    phone: Optional[str],
+    about_case: Optional[str],
+    case_type: Optional[str],
+    case_state: Optional[str],
+    is_referral: bool
+) -> dict:
+    """
+    Run the lead pipeline and archive the submission with its verdict and
+    outcomes. Shared by the synchronous /submit-lead path and the background
+    pipeline for async acceptance.
+    """
+    lead = {
+        "source": source,
+        "name": name,
+        "email": email,
+        "phone": phone,
+        "about_case": about_case,
+        "case_type": case_type,
+        "case_state": case_state,
+        "is_referral": is_referral
+    }
+    trace = {}
+    started = time.perf_counter()
+    try:
+        result = await run_lead_stages(trace, **lead)
+    except HTTPException as e:
+        archive_submission(lead, trace, started, error=e)
+        raise
+    except Exception as e:
+        archive_submission(lead, trace, started, error=HTTPException(status_code=500, detail=str(e)))
+        raise
+    archive_submission(lead, trace, started, result=result)
+    return result
+
+def require_admin_key(request: Request):
+    """Reject /admin/* requests without the configured X-Admin-Key"""
+    if not ADMIN_API_KEY:
+        raise HTTPException(status_code=503, detail="Admin API not configured")
+    provided = request.headers.get("x-admin-key", "")
+    if not secrets.compare_digest(provided.encode("utf-8"), ADMIN_API_KEY.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid admin key")
+
+def parse_query_time(value: Optional[str], name: str) -> Optional[float]:
+    """Accept an ISO 8601 datetime or a unix timestamp"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}: use ISO 8601 or a unix timestamp")
+
+@app.get("/admin/submissions")
+async def query_submissions(
+    request: Request,
+    verdict: Optional[str] = None,
+    source: Optional[str] = None,
+    email: Optional[str] = None,
+    phone: Optional[str] = None,
+    submission_hash: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    cursor: Optional[int] = None,
+    limit: int = 50
+):
+    """
+    Query the submission archive (newest first). Filters combine with AND;
+    follow next_cursor for the next page.
+    """
+    require_admin_key(request)
+    if submission_archive is None:
+        raise HTTPException(status_code=503, detail="Submission archive disabled")
+    
+    limit = max(1, min(limit, 500))
+    started = time.perf_counter()
+    rows = await asyncio.to_thread(
+        submission_archive.query,
+        verdict=verdict,
+        source=source,
+        email=email,
+        phone=phone,
+        submission_hash=submission_hash,
+        since=parse_query_time(since, "since"),
+        until=parse_query_time(until, "until"),
+        before_id=cursor,
+        limit=limit
+    )
+    
+    return {
+        "status": "success",
+        "count": len(rows),
+        "submissions": rows,
+        "next_cursor": rows[-1]["id"] if len(rows) == limit else None,
+        "query_ms": round((time.perf_counter() - started) * 1000, 1),
+        "timestamp": datetime.now().isoformat()
+    }
+
+def parse_duration(value: str, name: str) -> int:
+    """Parse "90s", "15m", "24h", "7d" or plain seconds"""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    match = re.fullmatch(r"\s*(\d+)\s*([smhd]?)\s*", value or "")
+    if not match or int(match.group(1)) <= 0:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}: use e.g. 15m, 24h or 7d")
+    return int(match.group(1)) * units[match.group(2) or "s"]
+
+def safe_rate(numerator: int, denominator: int) -> Optional[float]:
+    return round(numerator / denominator, 4) if denominator else None
+
+@app.get("/admin/analytics")
+async def lead_analytics_summary(request: Request, window: str = "24h", step: str = "1h"):
+    """
+    Lead volume by source, spam / duplicate / webhook failure rates and
+    case type / state breakdowns over a rolling window, plus a per-step
+    series of leads by source. Requests turned away before the pipeline
+    (rate limited, shed, oversized, invalid) are reported separately under
+    early_rejections and are not counted as submissions.
+    """
+    require_admin_key(request)
+    if lead_analytics is None:
+        raise HTTPException(status_code=503, detail="Lead analytics disabled")
+    
+    window_seconds = parse_duration(window, "window")
+    step_seconds = max(ANALYTICS_BUCKET_SECONDS, parse_duration(step, "step") // ANALYTICS_BUCKET_SECONDS * ANALYTICS_BUCKET_SECONDS)
+    if window_seconds > ANALYTICS_RETENTION_DAYS * 86400:
+        raise HTTPException(status_code=400, detail=f"window exceeds the {ANALYTICS_RETENTION_DAYS} day retention")
+    if window_seconds // step_seconds > 2000:
+        raise HTTPException(status_code=400, detail="Too many steps for this window - use a larger step")
+    
+    since = time.time() - window_seconds
+    started = time.perf_counter()
+    totals = await asyncio.to_thread(lead_analytics.totals, since)
+    series = await asyncio.to_thread(lead_analytics.series, since, "submissions", step_seconds)
+    
+    submissions = totals.get("submissions", {})
+    verdicts = totals.get("verdict", {})
+    by_source = {}
+    for source in ("form", "chatbot"):
+        total = submissions.get(source, 0)
+        spam = verdicts.get(f"{source}:spam", 0)
+        duplicates = verdicts.get(f"{source}:duplicate", 0)
+        by_source[source] = {
+            "submissions": total,
+            "leads_per_hour": round(total * 3600 / window_seconds, 2),
+            "accepted": verdicts.get(f"{source}:accepted", 0),
+            "spam": spam,
+            "duplicates": duplicates,
+            "rejected": verdicts.get(f"{source}:rejected", 0),
+            "failed": verdicts.get(f"{source}:failed", 0),
+            "spam_rate": safe_rate(spam, total),
+            "duplicate_rate": safe_rate(duplicates, total - spam)
+        }
+    
+    total_submissions = sum(summary["submissions"] for summary in by_source.values())
+    total_spam = sum(count for label, count in verdicts.items() if label.endswith(":spam"))
+    total_duplicates = sum(count for label, count in verdicts.items() if label.endswith(":duplicate"))
+    webhook = totals.get("webhook", {})
+    webhook_attempts = webhook.get("success", 0) + webhook.get("failure", 0)
+    
+    return {
+        "status": "success",
+        "window_seconds": window_seconds,
+        "step_seconds": step_seconds,
+        "submissions": total_submissions,
+        "leads_per_hour": round(total_submissions * 3600 / window_seconds, 2),
+        "spam_rate": safe_rate(total_spam, total_submissions),
+        "duplicate_rate": safe_rate(total_duplicates, total_submissions - total_spam),
+        "spam_detected_by": totals.get("spam_detection", {}),
+        "webhook_failure_rate": safe_rate(webhook.get("failure", 0), webhook_attempts),
+        "early_rejections": totals.get("early_rejection", {}),
+        "by_source": by_source,
+        "case_types": dict(sorted(totals.get("case_type", {}).items(), key=lambda item: -item[1])),
+        "case_states": dict(sorted(totals.get("case_state", {}).items(), key=lambda item: -item[1])),
+        "series": [
+            {"start": datetime.fromtimestamp(step_start).isoformat(), **{label: count for label, count in counts.items() if label in by_source}}
+            for step_start, counts in sorted(series.items())
+        ],
+        "query_ms": round((time.perf_counter() - started) * 1000, 1),
+        "timestamp": datetime.now().isoformat()
+    }
+
+def purge_submission_archive() -> Optional[str]:
+    """Drop archived submissions past their retention period"""
+    purged = submission_archive.purge(time.time() - SUBMISSION_ARCHIVE_RETENTION_DAYS * 86400)
+    if purged:
+        return f"purged {purged} archived submissions older than {SUBMISSION_ARCHIVE_RETENTION_DAYS} days"
+
+def purge_lead_analytics() -> Optional[str]:
+    purged = lead_analytics.purge(time.time() - ANALYTICS_RETENTION_DAYS * 86400)
+    if purged:
+        return f"purged {purged} analytics buckets older than {ANALYTICS_RETENTION_DAYS} days"
+
+if submission_archive is not None:
+    maintenance.register("submission_archive_purge", RETENTION_PURGE_INTERVAL, purge_submission_archive, blocking=True, run_at_start=True)
+def flush_lead_analytics():
+    lead_analytics.flush()
+
+async def flush_lead_analytics_on_shutdown():
+    try:
+        await asyncio.to_thread(lead_analytics.flush)
+    except Exception as e:
+        print(f"LEAD ANALYTICS: could not write counters on shutdown: {e}")
+
+if lead_analytics is not None:
+    maintenance.register("lead_analytics_purge", RETENTION_PURGE_INTERVAL, purge_lead_analytics, blocking=True, run_at_start=True)
+    maintenance.register("lead_analytics_flush", ANALYTICS_FLUSH_INTERVAL, flush_lead_analytics, blocking=True)
+    # Shutdown hooks run in reverse - go first in the list so this runs after the background tasks drained
+    app_shutdown_hooks.insert(0, flush_lead_analytics_on_shutdown)
+
+async def run_lead_stages(
+    trace: dict,
+    source: str,
+    name: str,
+    email: str,
+    phone: Optional[str],
+    about_case: Optional[str],
+    case_type: Optional[str],
+    case_state: Optional[str],
+    is_referral: bool
+) -> dict:
+    """
+    Full lead pipeline: spam detection, validation, duplicate detection,
+    email + SMS notifications and the webhook. Returns the response body for
+    the submitter, or raises HTTPException. Verdict, dedupe hash and stage
+    timings are noted in trace for the submission archive.
+    """
+    # SPAM DETECTION FIRST - before detailed validation
+    # This prevents spam from causing validation errors in logs
+    if source == "form":
+        # For spam detection, treat missing fields as empty strings to avoid crashes
+        spam_name = name or ""
+        spam_phone = phone or ""
+        spam_email = email or ""
+        spam_case = about_case or ""
         
-        if is_duplicate:
-            log_duplicate_details(name, phone or "", email or "", about_case, source)
-            
-            # Still send to webhook (GoHighLevel handles duplicates)
-            # but skip email and SMS notifications
-            print(f"DUPLICATE SUBMISSION: Processing webhook but skipping notifications for {name} ({email})")
-            
-            # Prepare unified webhook data
-            webhook_data = {
-                'source': source,
-                'name': name,
-                'phone': phone or "",
-                'email': email,
-                'about_case': about_case,
-                'case_type': case_type or "",
-                'case_state': case_state or "",
-                'is_referral': str(is_referral).lower(),
-                'timestamp': datetime.now().isoformat(),
-                'duplicate_detected': True  # Flag for webhook/GHL
-            }
+        # Repeat offenders are rejected from the learned blocklist without an LLM call
+        with timed_stage(trace, "blocklist"):
+            blocklist_match = await check_spam_blocklist(spam_phone, spam_email, spam_case)
+        
+        if blocklist_match:
+            trace["blocklist_match"] = blocklist_match
+            trace["spam_detected_by"] = "blocklist"
+            is_spam = True
+            print(f"SPAM BLOCKLIST: {name} ({email}) matches denied {blocklist_match['kind']} {blocklist_match['value']}")
+        else:
+            # Obviously fake contact details are rejected locally as well
+            contact_check = contact_validator.validate(spam_name, spam_phone, spam_email) if contact_validator is not None else None
+            if contact_check is not None and (contact_check["signals"] or contact_check["parse_issues"]):
+                trace["contact_validation"] = contact_check
             
-            # Add debug flag if in debug mode
-            if is_debug_mode():
-                webhook_data['debug_mode'] = True
-                webhook_data['debug_level'] = DEBUG_MODE
+            if contact_check is not None and contact_check["reject"]:
+                contact_validator.rejected += 1
+                trace["spam_detected_by"] = "contact_validation"
+                is_spam = True
+                print(f"CONTACT VALIDATION: {name} ({email}) scored {contact_check['score']} ({', '.join(contact_check['signals'])})")
+            else:
+                # Weaker contact signals are left to the LLM, which sees them alongside the case text
+                with timed_stage(trace, "spam_check"):
+                    is_spam = await check_for_spam(
+                        spam_name, spam_phone, spam_email, spam_case, ContactValidator.describe(contact_check)
+                    )
+                if is_spam:
+                    trace["spam_detected_by"] = "llm"
+                    await learn_spam_submission(spam_phone, spam_email, spam_case)
+        
+        if is_spam:
+            trace["verdict"] = "spam"
+            print(f"SPAM DETECTED: Form submission from {name} ({email}) - rejected silently")
+            # Return fake success to avoid giving spammers feedback about detection
+            # ============ NEW: LOG SPAM TO GOOGLE SHEETS ============ 
+            # Log spam leads for auditing purposes
+            print(f"SPAM AUDIT: Logging spam submission to Google Sheets for {name} ({email})")
             
-            # Send to webhook only (skip notifications)
-            webhook_result = await send_to_webhook(webhook_data)
+            # Log to Google Sheets asynchronously (won't block main flow)
+            background_tasks.spawn("sheets_log", log_to_google_sheets(
+                name=name,
+                email=email or "",
+                phone=phone or "",
+                case_description=about_case,  # Remove the [SPAM DETECTED] prefix
+                source=source
+            ))
             
-            # Return success response indicating duplicate was handled
+            # ============ END SPAM LOGGING ============
             return {
-                "status": "success",
-                "message": f"Duplicate {source} submission processed (notifications skipped)",
-                "duplicate_detected": True,
-                "email_sent": False,
-                "sms_sent": False,
-                "webhook_response": webhook_result.get('response', {}),
-                "webhook_success": webhook_result.get('success', False),
-                "debug_mode": is_debug_mode(),
-                "debug_level": DEBUG_MODE if is_debug_mode() else None,
-                "webhook_skipped": should_skip_webhook(),
+                "status": "success",  # Lie to the spammer
+                "message": "Form submitted successfully",
                 "timestamp": datetime.now().isoformat()
             }
-        
-        # ============ END DUPLICATE DETECTION CHECK ============
-        
-        # Continue with normal processing for non-duplicate submissions
-        print(f"NEW SUBMISSION: Processing notifications for {name} ({email})")
-        
-        # Get the appropriate notification email based on debug mode
-        notification_email = get_notification_email()
-        
-        # Prepare email content based on source
-        if source == "form":
-            subject = "New Lead Form Filled Out"
-            case_info_for_sms = f"Case: {about_case[:50]}..." if len(about_case) > 50 else about_case
-            
-            html_content = get_form_email_template(
-                lead_name=name,
-                lead_phone=phone or "Not provided",
-                lead_email=email,
-                lead_case_description=about_case
-            )
-            
-        else:  # chatbot
-            subject = "New Lead Alert"
-            case_info_for_sms = f"{case_type} case in {case_state}: {about_case[:30]}..." if len(about_case) > 30 else f"{case_type} case in {case_state}: {about_case}"
             
-            html_content = get_chatbot_email_template(
-                lead_name=name,
-                lead_phone=phone or "Not provided", 
-                lead_case_type=case_type,
-                lead_case_state=case_state,
-                case_description=about_case
-            )
-        
-        # Send email notification to the firm (or debug email)
-        if not notification_email:
-            missing_var = "DEBUG_EMAIL" if is_debug_mode() else "FIRM_NOTIFICATION_EMAIL"
-            raise HTTPException(status_code=500, detail=f"{missing_var} environment variable not configured")
         
-        email_result = await send_email_via_resend(
-            to_email=notification_email,
-            subject=subject,
-            html_content=html_content
-        )
+    
+    # DETAILED VALIDATION ONLY AFTER spam filtering
+    # Now we know it's legitimate, so validation errors represent real issues
+    
+    # Log the complete request data for debugging legitimate submissions
+    request_data = {
+        "source": source,
+        "name": name,
+        "email": email,
+        "phone": phone,
+        "about_case": about_case,
+        "case_type": case_type,
+        "case_state": case_state,
+        "is_referral": is_referral
+    }
+    print(f"Processing legitimate {source} submission with data: {request_data}")
+    
+    validate_lead_fields(source, email, about_case, case_type, case_state, request_data)
+    trace["submission_hash"] = generate_submission_hash(name, phone or "", email or "", about_case, source)
+    
+    # ============ NEW: DUPLICATE DETECTION CHECK ============
+    # Check if this is a duplicate submission before processing
+    is_duplicate = is_duplicate_submission(
+        name=name,
+        phone=phone or "",
+        email=email or "",
+        about_case=about_case,
+        source=source
+    )
+    
+    if is_duplicate:
+        trace["verdict"] = "duplicate"
+        log_duplicate_details(name, phone or "", email or "", about_case, source)
         
-        if not email_result['success']:
-            print(f"Email send failed: {email_result.get('error', 'Unknown error')}")
-            await send_error_alert(f"Email send failed: {email_result.get('error', 'Unknown error')}", "/submit-lead")
-        
-        # Send SMS notification (to appropriate phone number based on debug mode)
-        sms_success = await send_sms_notification(
-            phone_number=phone or "No phone provided",
-            user_name=name,
-            source=source,
-            case_info=case_info_for_sms,
-            is_referral=is_referral
-        )
+        # Still send to webhook (GoHighLevel handles duplicates)
+        # but skip email and SMS notifications
+        print(f"DUPLICATE SUBMISSION: Processing webhook but skipping notifications for {name} ({email})")
         
         # Prepare unified webhook data
         webhook_data = {
@@ -1052,7 +4730,7 @@ async def submit_lead(
             'case_state': case_state or "",
             'is_referral': str(is_referral).lower(),
             'timestamp': datetime.now().isoformat(),
-            'duplicate_detected': False  # Flag for webhook/GHL
+            'duplicate_detected': True  # Flag for webhook/GHL
         }
         
         # Add debug flag if in debug mode
@@ -1060,45 +4738,508 @@ async def submit_lead(
             webhook_data['debug_mode'] = True
             webhook_data['debug_level'] = DEBUG_MODE
         
-        # Send to webhook
+        # Send to webhook only (skip notifications)
+        with timed_stage(trace, "webhook"):
+            webhook_result = await send_to_webhook(webhook_data)
+        
+        # Return success response indicating duplicate was handled
+        return {
+            "status": "success",
+            "message": f"Duplicate {source} submission processed (notifications skipped)",
+            "duplicate_detected": True,
+            "email_sent": False,
+            "sms_sent": False,
+            "webhook_response": webhook_result.get('response', {}),
+            "webhook_success": webhook_result.get('success', False),
+            "debug_mode": is_debug_mode(),
+            "debug_level": DEBUG_MODE if is_debug_mode() else None,
+            "webhook_skipped": should_skip_webhook(),
+            "timestamp": datetime.now().isoformat()
+        }
+    
+    # ============ END DUPLICATE DETECTION CHECK ============
+    
+    # Continue with normal processing for non-duplicate submissions
+    print(f"NEW SUBMISSION: Processing notifications for {name} ({email})")
+    
+    # Get the appropriate notification email based on debug mode
+    notification_email = get_notification_email()
+    
+    # Prepare email content based on source
+    if source == "form":
+        subject = "New Lead Form Filled Out"
+        case_info_for_sms = f"Case: {about_case[:50]}..." if len(about_case) > 50 else about_case
+        
+        html_content = get_form_email_template(
+            lead_name=name,
+            lead_phone=phone or "Not provided",
+            lead_email=email,
+            lead_case_description=about_case
+        )
+        
+    else:  # chatbot
+        subject = "New Lead Alert"
+        case_info_for_sms = f"{case_type} case in {case_state}: {about_case[:30]}..." if len(about_case) > 30 else f"{case_type} case in {case_state}: {about_case}"
+        
+        html_content = get_chatbot_email_template(
+            lead_name=name,
+            lead_phone=phone or "Not provided", 
+            lead_case_type=case_type,
+            lead_case_state=case_state,
+            case_description=about_case
+        )
+    
+    # Send email notification to the firm (or debug email)
+    if not notification_email:
+        missing_var = "DEBUG_EMAIL" if is_debug_mode() else "FIRM_NOTIFICATION_EMAIL"
+        raise HTTPException(status_code=500, detail=f"{missing_var} environment variable not configured")
+    
+    async def send_lead_email() -> dict:
+        result = await send_email_via_resend(
+            to_email=notification_email,
+            subject=subject,
+            html_content=html_content
+        )
+        
+        if not result['success']:
+            print(f"Email send failed: {result.get('error', 'Unknown error')}")
+            await send_error_alert(f"Email send failed: {result.get('error', 'Unknown error')}", "/submit-lead")
+        return result
+    
+    async def send_lead_sms() -> bool:
+        # Send SMS notification (to appropriate phone number based on debug mode)
+        return await send_sms_notification(
+            phone_number=phone or "No phone provided",
+            user_name=name,
+            source=source,
+            case_info=case_info_for_sms,
+            is_referral=is_referral
+        )
+    
+    # In digest mode, leads arriving during a burst are held for one summary
+    # SMS + email instead of being notified one by one
+    notifications_digested = LEAD_DIGEST_ENABLED and lead_digest.window_open()
+    if notifications_digested:
+        lead_digest.add({
+            "name": name,
+            "source": source,
+            "phone": phone,
+            "email": email,
+            "summary": case_info_for_sms,
+            "is_referral": is_referral,
+            "received_at": datetime.now().strftime("%H:%M:%S")
+        })
+        email_result = {'success': False}
+        sms_success = False
+        email_deferred = sms_deferred = False
+    else:
+        if LEAD_DIGEST_ENABLED:
+            lead_digest.open_window()
+        
+        # Email and SMS are non-critical: if the deadline can't cover them while
+        # keeping the webhook's budget in reserve, they are sent after the response
+        # If Resend/Twilio sheds the call or it runs out of time inline, the
+        # stage is deferred too - the webhook below must always run
+        email_deferred = not has_budget_for("email", reserve_for="webhook")
+        if not email_deferred:
+            try:
+                with timed_stage(trace, "email"), reserving_budget_for("webhook"):
+                    email_result = await send_lead_email()
+            except UpstreamUnavailable as e:
+                email_deferred = True
+                defer_stage("email", send_lead_email, reason=f"resend unavailable inline ({e.detail})")
+        else:
+            defer_stage("email", send_lead_email)
+        if email_deferred:
+            email_result = {'success': False}
+        
+        sms_deferred = not has_budget_for("sms", reserve_for="webhook")
+        if not sms_deferred:
+            try:
+                with timed_stage(trace, "sms"), reserving_budget_for("webhook"):
+                    sms_success = await send_lead_sms()
+            except UpstreamUnavailable as e:
+                sms_deferred = True
+                defer_stage("sms", send_lead_sms, reason=f"twilio unavailable inline ({e.detail})")
+        else:
+            defer_stage("sms", send_lead_sms)
+        if sms_deferred:
+            sms_success = False
+    
+    # Prepare unified webhook data
+    webhook_data = {
+        'source': source,
+        'name': name,
+        'phone': phone or "",
+        'email': email,
+        'about_case': about_case,
+        'case_type': case_type or "",
+        'case_state': case_state or "",
+        'is_referral': str(is_referral).lower(),
+        'timestamp': datetime.now().isoformat(),
+        'duplicate_detected': False  # Flag for webhook/GHL
+    }
+    
+    # Add debug flag if in debug mode
+    if is_debug_mode():
+        webhook_data['debug_mode'] = True
+        webhook_data['debug_level'] = DEBUG_MODE
+    
+    # Send to webhook
+    with timed_stage(trace, "webhook"):
         webhook_result = await send_to_webhook(webhook_data)
+    
+    if webhook_result['success']:
+        print(f"{source.title()} submission from {name} ({email}) successfully processed and forwarded")
+        if is_debug_mode():
+            print(f"DEBUG MODE: Notifications sent to debug contacts")
         
-        if webhook_result['success']:
-            print(f"{source.title()} submission from {name} ({email}) successfully processed and forwarded")
-            if is_debug_mode():
-                print(f"DEBUG MODE: Notifications sent to debug contacts")
-            
-            return {
-                "status": "success",
-                "message": f"{source.title()} lead submitted successfully",
+        return {
+            "status": "success",
+            "message": f"{source.title()} lead submitted successfully",
+            "duplicate_detected": False,
+            "email_sent": email_result['success'],
+            "sms_sent": sms_success,
+            "email_deferred": email_deferred,
+            "sms_deferred": sms_deferred,
+            "notifications_digested": notifications_digested,
+            "webhook_response": webhook_result['response'],
+            "debug_mode": is_debug_mode(),
+            "debug_level": DEBUG_MODE if is_debug_mode() else None,
+            "webhook_skipped": should_skip_webhook(),
+            "timestamp": datetime.now().isoformat()
+        }
+    else:
+        print(f"Failed to forward {source} submission from {name} ({email}) to webhook")
+        print(f"Webhook failure details: {webhook_result}")
+        
+        # Use the effective status code (parsed from content if available)
+        effective_status_code = webhook_result.get('effective_status_code', 500)
+        
+        # Include webhook response details in error
+        raise HTTPException(
+            status_code=effective_status_code, 
+            detail={
+                "message": "Failed to process submission",
                 "duplicate_detected": False,
                 "email_sent": email_result['success'],
                 "sms_sent": sms_success,
-                "webhook_response": webhook_result['response'],
-                "debug_mode": is_debug_mode(),
-                "debug_level": DEBUG_MODE if is_debug_mode() else None,
-                "webhook_skipped": should_skip_webhook(),
-                "timestamp": datetime.now().isoformat()
+                "email_deferred": email_deferred,
+                "sms_deferred": sms_deferred,
+                "notifications_digested": notifications_digested,
+                "webhook_error": webhook_result,
+                "debug_mode": is_debug_mode()
             }
-        else:
-            print(f"Failed to forward {source} submission from {name} ({email}) to webhook")
-            print(f"Webhook failure details: {webhook_result}")
-            
-            # Use the effective status code (parsed from content if available)
-            effective_status_code = webhook_result.get('effective_status_code', 500)
-            
-            # Include webhook response details in error
-            raise HTTPException(
-                status_code=effective_status_code, 
-                detail={
-                    "message": "Failed to process submission",
-                    "duplicate_detected": False,
-                    "email_sent": email_result['success'],
-                    "sms_sent": sms_success,
-                    "webhook_error": webhook_result,
-                    "debug_mode": is_debug_mode()
-                }
+        )
+
+# ----- ASYNC LEAD ACCEPTANCE -----
+
+class LeadStore(SQLiteStore):
+    """
+    SQLite store for leads accepted in async mode and their pipeline outcome.
+    SQLite handles cross-process locking, so every worker shares it, and it
+    survives restarts so leads accepted before a crash are re-run at startup.
+    """
+    
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS leads (
+            lead_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            outcome TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_leads_status_updated ON leads (status, updated_at)"
+    )
+    
+    def create(self, lead_id: str, lead: dict):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT INTO leads (lead_id, status, payload, created_at, updated_at) VALUES (?, 'accepted', ?, ?, ?)",
+                (lead_id, json.dumps(lead), now, now)
+            )
+            conn.commit()
+    
+    def set_status(self, lead_id: str, status: str, outcome: Optional[dict] = None):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "UPDATE leads SET status = ?, outcome = COALESCE(?, outcome), updated_at = ? WHERE lead_id = ?",
+                (status, json.dumps(outcome) if outcome is not None else None, time.time(), lead_id)
             )
+            conn.commit()
+    
+    def get(self, lead_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT status, outcome, created_at, updated_at FROM leads WHERE lead_id = ?",
+                (lead_id,)
+            ).fetchone()
+        if not row:
+            return None
+        status, outcome, created_at, updated_at = row
+        return {
+            "status": status,
+            "outcome": json.loads(outcome) if outcome else None,
+            "created_at": created_at,
+            "updated_at": updated_at
+        }
+    
+    def claim_stale(self, older_than: float) -> List[tuple]:
+        """
+        Claim leads whose pipeline never finished (crash/deploy mid-flight).
+        Each lead is claimed with a conditional UPDATE, so when several
+        workers start at once only one of them re-runs it.
+        """
+        claimed = []
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(
+                "SELECT lead_id, payload, created_at, updated_at FROM leads WHERE status IN ('accepted', 'processing') AND updated_at < ?",
+                (older_than,)
+            ).fetchall()
+            for lead_id, payload, created_at, updated_at in rows:
+                cursor = conn.execute(
+                    "UPDATE leads SET status = 'processing', updated_at = ? WHERE lead_id = ? AND updated_at = ?",
+                    (time.time(), lead_id, updated_at)
+                )
+                if cursor.rowcount == 1:
+                    claimed.append((lead_id, json.loads(payload), created_at))
+            conn.commit()
+        return claimed
+    
+    def purge(self, older_than: float) -> int:
+        with self._lock:
+            conn = self._connect()
+            cursor = conn.execute(
+                "DELETE FROM leads WHERE status IN ('completed', 'failed') AND updated_at < ?",
+                (older_than,)
+            )
+            conn.commit()
+            return cursor.rowcount
+
+lead_store = LeadStore(LEAD_STORE_PATH)
+
+# What /lead-status reports for a spam lead: a delivered, non-duplicate lead
+SPAM_LEAD_STATUS_OUTCOME = {
+    "duplicate_detected": False,
+    "email_sent": True,
+    "sms_sent": True,
+    "email_deferred": False,
+    "sms_deferred": False,
+    "notifications_digested": False,
+    "webhook_success": True
+}
+
+def start_lead_pipeline(lead_id: str, lead: dict, received_at: Optional[float] = None):
+    """Run the lead pipeline for an accepted lead in the background"""
+    background_tasks.spawn("lead_pipeline", run_lead_pipeline(lead_id, lead, received_at))
+
+async def run_lead_pipeline(lead_id: str, lead: dict, received_at: Optional[float] = None):
+    """
+    Background half of async acceptance: runs the normal pipeline and records
+    email/SMS/webhook outcomes for GET /lead-status/{lead_id}.
+    """
+    # Runs after the 202 went out, so it gets its own (longer) deadline
+    request_deadline.set(time.monotonic() + ASYNC_LEAD_DEADLINE_SECONDS)
+    if received_at is not None:
+        request_received_at.set(received_at)  # recovered lead - archive it under its original arrival time
+    try:
+        await asyncio.to_thread(lead_store.set_status, lead_id, "processing")
+        result = await process_lead_submission(**lead)
+        
+        if "webhook_response" not in result:
+            # Spam gets the same fake success as the sync path. The submitter can poll
+            # this lead_id, so its status must read like a lead that was delivered
+            outcome = dict(SPAM_LEAD_STATUS_OUTCOME)
+        else:
+            outcome = {
+                "duplicate_detected": result.get("duplicate_detected"),
+                "email_sent": result.get("email_sent"),
+                "sms_sent": result.get("sms_sent"),
+                "email_deferred": result.get("email_deferred"),
+                "sms_deferred": result.get("sms_deferred"),
+                "notifications_digested": result.get("notifications_digested"),
+                "webhook_success": result.get("webhook_success", True)
+            }
+        await asyncio.to_thread(lead_store.set_status, lead_id, "completed", outcome)
+        print(f"ASYNC LEAD {lead_id}: completed {outcome}")
+        
+    except HTTPException as e:
+        detail = e.detail if isinstance(e.detail, dict) else {"message": str(e.detail)}
+        outcome = {
+            "status_code": e.status_code,
+            "error": detail.get("message"),
+            "duplicate_detected": detail.get("duplicate_detected"),
+            "email_sent": detail.get("email_sent"),
+            "sms_sent": detail.get("sms_sent"),
+            "webhook_success": False if "webhook_error" in detail else None
+        }
+        print(f"ASYNC LEAD {lead_id}: failed {outcome}")
+        await asyncio.to_thread(lead_store.set_status, lead_id, "failed", outcome)
+        
+    except Exception as e:
+        print(f"ASYNC LEAD {lead_id}: unexpected error: {e}")
+        await send_error_alert(f"Async lead pipeline error: {str(e)}", "/submit-lead")
+        try:
+            await asyncio.to_thread(lead_store.set_status, lead_id, "failed", {"error": "Internal server error"})
+        except Exception as store_error:
+            print(f"ASYNC LEAD {lead_id}: could not record failure: {store_error}")
+
+async def accept_lead_async(lead: dict):
+    """
+    Persist a lead, start its pipeline in the background and answer
+    202 Accepted right away. Falls back to inline processing if the lead
+    store is unavailable, so a lead is never accepted without being persisted.
+    Field validation runs in the pipeline after spam detection, as on the
+    sync path, so spammers get no validation feedback; a legitimate lead
+    with invalid fields ends up "failed" with the validation error.
+    """
+    lead_id = uuid.uuid4().hex
+    try:
+        await asyncio.to_thread(lead_store.create, lead_id, lead)
+    except Exception as e:
+        print(f"ASYNC LEAD: could not persist lead ({e}) - processing synchronously")
+        return await process_lead_submission(**lead)
+    
+    start_lead_pipeline(lead_id, lead)
+    print(f"ASYNC LEAD {lead_id}: accepted {lead['source']} submission from {lead['name']} ({lead['email']})")
+    
+    return JSONResponse(
+        status_code=202,
+        content={
+            "status": "accepted",
+            "message": f"{lead['source'].title()} lead accepted for processing",
+            "lead_id": lead_id,
+            "status_url": f"/lead-status/{lead_id}",
+            "debug_mode": is_debug_mode(),
+            "timestamp": datetime.now().isoformat()
+        }
+    )
+
+async def recover_pending_leads() -> Optional[str]:
+    """
+    Re-run leads orphaned by a crash or deploy. Runs at startup and then
+    periodically, so leads left behind by a worker that died while the
+    others kept running are picked up too.
+    """
+    stale_leads = await asyncio.to_thread(lead_store.claim_stale, time.time() - LEAD_RECOVERY_GRACE)
+    for lead_id, lead, received_at in stale_leads:
+        print(f"ASYNC LEAD {lead_id}: recovering unfinished lead from a previous run")
+        start_lead_pipeline(lead_id, lead, received_at)
+    if stale_leads:
+        return f"recovered {len(stale_leads)} orphaned leads"
+
+def purge_lead_statuses() -> Optional[str]:
+    purged = lead_store.purge(time.time() - LEAD_STATUS_RETENTION)
+    if purged:
+        return f"purged {purged} old lead status records"
+
+maintenance.register("lead_recovery", LEAD_RECOVERY_INTERVAL, recover_pending_leads, run_at_start=True)
+maintenance.register("lead_status_purge", RETENTION_PURGE_INTERVAL, purge_lead_statuses, blocking=True, run_at_start=True)
+
+@app.get("/lead-status/{lead_id}")
+async def get_lead_status(lead_id: str):
+    """Report the processing status and notification outcomes of an async lead"""
+    record = await asyncio.to_thread(lead_store.get, lead_id)
+    if not record:
+        raise HTTPException(status_code=404, detail="Lead not found")
+    
+    outcome = record["outcome"] or {}
+    return {
+        "lead_id": lead_id,
+        "status": record["status"],
+        "duplicate_detected": outcome.get("duplicate_detected"),
+        "email_sent": outcome.get("email_sent"),
+        "sms_sent": outcome.get("sms_sent"),
+        "email_deferred": outcome.get("email_deferred"),
+        "sms_deferred": outcome.get("sms_deferred"),
+        "notifications_digested": outcome.get("notifications_digested"),
+        "webhook_success": outcome.get("webhook_success"),
+        "error": outcome.get("error"),
+        "accepted_at": datetime.fromtimestamp(record["created_at"]).isoformat(),
+        "updated_at": datetime.fromtimestamp(record["updated_at"]).isoformat(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+# ----- CONSOLIDATED LEAD SUBMISSION ENDPOINT -----
+
+@app.post("/submit-lead")
+async def submit_lead(
+    request: Request,
+    source: str = Form(...),  # "form" or "chatbot"
+    name: str = Form(...),
+    email: str = Form(...),
+    phone: Optional[str] = Form(None),
+    # Unified case description field for both form and chatbot
+    about_case: Optional[str] = Form(None),  # Now used by both form and chatbot
+    # Chatbot-specific fields (kept for backward compatibility)
+    case_type: Optional[str] = Form(None),  # Chatbot case type
+    case_state: Optional[str] = Form(None),  # Chatbot case state/location
+    # Optional fields
+    is_referral: bool = Form(False),
+    async_mode: Optional[bool] = Form(None)  # Overrides LEAD_ASYNC_MODE per request
+):
+    """
+    Consolidated endpoint that handles both form and chatbot lead submissions.
+    Now includes intelligent duplicate detection to prevent multiple notifications
+    for the same lead within a 10-minute window.
+    
+    In async mode the lead is persisted and answered with
+    202 Accepted + lead_id; processing continues in the background and its
+    outcome is reported by GET /lead-status/{lead_id}.
+    
+    Retries carrying the same Idempotency-Key get the first response instead
+    of re-running the pipeline; identical resubmits without one are handled
+    by duplicate detection.
+    """
+    try:
+        print(f"Received {source} submission from {name} ({email})")
+        if is_debug_mode():
+            print(f"DEBUG MODE ACTIVE: {DEBUG_MODE}")
+        
+        # BASIC validation first (only the absolute minimum to prevent crashes)
+        if not name or source not in ["form", "chatbot"]:
+            detail = "Missing required fields: name and valid source are required"
+            archive_rejected_submission(400, detail, {
+                "source": source if source in ["form", "chatbot"] else "unknown", "name": name, "email": email,
+                "phone": phone, "about_case": about_case, "case_type": case_type, "case_state": case_state,
+                "is_referral": is_referral
+            })
+            raise HTTPException(status_code=400, detail=detail)
+        
+        lead = {
+            "source": source,
+            "name": name,
+            "email": email,
+            "phone": phone,
+            "about_case": about_case,
+            "case_type": case_type,
+            "case_state": case_state,
+            "is_referral": is_referral
+        }
+        
+        use_async = LEAD_ASYNC_MODE if async_mode is None else async_mode
+        
+        async def handle_lead():
+            if use_async:
+                return await accept_lead_async(lead)
+            return shape_response(request, await process_lead_submission(**lead), lean_lead_response)
+        
+        # Retries with an Idempotency-Key replay the first response. Identical resubmits
+        # without one still go through duplicate detection, which forwards them to the
+        # webhook flagged duplicate_detected=True as before.
+        key, ttl, fingerprint = get_idempotency_key(
+            request, json.dumps({**lead, "async_mode": use_async}, sort_keys=True), derive_from_payload=False
+        )
+        if key is None:
+            return await handle_lead()
+        return await idempotency_cache.run(key, ttl, handle_lead, fingerprint)
             
     except HTTPException:
         raise
@@ -1107,25 +5248,400 @@ async def submit_lead(
         await send_error_alert(f"Lead submission error: {str(e)}", "/submit-lead")
         raise HTTPException(status_code=500, detail="Internal server error")
 
-# ----- REMAINING ENDPOINTS -----
+# ----- REMAINING ENDPOINTS -----
+
+# ----- UPSTREAM CONNECTION PRE-WARMING -----
+
+def get_upstream_warm_urls() -> Dict[str, str]:
+    """
+    Origin (scheme + host only) of every configured HTTP upstream. Warming
+    only needs the connection, so no API path - and never the Make webhook
+    itself, which would trigger the scenario.
+    """
+    candidates = {
+        "resend": "https://api.resend.com" if RESEND_API_KEY else None,
+        "twilio": "https://api.twilio.com" if TWILIO_ACCOUNT_SID else None,
+        "make": MAKE_WEBHOOK_URL,
+        "docsbot": "https://api.docsbot.ai" if DOCSBOT_API_KEY else None,
+        "chatbase": CHATBASE_BASE_URL if CHATBASE_API_KEY else None
+    }
+    warm_urls = {}
+    for name, url in candidates.items():
+        if url:
+            parts = urlsplit(url)
+            warm_urls[name] = f"{parts.scheme}://{parts.netloc}/"
+    return warm_urls
+
+def resolve_host_ms(host: str, port: int = 443) -> float:
+    started = time.perf_counter()
+    socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    return (time.perf_counter() - started) * 1000
+
+def open_upstream_connection(name: str, url: str, timeout: float) -> dict:
+    """
+    Open (or reuse) a pooled keep-alive connection to an upstream with a
+    HEAD request and time it. Runs in a worker thread via call_upstream.
+    """
+    host = urlsplit(url).hostname
+    dns_ms = resolve_host_ms(host)
+    
+    session = upstream_sessions[name]
+    pools = session.get_adapter(url).poolmanager.pools
+    
+    def connections_opened() -> int:
+        return sum(pools[key].num_connections for key in pools.keys())
+    
+    connections_before = connections_opened()
+    started = time.perf_counter()
+    response = session.head(url, timeout=timeout, allow_redirects=False)
+    response.close()  # hand the connection back to the pool
+    
+    return {
+        "host": host,
+        "dns_ms": round(dns_ms, 1),
+        "request_ms": round((time.perf_counter() - started) * 1000, 1),
+        "new_connection": connections_opened() > connections_before,
+        "status_code": response.status_code
+    }
+
+def open_openai_connection(timeout: float) -> dict:
+    """Warm the OpenAI client's connection pool with a cheap model lookup"""
+    dns_ms = resolve_host_ms("api.openai.com")
+    started = time.perf_counter()
+    openai.models.retrieve("gpt-4o-mini", timeout=timeout)
+    return {
+        "host": "api.openai.com",
+        "dns_ms": round(dns_ms, 1),
+        "request_ms": round((time.perf_counter() - started) * 1000, 1)
+    }
+
+def prebuild_sheets_client() -> dict:
+    """Make sure the Sheets service is built (e.g. after a failed startup auth)"""
+    started = time.perf_counter()
+    if sheets_logger.service is None:
+        sheets_logger._authenticate()
+    return {
+        "client_ready": sheets_logger.service is not None,
+        "build_ms": round((time.perf_counter() - started) * 1000, 1)
+    }
+
+def upstream_probe(name: str, timeout: float):
+    """Coroutine opening (or reusing) a pooled connection to one upstream - shared by warming and health probes"""
+    if name == "openai":
+        return call_upstream("openai", open_openai_connection, timeout=timeout)
+    if name == "sheets":
+        # The Sheets build has no timeout of its own - bound the wait (the thread finishes in the background)
+        return asyncio.wait_for(call_upstream("sheets", prebuild_sheets_client), timeout)
+    return call_upstream(name, open_upstream_connection, name, get_upstream_warm_urls()[name], timeout=timeout)
+
+def probeable_upstreams() -> List[str]:
+    names = list(get_upstream_warm_urls())
+    if openai.api_key:
+        names.append("openai")
+    if GOOGLE_SHEETS_TOKEN:
+        names.append("sheets")
+    return names
+
+async def warm_upstreams() -> dict:
+    """Open pooled connections to every configured upstream in parallel and report per-host timings"""
+    names = [name for name in probeable_upstreams() if name != "sheets" or PREWARM_SHEETS_CLIENT]
+    outcomes = await asyncio.gather(
+        *(upstream_probe(name, UPSTREAM_PREWARM_TIMEOUT_SECONDS) for name in names),
+        return_exceptions=True
+    )
+    
+    results = {}
+    for name, outcome in zip(names, outcomes):
+        if isinstance(outcome, Exception):
+            results[name] = {"warm": False, "error": str(outcome) or type(outcome).__name__}
+        else:
+            results[name] = {"warm": True, **outcome}
+        if not isinstance(outcome, UpstreamUnavailable):
+            # A warm-up is as good as a health probe - saves the prober a round
+            upstream_prober.record(name, outcome)
+    
+    for name, result in results.items():
+        if result["warm"]:
+            print(f"Upstream pre-warm: {name} ready (dns={result.get('dns_ms')}ms, request={result.get('request_ms', result.get('build_ms'))}ms)")
+        else:
+            print(f"Upstream pre-warm: {name} failed - {result['error']}")
+    return results
+
+async def warm_upstreams_on_startup():
+    """Startup hook: pay DNS + TLS handshakes before the first real lead does"""
+    if UPSTREAM_PREWARM_ENABLED:
+        await warm_upstreams()
+
+app_startup_hooks.append(warm_upstreams_on_startup)
+
+warm_state = {"task": None, "started_at": None, "results": None}
+
+async def warm_upstreams_with_cooldown() -> dict:
+    """
+    warm_upstreams at most once per UPSTREAM_WARM_COOLDOWN_SECONDS; callers in
+    between (or during a warm-up) share the latest results, so a public
+    /warm can't be used to fan requests out to every upstream.
+    """
+    now = time.monotonic()
+    if warm_state["task"] is None and (
+        warm_state["started_at"] is None or now - warm_state["started_at"] >= UPSTREAM_WARM_COOLDOWN_SECONDS
+    ):
+        warm_state["started_at"] = now
+        warm_state["task"] = asyncio.create_task(warm_upstreams())
+    
+    task = warm_state["task"]
+    if task is not None:
+        results = await asyncio.shield(task)
+        if warm_state["task"] is task:
+            warm_state["task"] = None
+            warm_state["results"] = results
+    return warm_state["results"]
+
+@app.post("/warm")
+async def warm_server(request: Request):
+    """
+    Warming endpoint to keep the server alive and its upstream connection
+    pools hot, reporting per-host handshake timings (upstreams are contacted
+    at most once per UPSTREAM_WARM_COOLDOWN_SECONDS).
+    """
+    return {
+        "status": "warm",
+        "timestamp": datetime.now().isoformat(),
+        "message": "Server is alive and ready",
+        "debug_mode": is_debug_mode(),
+        "debug_level": DEBUG_MODE if is_debug_mode() else None,
+        "duplicate_detection_entries": get_duplicate_entry_count(),
+        "upstreams": await warm_upstreams_with_cooldown() if UPSTREAM_PREWARM_ENABLED else None
+    }
+
+# ----- UPSTREAM HEALTH PROBES -----
+
+class UpstreamHealthProber:
+    """
+    Probes each upstream on its own schedule in the background (one task per
+    upstream, lowest priority so probes never compete with leads) and caches
+    the latest status and latency. /health?deep=true only reads the cache, so
+    load balancers can poll it as often as they like without fanning out to
+    every upstream.
+    """
+    
+    def __init__(self, default_interval: float, intervals: Dict[str, float], failure_threshold: int):
+        self.default_interval = default_interval
+        self.intervals = intervals
+        self.failure_threshold = failure_threshold
+        self.results = {}  # upstream -> latest probe result
+        self._tasks = []
+    
+    def interval_for(self, name: str) -> float:
+        return self.intervals.get(name, self.default_interval)
+    
+    async def start(self):
+        for name in probeable_upstreams():
+            self._tasks.append(asyncio.create_task(self._run(name)))
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+    
+    async def _run(self, name: str):
+        interval = self.interval_for(name)
+        # Upstreams already checked by the startup warm-up wait a full round;
+        # the rest are staggered so they don't all fire at once
+        await asyncio.sleep(interval if name in self.results else random.uniform(0, min(interval, 10)))
+        while True:
+            await self.probe(name)
+            await asyncio.sleep(interval * random.uniform(0.9, 1.1))
+    
+    async def probe(self, name: str):
+        request_priority.set(PRIORITY_CHAT)  # task-local: probes yield upstream slots to real traffic
+        started = time.perf_counter()
+        try:
+            outcome = await upstream_probe(name, UPSTREAM_PROBE_TIMEOUT_SECONDS)
+        except UpstreamUnavailable:
+            return  # shed locally - says nothing about the upstream
+        except Exception as e:
+            outcome = e
+        self.record(name, outcome, (time.perf_counter() - started) * 1000)
+    
+    def record(self, name: str, outcome, latency_ms: Optional[float] = None):
+        """Fold one probe outcome (result dict or exception) into the cached status"""
+        previous = self.results.get(name, {})
+        if latency_ms is None and isinstance(outcome, dict):
+            latency_ms = outcome.get("request_ms", outcome.get("build_ms"))
+        
+        if isinstance(outcome, Exception):
+            error = str(outcome) or type(outcome).__name__
+        elif outcome.get("status_code", 200) >= 500:
+            error = f"HTTP {outcome['status_code']}"
+        elif outcome.get("client_ready") is False:
+            error = "client not ready"
+        else:
+            error = None
+        
+        failures = 0 if error is None else previous.get("consecutive_failures", 0) + 1
+        if error is None:
+            status = "up"
+        elif failures >= self.failure_threshold:
+            status = "down"
+        else:
+            status = "degraded"
+        if status == "down" and previous.get("status") != "down":
+            print(f"UPSTREAM PROBE: {name} is down ({error})")
+        elif status == "up" and previous.get("status") == "down":
+            print(f"UPSTREAM PROBE: {name} recovered")
+        
+        now = datetime.now().isoformat()
+        self.results[name] = {
+            "status": status,
+            "latency_ms": round(latency_ms, 1) if latency_ms is not None else None,
+            "status_code": outcome.get("status_code") if isinstance(outcome, dict) else None,
+            "consecutive_failures": failures,
+            "last_error": error if error is not None else previous.get("last_error"),
+            "last_success_at": now if error is None else previous.get("last_success_at"),
+            "checked_at": now,
+            "_checked": time.monotonic()
+        }
+    
+    def snapshot(self) -> dict:
+        """Cached status of every upstream; results older than three intervals are reported stale"""
+        now = time.monotonic()
+        upstreams = {}
+        for name in probeable_upstreams():
+            result = self.results.get(name)
+            if result is None:
+                upstreams[name] = {"status": "unknown", "critical": name in HEALTH_CRITICAL_UPSTREAMS}
+                continue
+            entry = {key: value for key, value in result.items() if key != "_checked"}
+            if now - result["_checked"] > 3 * self.interval_for(name):
+                entry["status"] = "stale"
+            entry["critical"] = name in HEALTH_CRITICAL_UPSTREAMS
+            upstreams[name] = entry
+        return upstreams
+
+upstream_prober = UpstreamHealthProber(
+    UPSTREAM_PROBE_INTERVAL_SECONDS, UPSTREAM_PROBE_INTERVALS, UPSTREAM_PROBE_FAILURE_THRESHOLD
+)
 
-@app.post("/warm")
-async def warm_server(request: Request):
-    """Simple warming endpoint to keep the server alive"""
-    client_ip = request.client.host
+async def start_upstream_prober():
+    if UPSTREAM_PROBE_ENABLED:
+        await upstream_prober.start()
+
+app_startup_hooks.append(start_upstream_prober)
+app_shutdown_hooks.append(upstream_prober.stop)
+
+# ----- CHAT PROVIDER CLIENTS -----
+
+def build_docsbot_request(
+    conversation_id: str,
+    question: str,
+    metadata: dict,
+    context_items: int,
+    full_source: bool,
+    conversation_history: Optional[list] = None
+) -> dict:
+    """Build a DocsBot chat-agent request body (history is omitted for resource lookups)"""
+    request_body = {
+        "conversationId": conversation_id,
+        "question": question
+    }
+    if conversation_history is not None:
+        request_body["conversation_history"] = conversation_history
+    request_body.update({
+        "metadata": metadata,
+        "context_items": context_items,
+        "human_escalation": False,
+        "followup_rating": False,
+        "document_retriever": True,
+        "full_source": full_source,
+        "stream": False
+    })
+    return request_body
+
+async def post_docsbot_chat(request_body: dict, endpoint: str):
+    """Send a chat-agent request to DocsBot and return the parsed response"""
+    response = await call_upstream(
+        "docsbot",
+        upstream_sessions["docsbot"].post,
+        f"https://api.docsbot.ai/teams/{DOCSBOT_TEAM_ID}/bots/{DOCSBOT_BOT_ID}/chat-agent",
+        headers={
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {DOCSBOT_API_KEY}'
+        },
+        json=request_body,
+        timeout=30
+    )
+    
+    if not response.ok:
+        error_msg = f"DocsBots API returned {response.status_code}"
+        print(f"DocsBots API error: {error_msg}")
+        await send_error_alert(error_msg, endpoint)
+        raise HTTPException(status_code=response.status_code, detail=error_msg)
+    
+    return response.json()
+
+def build_chatbase_request(conversation_id: str, question: str, conversation_history: list) -> dict:
+    """Build a Chatbase chat request body from DocsBot-style conversation history"""
+    # Prepare conversation history for Chatbase format
+    chatbase_messages = []
     
-    if not check_rate_limit(client_ip):
-        raise HTTPException(status_code=429, detail="Rate limit exceeded")
+    # Add conversation history
+    for msg in conversation_history:
+        chatbase_messages.append({
+            "role": msg.get("role", "user"),
+            "content": msg.get("content", "")
+        })
+    
+    # Add current question
+    chatbase_messages.append({
+        "role": "user", 
+        "content": question
+    })
     
     return {
-        "status": "warm",
-        "timestamp": datetime.now().isoformat(),
-        "message": "Server is alive and ready",
-        "debug_mode": is_debug_mode(),
-        "debug_level": DEBUG_MODE if is_debug_mode() else None,
-        "duplicate_detection_entries": len(duplicate_detection_storage)
+        "messages": chatbase_messages,
+        "chatbotId": CHATBASE_CHATBOT_ID,
+        "stream": False,
+        "temperature": 0.1,
+        "conversationId": conversation_id,
+        "model": "gpt-4o-mini"
     }
 
+async def post_chatbase_chat(request_body: dict, endpoint: str) -> dict:
+    """Send a chat request to Chatbase and return the parsed response"""
+    response = await call_upstream(
+        "chatbase",
+        upstream_sessions["chatbase"].post,
+        f"{CHATBASE_BASE_URL}/chat",
+        headers={
+            'Authorization': f'Bearer {CHATBASE_API_KEY}',
+            'Content-Type': 'application/json'
+        },
+        json=request_body,
+        timeout=30
+    )
+    
+    if not response.ok:
+        error_msg = f"Chatbase API returned {response.status_code}: {response.text}"
+        print(f"Chatbase API error: {error_msg}")
+        await send_error_alert(error_msg, endpoint)
+        raise HTTPException(status_code=response.status_code, detail=error_msg)
+    
+    return response.json()
+
+def format_chatbase_response(response_data: dict) -> list:
+    """Reshape a Chatbase reply into DocsBot's lookup_answer event format"""
+    chatbase_text = response_data.get('text', response_data.get('response', response_data.get('message', '')))
+    
+    # Create response in format similar to DocsBot for compatibility
+    return [{
+        "event": "lookup_answer",
+        "data": {
+            "answer": chatbase_text,
+            "sources": []
+        }
+    }]
+
 @app.post("/chat-docsbot")
 async def chat_with_docsbot(
     request: Request,
@@ -1137,58 +5653,35 @@ async def chat_with_docsbot(
     full_source: bool = Form(True)
 ):
     """Handle DocsBots chat API requests"""
-    client_ip = request.client.host
-    
-    if not check_rate_limit(client_ip):
-        raise HTTPException(status_code=429, detail="Rate limit exceeded")
-    
     try:
         # Parse JSON strings if provided
         parsed_history = json.loads(conversation_history) if conversation_history else []
         parsed_metadata = json.loads(metadata) if metadata else {}
         
+        # Lean responses drop source documents anyway, so don't have DocsBot send them
+        if wants_lean_response(request):
+            full_source = False
+        
         # Prepare request body for DocsBots
-        request_body = {
-            "conversationId": conversation_id,
-            "question": question,
-            "conversation_history": parsed_history,
-            "metadata": parsed_metadata,
-            "context_items": context_items,
-            "human_escalation": False,
-            "followup_rating": False,
-            "document_retriever": True,
-            "full_source": full_source,
-            "stream": False
-        }
+        request_body = build_docsbot_request(
+            conversation_id, question, parsed_metadata, context_items, full_source,
+            conversation_history=parsed_history
+        )
         
         print(f"Sending to DocsBots API: {json.dumps(request_body, indent=2)}")
         
         # Make request to DocsBots API
-        response = requests.post(
-            f"https://api.docsbot.ai/teams/{DOCSBOT_TEAM_ID}/bots/{DOCSBOT_BOT_ID}/chat-agent",
-            headers={
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {DOCSBOT_API_KEY}'
-            },
-            json=request_body,
-            timeout=30
-        )
-        
-        if not response.ok:
-            error_msg = f"DocsBots API returned {response.status_code}"
-            print(f"DocsBots API error: {error_msg}")
-            await send_error_alert(error_msg, "/chat-docsbot")
-            raise HTTPException(status_code=response.status_code, detail=error_msg)
-        
-        response_data = response.json()
+        response_data = await post_docsbot_chat(request_body, "/chat-docsbot")
         print(f"DocsBots response: {json.dumps(response_data, indent=2)}")
         
-        return {
+        return shape_response(request, {
             "status": "success",
             "data": response_data,
             "timestamp": datetime.now().isoformat()
-        }
+        }, lean_chat_response)
         
+    except UpstreamUnavailable:
+        raise
     except requests.exceptions.RequestException as e:
         error_msg = f"DocsBots API request failed: {str(e)}"
         print(error_msg)
@@ -1213,55 +5706,26 @@ async def get_resources_for_case(
     context_items: int = Form(5)
 ):
     """Get resources from DocsBots for case description"""
-    client_ip = request.client.host
-    
-    if not check_rate_limit(client_ip):
-        raise HTTPException(status_code=429, detail="Rate limit exceeded")
-    
     try:
         # Parse metadata if provided
         parsed_metadata = json.loads(metadata) if metadata else {}
         
         # Prepare request body for DocsBots
-        request_body = {
-            "conversationId": conversation_id,
-            "question": question,
-            "metadata": parsed_metadata,
-            "context_items": context_items,
-            "human_escalation": False,
-            "followup_rating": False,
-            "document_retriever": True,
-            "full_source": True,
-            "stream": False
-        }
+        request_body = build_docsbot_request(conversation_id, question, parsed_metadata, context_items, full_source=True)
         
         print(f"Getting resources from DocsBots: {json.dumps(request_body, indent=2)}")
         
         # Make request to DocsBots API
-        response = requests.post(
-            f"https://api.docsbot.ai/teams/{DOCSBOT_TEAM_ID}/bots/{DOCSBOT_BOT_ID}/chat-agent",
-            headers={
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {DOCSBOT_API_KEY}'
-            },
-            json=request_body,
-            timeout=30
-        )
+        response_data = await post_docsbot_chat(request_body, "/get-resources")
         
-        if not response.ok:
-            error_msg = f"DocsBots API returned {response.status_code}"
-            print(f"DocsBots API error: {error_msg}")
-            await send_error_alert(error_msg, "/get-resources")
-            raise HTTPException(status_code=response.status_code, detail=error_msg)
-        
-        response_data = response.json()
-        
-        return {
+        return shape_response(request, {
             "status": "success",
             "data": response_data,
             "timestamp": datetime.now().isoformat()
-        }
+        }, lean_chat_response)
         
+    except UpstreamUnavailable:
+        raise
     except requests.exceptions.RequestException as e:
         error_msg = f"DocsBots API request failed: {str(e)}"
         print(error_msg)
@@ -1276,6 +5740,109 @@ async def get_resources_for_case(
         print(error_msg)
         await send_error_alert(error_msg, "/get-resources")
         raise HTTPException(status_code=500, detail="Internal server error")
+
+def extract_docsbot_sources(value: Any) -> list:
+    """Every source document cited anywhere in a DocsBot response, deduplicated in order"""
+    sources, seen = [], set()
+    
+    def walk(item):
+        if isinstance(item, list):
+            for element in item:
+                walk(element)
+        elif isinstance(item, dict):
+            for key, element in item.items():
+                if key == "sources" and isinstance(element, list):
+                    for source in element:
+                        identity = json.dumps(
+                            {field: source.get(field) for field in ("title", "url", "page")} if isinstance(source, dict) else source,
+                            sort_keys=True, default=str
+                        )
+                        if identity not in seen:
+                            seen.add(identity)
+                            sources.append(source)
+                else:
+                    walk(element)
+    
+    walk(value)
+    return sources
+
+@app.post("/chat-with-resources")
+async def chat_with_resources(
+    request: Request,
+    conversation_id: str = Form(...),
+    question: str = Form(...),
+    conversation_history: Optional[str] = Form(None),
+    metadata: Optional[str] = Form(None),
+    context_items: int = Form(3),
+    full_source: bool = Form(True),
+    resource_context_items: int = Form(5)
+):
+    """
+    /chat-docsbot and /get-resources in one round trip. When the answer is
+    fetched with full_source and at least as many context items as the
+    resources need (resource_context_items defaults to 5, as on
+    /get-resources), its sources are the resources and DocsBot is called
+    once; otherwise both requests go out concurrently. Send context_items=5
+    or more to get the single-request path.
+    """
+    try:
+        parsed_history = json.loads(conversation_history) if conversation_history else []
+        parsed_metadata = json.loads(metadata) if metadata else {}
+        
+        chat_body = build_docsbot_request(
+            conversation_id, question, parsed_metadata, context_items, full_source,
+            conversation_history=parsed_history
+        )
+        resources_reused = full_source and context_items >= resource_context_items
+        
+        resources_error = None
+        if resources_reused:
+            print(f"Sending to DocsBots API (answer + resources in one request): {json.dumps(chat_body, indent=2)}")
+            response_data = await post_docsbot_chat(chat_body, "/chat-with-resources")
+            resources = extract_docsbot_sources(response_data)
+        else:
+            resource_body = build_docsbot_request(conversation_id, question, parsed_metadata, resource_context_items, full_source=True)
+            print(f"Sending to DocsBots API (answer and resources concurrently): {json.dumps(chat_body, indent=2)}")
+            response_data, resource_data = await asyncio.gather(
+                post_docsbot_chat(chat_body, "/chat-with-resources"),
+                post_docsbot_chat(resource_body, "/chat-with-resources"),
+                return_exceptions=True
+            )
+            if isinstance(response_data, BaseException):
+                raise response_data
+            if isinstance(resource_data, BaseException):
+                # The answer is what the visitor is waiting for - send it without resources
+                print(f"DocsBots resources lookup failed: {resource_data}")
+                resources = []
+                resources_error = getattr(resource_data, "detail", None) or str(resource_data)
+            else:
+                resources = extract_docsbot_sources(resource_data)
+        
+        return shape_response(request, {
+            "status": "success",
+            "data": response_data,
+            "resources": resources,
+            "resources_reused": resources_reused,
+            "resources_error": resources_error,
+            "timestamp": datetime.now().isoformat()
+        }, lean_chat_with_resources_response)
+        
+    except (UpstreamUnavailable, HTTPException):
+        raise
+    except requests.exceptions.RequestException as e:
+        error_msg = f"DocsBots API request failed: {str(e)}"
+        print(error_msg)
+        await send_error_alert(error_msg, "/chat-with-resources")
+        raise HTTPException(status_code=503, detail="Service temporarily unavailable")
+    except json.JSONDecodeError as e:
+        error_msg = f"Invalid JSON in request parameters: {str(e)}"
+        print(error_msg)
+        raise HTTPException(status_code=400, detail=error_msg)
+    except Exception as e:
+        error_msg = f"Unexpected error in chat with resources endpoint: {str(e)}"
+        print(error_msg)
+        await send_error_alert(error_msg, "/chat-with-resources")
+        raise HTTPException(status_code=500, detail="Internal server error")
     
 @app.post("/chat-chatbase")
 async def chat_with_chatbase(
@@ -1288,11 +5855,6 @@ async def chat_with_chatbase(
     full_source: bool = Form(True)
 ):
     """Handle Chatbase chat API requests"""
-    client_ip = request.client.host
-    
-    if not check_rate_limit(client_ip):
-        raise HTTPException(status_code=429, detail="Rate limit exceeded")
-    
     try:
         # Parse JSON strings if provided
         parsed_history = json.loads(conversation_history) if conversation_history else []
@@ -1302,73 +5864,27 @@ async def chat_with_chatbase(
         print(f"Conversation history length: {len(parsed_history)}")
         print(f"Metadata: {parsed_metadata}")
         
-        # Prepare conversation history for Chatbase format
-        chatbase_messages = []
-        
-        # Add conversation history
-        for msg in parsed_history:
-            chatbase_messages.append({
-                "role": msg.get("role", "user"),
-                "content": msg.get("content", "")
-            })
-        
-        # Add current question
-        chatbase_messages.append({
-            "role": "user", 
-            "content": question
-        })
-        
         # Prepare request body for Chatbase
-        request_body = {
-            "messages": chatbase_messages,
-            "chatbotId": CHATBASE_CHATBOT_ID,
-            "stream": False,
-            "temperature": 0.1,
-            "conversationId": conversation_id,
-            "model": "gpt-4o-mini"
-        }
+        request_body = build_chatbase_request(conversation_id, question, parsed_history)
         
         print(f"Sending to Chatbase API: {json.dumps(request_body, indent=2)}")
         
         # Make request to Chatbase API
-        response = requests.post(
-            f"{CHATBASE_BASE_URL}/chat",
-            headers={
-                'Authorization': f'Bearer {CHATBASE_API_KEY}',
-                'Content-Type': 'application/json'
-            },
-            json=request_body,
-            timeout=30
-        )
-        
-        if not response.ok:
-            error_msg = f"Chatbase API returned {response.status_code}: {response.text}"
-            print(f"Chatbase API error: {error_msg}")
-            await send_error_alert(error_msg, "/chat-chatbase")
-            raise HTTPException(status_code=response.status_code, detail=error_msg)
-        
-        response_data = response.json()
+        response_data = await post_chatbase_chat(request_body, "/chat-chatbase")
         print(f"Chatbase response: {json.dumps(response_data, indent=2)}")
         
         # Transform Chatbase response to match expected format
-        chatbase_text = response_data.get('text', response_data.get('response', response_data.get('message', '')))
-        
-        # Create response in format similar to DocsBot for compatibility
-        formatted_response = [{
-            "event": "lookup_answer",
-            "data": {
-                "answer": chatbase_text,
-                "sources": []
-            }
-        }]
+        formatted_response = format_chatbase_response(response_data)
         
-        return {
+        return shape_response(request, {
             "status": "success",
             "data": formatted_response,
             "raw_chatbase_response": response_data,
             "timestamp": datetime.now().isoformat()
-        }
+        }, lean_chat_response)
         
+    except UpstreamUnavailable:
+        raise
     except requests.exceptions.RequestException as e:
         error_msg = f"Chatbase API request failed: {str(e)}"
         print(error_msg)
@@ -1384,26 +5900,561 @@ async def chat_with_chatbase(
         await send_error_alert(error_msg, "/chat-chatbase")
         raise HTTPException(status_code=500, detail="Internal server error")
 
-@app.get("/health")
-async def health_check():
-    """Simple health check endpoint."""
+# ----- UNIFIED CHAT ENDPOINT (LATENCY-AWARE ROUTING + HEDGING) -----
+
+class ChatProviderStats:
+    """EWMA latency / error rate and a latency sample window for one chat provider"""
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.ewma_latency = None
+        self.error_rate = 0.0
+        self.latencies = deque(maxlen=200)
+        self.requests = 0
+        self.errors = 0
+        self.wins = 0
+        self.hedges_fired = 0
+    
+    def record(self, latency_seconds: float, success: bool):
+        self.requests += 1
+        if success:
+            self.latencies.append(latency_seconds)
+            if self.ewma_latency is None:
+                self.ewma_latency = latency_seconds
+            else:
+                self.ewma_latency += CHAT_EWMA_ALPHA * (latency_seconds - self.ewma_latency)
+        else:
+            self.errors += 1
+        self.error_rate += CHAT_EWMA_ALPHA * ((0.0 if success else 1.0) - self.error_rate)
+    
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        if len(self.latencies) < CHAT_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index]
+    
+    def score(self) -> float:
+        """Lower is healthier: expected latency inflated by recent errors"""
+        latency = self.ewma_latency if self.ewma_latency is not None else CHAT_HEDGE_DEFAULT_DELAY_SECONDS
+        return latency * (1 + CHAT_ERROR_PENALTY * self.error_rate)
+    
+    def hedge_delay(self) -> float:
+        percentile_latency = self.latency_percentile(CHAT_HEDGE_PERCENTILE)
+        if percentile_latency is None:
+            return CHAT_HEDGE_DEFAULT_DELAY_SECONDS
+        return max(CHAT_HEDGE_MIN_DELAY_SECONDS, percentile_latency)
+    
+    def stats(self) -> dict:
+        return {
+            "ewma_latency_ms": round(self.ewma_latency * 1000, 1) if self.ewma_latency is not None else None,
+            "p50_latency_ms": round(self.latency_percentile(50) * 1000, 1) if self.latency_percentile(50) is not None else None,
+            "hedge_after_ms": round(self.hedge_delay() * 1000, 1),
+            "error_rate": round(self.error_rate, 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "wins": self.wins,
+            "hedges_fired": self.hedges_fired
+        }
+
+chat_provider_stats = {
+    "docsbot": ChatProviderStats("docsbot"),
+    "chatbase": ChatProviderStats("chatbase")
+}
+
+def configured_chat_providers() -> List[str]:
+    providers = []
+    if DOCSBOT_TEAM_ID and DOCSBOT_BOT_ID and DOCSBOT_API_KEY:
+        providers.append("docsbot")
+    if CHATBASE_API_KEY and CHATBASE_CHATBOT_ID:
+        providers.append("chatbase")
+    return providers
+
+def rank_chat_providers() -> List[str]:
+    """Configured providers, healthiest (lowest score) first"""
+    return sorted(configured_chat_providers(), key=lambda name: chat_provider_stats[name].score())
+
+async def ask_chat_provider(
+    provider: str,
+    conversation_id: str,
+    question: str,
+    conversation_history: list,
+    metadata: dict,
+    context_items: int,
+    full_source: bool
+) -> list:
+    """Ask one provider and return its answer in DocsBot's event format, recording latency/errors"""
+    started = time.perf_counter()
+    try:
+        if provider == "docsbot":
+            request_body = build_docsbot_request(
+                conversation_id, question, metadata, context_items, full_source,
+                conversation_history=conversation_history
+            )
+            data = await post_docsbot_chat(request_body, "/chat")
+        else:
+            request_body = build_chatbase_request(conversation_id, question, conversation_history)
+            data = format_chatbase_response(await post_chatbase_chat(request_body, "/chat"))
+    except UpstreamUnavailable:
+        # Refused locally (shed/deadline) - says nothing about the provider's health
+        raise
+    except Exception:
+        chat_provider_stats[provider].record(time.perf_counter() - started, success=False)
+        raise
+    
+    chat_provider_stats[provider].record(time.perf_counter() - started, success=True)
+    return data
+
+async def hedged_chat(**chat_kwargs):
+    """
+    Ask the healthiest provider; if it hasn't answered within its
+    CHAT_HEDGE_PERCENTILE latency (or it fails), also ask the other one and
+    keep whichever answer arrives first.
+    Returns (provider, data, hedged).
+    """
+    providers = rank_chat_providers()
+    if not providers:
+        raise HTTPException(status_code=503, detail="No chat provider configured")
+    
+    task_providers = {}
+    
+    def start(provider: str) -> asyncio.Task:
+        # Losing requests are left to finish so their latency still feeds the stats;
+        # their failures are expected, so the registry only counts them
+        task = background_tasks.spawn("chat_request", ask_chat_provider(provider, **chat_kwargs), report_failures=False)
+        task_providers[task] = provider
+        return task
+    
+    primary = providers[0]
+    backup = providers[1] if CHAT_HEDGING_ENABLED and len(providers) > 1 else None
+    pending = {start(primary)}
+    hedged = False
+    last_error = None
+    
+    while pending:
+        hedge_timeout = chat_provider_stats[primary].hedge_delay() if backup and not hedged else None
+        done, pending = await asyncio.wait(pending, timeout=hedge_timeout, return_when=asyncio.FIRST_COMPLETED)
+        
+        for task in done:
+            if task.exception() is None:
+                provider = task_providers[task]
+                chat_provider_stats[provider].wins += 1
+                return provider, task.result(), hedged
+            last_error = task.exception()
+            print(f"CHAT ROUTING: {task_providers[task]} failed: {last_error}")
+        
+        # Primary is slower than its percentile threshold (or already failed) - bring in the backup
+        if backup and not hedged:
+            if not done:
+                print(f"CHAT ROUTING: {primary} slower than p{CHAT_HEDGE_PERCENTILE:g} ({hedge_timeout:.2f}s), hedging to {backup}")
+                chat_provider_stats[primary].hedges_fired += 1
+            else:
+                print(f"CHAT ROUTING: failing over from {primary} to {backup}")
+            pending.add(start(backup))
+            hedged = True
+    
+    raise last_error
+
+@app.post("/chat")
+async def chat_unified(
+    request: Request,
+    conversation_id: str = Form(...),
+    question: str = Form(...),
+    conversation_history: Optional[str] = Form(None),
+    metadata: Optional[str] = Form(None),
+    context_items: int = Form(3),
+    full_source: bool = Form(True)
+):
+    """
+    Provider-agnostic chat: routes to DocsBot or Chatbase by EWMA latency and
+    error rate, hedging to the other provider when the first one is slow.
+    Answers use DocsBot's lookup_answer event format whichever provider wins.
+    """
+    try:
+        # Parse JSON strings if provided
+        parsed_history = json.loads(conversation_history) if conversation_history else []
+        parsed_metadata = json.loads(metadata) if metadata else {}
+        
+        provider, response_data, hedged = await hedged_chat(
+            conversation_id=conversation_id,
+            question=question,
+            conversation_history=parsed_history,
+            metadata=parsed_metadata,
+            context_items=context_items,
+            full_source=full_source and not wants_lean_response(request)
+        )
+        print(f"Unified chat answered by {provider}{' (hedged)' if hedged else ''}")
+        
+        return shape_response(request, {
+            "status": "success",
+            "provider": provider,
+            "hedged": hedged,
+            "data": response_data,
+            "timestamp": datetime.now().isoformat()
+        }, lean_chat_response)
+        
+    except UpstreamUnavailable:
+        raise
+    except json.JSONDecodeError as e:
+        error_msg = f"Invalid JSON in request parameters: {str(e)}"
+        print(error_msg)
+        raise HTTPException(status_code=400, detail=error_msg)
+    except HTTPException as e:
+        if e.status_code == 503:
+            raise
+        # Provider errors were already alerted on by the provider clients
+        raise HTTPException(status_code=503, detail="Service temporarily unavailable")
+    except requests.exceptions.RequestException as e:
+        error_msg = f"All chat providers failed: {str(e)}"
+        print(error_msg)
+        await send_error_alert(error_msg, "/chat")
+        raise HTTPException(status_code=503, detail="Service temporarily unavailable")
+    except Exception as e:
+        error_msg = f"Unexpected error in unified chat endpoint: {str(e)}"
+        print(error_msg)
+        await send_error_alert(error_msg, "/chat")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+# ----- EVENT LOOP LAG MONITOR & BLOCKING-CALL DETECTOR -----
+
+class EventLoopMonitor:
+    """
+    Measures event-loop lag and catches blocking calls.
+    A heartbeat task sleeps LOOP_MONITOR_INTERVAL_SECONDS and records how
+    late it wakes up. A watchdog thread checks the heartbeat; once it is
+    older than LOOP_BLOCK_THRESHOLD_MS the loop thread is stuck in one
+    callback, so the watchdog grabs that thread's stack while it is still
+    blocked. When the loop wakes up, the stall's full duration is charged to
+    the captured call site.
+    """
+    
+    MAX_OFFENDERS = 50
+    STACK_DEPTH = 15
+    
+    def __init__(self, interval: float, block_threshold: float):
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.lag_samples = deque(maxlen=600)  # ~1 minute at the default interval
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.offenders = {}  # call site -> stats
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id = None
+        self._pending_stall = None  # (site, stack) captured by the watchdog
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._task = None
+        self._thread = None
+    
+    async def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._run_heartbeat())
+        self._thread = threading.Thread(target=self._run_watchdog, name="loop-watchdog", daemon=True)
+        self._thread.start()
+    
+    async def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+    
+    async def _run_heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self._heartbeat = now
+            self.lag_samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            
+            if lag >= self.block_threshold:
+                with self._lock:
+                    stall, self._pending_stall = self._pending_stall, None
+                self._record_stall(lag, stall)
+    
+    def _run_watchdog(self):
+        check_every = max(0.01, self.block_threshold / 4)
+        while not self._stop.wait(check_every):
+            if time.monotonic() - self._heartbeat < self.block_threshold + self.interval:
+                continue
+            with self._lock:
+                if self._pending_stall is not None:
+                    continue  # already captured this stall
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is None:
+                    continue
+                self._pending_stall = self._describe(frame)
+    
+    def _describe(self, frame) -> tuple:
+        """(call site, formatted stack) of the loop thread's current frame"""
+        stack = traceback.extract_stack(frame)[-self.STACK_DEPTH:]
+        # Blame the innermost frame in this service's code, not the library it called into
+        site_frame = next((entry for entry in reversed(stack) if entry.filename == __file__), stack[-1])
+        site = f"{os.path.basename(site_frame.filename)}:{site_frame.lineno} in {site_frame.name}"
+        return site, [f"{entry.filename}:{entry.lineno} in {entry.name}: {entry.line}" for entry in stack]
+    
+    def _record_stall(self, lag: float, stall: Optional[tuple]):
+        self.stalls += 1
+        site, stack = stall if stall is not None else ("unknown (blocked between watchdog checks)", [])
+        print(f"EVENT LOOP BLOCKED for {lag * 1000:.0f}ms at {site}")
+        
+        with self._lock:
+            offender = self.offenders.get(site)
+            if offender is None:
+                if len(self.offenders) >= self.MAX_OFFENDERS:
+                    # Keep the memory bounded - drop the least costly site
+                    cheapest = min(self.offenders, key=lambda key: self.offenders[key]["total_seconds"])
+                    del self.offenders[cheapest]
+                offender = self.offenders[site] = {"count": 0, "total_seconds": 0.0, "worst_seconds": 0.0, "stack": stack}
+            offender["count"] += 1
+            offender["total_seconds"] += lag
+            offender["last_seen"] = datetime.now().isoformat()
+            if lag >= offender["worst_seconds"]:
+                offender["worst_seconds"] = lag
+                if stack:
+                    offender["stack"] = stack
+    
+    def lag_percentile(self, percentile: float) -> Optional[float]:
+        if not self.lag_samples:
+            return None
+        ordered = sorted(self.lag_samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+    
+    def summary(self) -> dict:
+        def ms(value):
+            return round(value * 1000, 1) if value is not None else None
+        return {
+            "lag_ms": ms(self.lag_samples[-1]) if self.lag_samples else None,
+            "p50_lag_ms": ms(self.lag_percentile(50)),
+            "p99_lag_ms": ms(self.lag_percentile(99)),
+            "max_lag_ms": ms(self.max_lag),
+            "stalls": self.stalls
+        }
+    
+    def worst_offenders(self, limit: int) -> List[dict]:
+        with self._lock:
+            ranked = sorted(self.offenders.items(), key=lambda item: -item[1]["total_seconds"])[:limit]
+            return [
+                {
+                    "site": site,
+                    "count": offender["count"],
+                    "total_ms": round(offender["total_seconds"] * 1000, 1),
+                    "worst_ms": round(offender["worst_seconds"] * 1000, 1),
+                    "last_seen": offender["last_seen"],
+                    "stack": offender["stack"]
+                }
+                for site, offender in ranked
+            ]
+
+loop_monitor = EventLoopMonitor(LOOP_MONITOR_INTERVAL_SECONDS, LOOP_BLOCK_THRESHOLD_MS / 1000)
+
+async def start_loop_monitor():
+    if LOOP_MONITOR_ENABLED:
+        await loop_monitor.start()
+
+app_startup_hooks.append(start_loop_monitor)
+app_shutdown_hooks.append(loop_monitor.stop)
+
+@app.get("/admin/diagnostics/event-loop")
+async def event_loop_diagnostics(request: Request, limit: int = 10):
+    """Event-loop lag for this worker and the call sites that blocked it longest"""
+    require_admin_key(request)
+    return {
+        "status": "success",
+        "worker_pid": os.getpid(),
+        "monitor_enabled": LOOP_MONITOR_ENABLED,
+        "block_threshold_ms": LOOP_BLOCK_THRESHOLD_MS,
+        **loop_monitor.summary(),
+        "worst_offenders": loop_monitor.worst_offenders(max(1, min(limit, EventLoopMonitor.MAX_OFFENDERS))),
+        "timestamp": datetime.now().isoformat()
+    }
+
+# ----- SAMPLING PROFILER -----
+
+def sample_thread_stacks(seconds: float, interval: float) -> tuple:
+    """
+    Sample every thread's stack for `seconds` and count identical stacks.
+    Returns ({collapsed_stack: samples}, sample_rounds). Runs in a worker
+    thread; each round only walks frame objects, so overhead stays low.
+    """
+    sampler_id = threading.get_ident()
+    counts = defaultdict(int)
+    rounds = 0
+    deadline = time.monotonic() + seconds
+    
+    while time.monotonic() < deadline:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_id:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            frames.append(thread_names.get(thread_id, f"thread-{thread_id}"))
+            # Collapsed format: root first, frames separated by ';'
+            counts[";".join(reversed(frames))] += 1
+        rounds += 1
+        time.sleep(interval)
+    
+    return counts, rounds
+
+def in_memory_table_sizes() -> dict:
+    """Entry counts of the in-process tables that grow with traffic"""
+    return {
+        "rate_limit_keys": len(rate_limit_storage),
+        "rate_limit_timestamps": sum(len(timestamps) for timestamps in rate_limit_storage.values()),
+        "duplicate_hashes": len(duplicate_detection_storage),
+        "idempotency_entries": len(idempotency_cache._entries),
+        "recent_llm_calls": len(recent_llm_calls),
+        "chat_latency_samples": sum(len(provider.latencies) for provider in chat_provider_stats.values())
+    }
+
+def allocation_growth_since(before, top: int) -> List[dict]:
+    """Snapshot again and diff against before - walks every live trace, so run it in a worker thread"""
+    exclude_tracemalloc = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    after = tracemalloc.take_snapshot().filter_traces(exclude_tracemalloc)
+    before = before.filter_traces(exclude_tracemalloc)
+    return [
+        {
+            "location": str(stat.traceback[0]) if stat.traceback else "unknown",
+            "size_diff_kb": round(stat.size_diff / 1024, 1),
+            "size_kb": round(stat.size / 1024, 1),
+            "count_diff": stat.count_diff
+        }
+        for stat in after.compare_to(before, "lineno")[:max(1, top)]
+    ]
+
+profiler_lock = asyncio.Lock()
+
+@app.post("/admin/profile")
+async def run_sampling_profiler(
+    request: Request,
+    seconds: float = 10.0,
+    interval_ms: float = 10.0,
+    format: str = "json",
+    allocations: bool = False,
+    top: int = 25
+):
+    """
+    Sample all threads for `seconds` and return collapsed stacks (feed
+    format=collapsed output straight to flamegraph.pl / speedscope).
+    allocations=true also diffs tracemalloc snapshots taken before and
+    after the run. One profile at a time per worker.
+    """
+    require_admin_key(request)
+    if format not in ("json", "collapsed"):
+        raise HTTPException(status_code=400, detail="format must be json or collapsed")
+    if profiler_lock.locked():
+        raise HTTPException(status_code=409, detail="A profile is already running on this worker")
+    
+    seconds = max(0.1, min(seconds, PROFILER_MAX_SECONDS))
+    interval = max(PROFILER_MIN_INTERVAL_MS, interval_ms) / 1000
+    
+    async with profiler_lock:
+        started_tracing = False
+        before = None
+        if allocations:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(PROFILER_TRACEMALLOC_FRAMES)
+                started_tracing = True
+            before = await asyncio.to_thread(tracemalloc.take_snapshot)
+        
+        print(f"PROFILER: sampling all threads for {seconds:.1f}s every {interval * 1000:.1f}ms")
+        try:
+            counts, rounds = await asyncio.to_thread(sample_thread_stacks, seconds, interval)
+            allocation_growth = None
+            if allocations:
+                allocation_growth = await asyncio.to_thread(allocation_growth_since, before, top)
+        finally:
+            # Tracing slows every allocation - never leave it on after the run
+            if started_tracing:
+                tracemalloc.stop()
+    
+    collapsed = "\n".join(f"{stack} {samples}" for stack, samples in sorted(counts.items(), key=lambda item: -item[1]))
+    if format == "collapsed":
+        return PlainTextResponse(collapsed + "\n")
+    
     return {
+        "status": "success",
+        "worker_pid": os.getpid(),
+        "seconds": seconds,
+        "interval_ms": round(interval * 1000, 2),
+        "sample_rounds": rounds,
+        "distinct_stacks": len(counts),
+        "collapsed": collapsed,
+        "allocation_growth": allocation_growth,
+        "in_memory_tables": in_memory_table_sizes(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.get("/health")
+async def health_check(deep: bool = False):
+    """
+    Simple health check endpoint. With deep=true it adds each upstream's
+    cached probe result and answers 503 while a critical upstream is down.
+    """
+    body = {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
         "service": "Law Firm Chatbot API",
         "debug_mode": is_debug_mode(),
         "debug_level": DEBUG_MODE if is_debug_mode() else None,
         "duplicate_detection": {
-            "active_entries": len(duplicate_detection_storage),
+            "active_entries": get_duplicate_entry_count(),
             "detection_window_seconds": DUPLICATE_DETECTION_WINDOW,
             "cleanup_interval_seconds": DUPLICATE_CLEANUP_INTERVAL
         },
+        "serving": {
+            "workers": SERVER_WORKERS,
+            "worker_pid": os.getpid(),
+            "shared_state": SHARED_STATE_ENABLED,
+            "persistent_state": state_log.stats() if state_log is not None else {"enabled": False}
+        },
+        "submission_archive": submission_archive.stats() if submission_archive is not None else {"enabled": False},
+        "load": {
+            "inflight_requests": sum(inflight_requests.values()),
+            "max_inflight_requests": MAX_INFLIGHT_REQUESTS,
+            "lead_admission_rejections": dict(lead_admission_rejections),
+            "upstreams": {name: limiter.stats() for name, limiter in upstream_limiters.items()}
+        },
+        "spam_detection": {
+            "blocklist": spam_blocklist.stats() if spam_blocklist is not None else {"enabled": False},
+            "contact_validation": contact_validator.stats() if contact_validator is not None else {"enabled": False},
+            "batching_enabled": SPAM_BATCHING_ENABLED,
+            "batch_window_ms": int(SPAM_BATCH_WINDOW_SECONDS * 1000),
+            "batches_sent": spam_batcher.batches_sent,
+            "submissions_batched": spam_batcher.submissions_batched,
+            "llm_usage": get_llm_usage_summary()
+        },
+        "event_loop": loop_monitor.summary(),
+        "maintenance": maintenance.stats(),
+        "background_tasks": background_tasks.stats(),
+        "lead_digest": lead_digest.stats(),
+        "make_webhook": make_webhook_batcher.stats(),
+        "stage_change_emails": stage_email_batcher.stats(),
+        "idempotency": idempotency_cache.stats(),
+        "chat_providers": {name: provider.stats() for name, provider in chat_provider_stats.items()},
         "debug_config": {
             "debug_phone_configured": bool(DEBUG_PHONE_NUMBER),
             "debug_email_configured": bool(DEBUG_EMAIL),
             "webhook_will_be_skipped": should_skip_webhook()
         } if is_debug_mode() else None
     }
+    if not deep:
+        return body
+    
+    upstreams = upstream_prober.snapshot()
+    body["upstreams"] = upstreams
+    if any(entry["critical"] and entry["status"] == "down" for entry in upstreams.values()):
+        body["status"] = "unhealthy"
+        return FastJSONResponse(status_code=503, content=body)
+    if any(entry["status"] in ("down", "degraded") for entry in upstreams.values()):
+        body["status"] = "degraded"
+    return body
     
 class GoogleSheetsLogger:
     def __init__(self):
@@ -1504,8 +6555,10 @@ async def log_to_google_sheets(name: str, email: str, phone: str, case_descripti
     Log legitimate lead to Google Sheets in a separate async call
     This won't block the main flow if Sheets API is slow
     """
+    # Runs detached from the request, so it must not inherit the request's deadline
+    request_deadline.set(time.monotonic() + DEFERRED_STAGE_DEADLINE_SECONDS)
     try:
-        sheets_logger.log_case_entry(name, email, phone, case_description, source)
+        await call_upstream("sheets", sheets_logger.log_case_entry, name, email, phone, case_description, source)
     except Exception as e:
         print(f"Error in Google Sheets logging: {e}")
         # Don't let Sheets errors affect the main flow
@@ -1576,7 +6629,7 @@ if __name__ == "__main__":
     print(f"\n=== DUPLICATE DETECTION CONFIGURATION ===")
     print(f"Detection window: {DUPLICATE_DETECTION_WINDOW} seconds ({DUPLICATE_DETECTION_WINDOW/60:.1f} minutes)")
     print(f"Cleanup interval: {DUPLICATE_CLEANUP_INTERVAL} seconds ({DUPLICATE_CLEANUP_INTERVAL/60:.1f} minutes)")
-    print(f"Active duplicate entries: {len(duplicate_detection_storage)}")
+    print(f"Active duplicate entries: {get_duplicate_entry_count()}")
     
     if is_debug_mode():
         print(f"DEBUG_PHONE_NUMBER: {'✓ Configured' if DEBUG_PHONE_NUMBER else '✗ Not configured'}")
@@ -1588,4 +6641,27 @@ if __name__ == "__main__":
             print("WARNING: DEBUG_EMAIL not set - emails will go to production email")
     print(f"===============================\n")
     
-    uvicorn.run(app, host="0.0.0.0", port=10000)
\ No newline at end of file
+    # Serving configuration
+    print(f"=== SERVING CONFIGURATION ===")
+    print(f"Workers: {SERVER_WORKERS}")
+    print(f"Shared state: {'✓ ' + SHARED_STATE_DIR if SHARED_STATE_ENABLED else '✗ In-process only'}")
+    print(f"Event loop: {UVICORN_LOOP}, HTTP parser: {UVICORN_HTTP}")
+    print(f"Persistent state: {'✓ ' + STATE_DIR if STATE_PERSISTENCE_ENABLED else '✗ Lost on restart'}")
+    print(f"===============================\n")
+    
+    # Restore dedupe/rate-limit state once, before workers attach to the shared tables
+    if SERVER_WORKERS > 1:
+        load_persistent_state()
+    
+    # Workers are spawned by importing "main:app", so the app must be passed by import string
+    uvicorn.run(
+        "main:app" if SERVER_WORKERS > 1 else app,
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "10000")),
+        workers=SERVER_WORKERS,
+        loop=UVICORN_LOOP,
+        http=UVICORN_HTTP,
+        backlog=UVICORN_BACKLOG,
+        timeout_keep_alive=UVICORN_KEEP_ALIVE_SECONDS,
+        access_log=os.getenv("UVICORN_ACCESS_LOG", "TRUE").upper() == "TRUE"
+    )
\ No newline at end of file
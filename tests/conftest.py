@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# main.py reads its configuration at import time - point every store at a
+# throwaway directory and keep startup from reaching real upstreams
+STATE_DIR = tempfile.mkdtemp(prefix="lead-api-tests-")
+os.environ.setdefault("LEAD_STORE_PATH", os.path.join(STATE_DIR, "leads.db"))
+os.environ.setdefault("SUBMISSION_ARCHIVE_PATH", os.path.join(STATE_DIR, "submissions.db"))
+os.environ.setdefault("UPSTREAM_PREWARM_ENABLED", "FALSE")
+os.environ.setdefault("FIRM_NOTIFICATION_EMAIL", "intake@example.com")
+os.environ.setdefault("RESEND_FROM_EMAIL", "leads@example.com")
+os.environ.setdefault("RESEND_API_KEY", "test-key")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
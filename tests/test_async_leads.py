@@ -0,0 +1,120 @@
+import asyncio
+import uuid
+
+import pytest
+
+import main
+
+
+LEGITIMATE_RESULT = {
+    "status": "success",
+    "duplicate_detected": False,
+    "email_sent": True,
+    "sms_sent": True,
+    "email_deferred": False,
+    "sms_deferred": False,
+    "notifications_digested": False,
+    "webhook_response": {"status_code": 200}
+}
+
+SPAM_RESULT = {
+    "status": "success",
+    "message": "Form submitted successfully",
+    "timestamp": "2026-01-01T00:00:00"
+}
+
+
+def make_lead(**overrides):
+    lead = {
+        "source": "form",
+        "name": "Dana Whitfield",
+        "email": f"{uuid.uuid4().hex[:8]}@example.com",
+        "phone": "3125552368",
+        "about_case": "I slipped on a wet floor at a grocery store and broke my wrist",
+        "case_type": None,
+        "case_state": None,
+        "is_referral": False
+    }
+    lead.update(overrides)
+    return lead
+
+
+def pipeline_status(monkeypatch, result):
+    async def process_lead_submission(**lead):
+        return dict(result)
+    
+    monkeypatch.setattr(main, "process_lead_submission", process_lead_submission)
+    
+    async def scenario():
+        lead_id = uuid.uuid4().hex
+        lead = make_lead()
+        main.lead_store.create(lead_id, lead)
+        await main.run_lead_pipeline(lead_id, lead)
+        return await main.get_lead_status(lead_id)
+    return asyncio.run(scenario())
+
+
+def outcome_fields(status):
+    return {key: value for key, value in status.items() if key not in ("lead_id", "accepted_at", "updated_at", "timestamp")}
+
+
+def test_legitimate_lead_reports_its_outcomes(monkeypatch):
+    status = pipeline_status(monkeypatch, {**LEGITIMATE_RESULT, "sms_sent": False})
+    
+    assert status["status"] == "completed"
+    assert status["email_sent"] is True
+    assert status["sms_sent"] is False
+    assert status["webhook_success"] is True
+
+
+def test_spam_lead_status_looks_delivered(monkeypatch):
+    spam = pipeline_status(monkeypatch, SPAM_RESULT)
+    legitimate = pipeline_status(monkeypatch, LEGITIMATE_RESULT)
+    
+    assert outcome_fields(spam) == outcome_fields(legitimate)
+
+
+@pytest.fixture
+def spam_verdict(monkeypatch):
+    async def no_blocklist_match(phone, email, about_case):
+        return None
+    
+    async def flagged(*args):
+        return True
+    
+    async def ignore(*args, **kwargs):
+        return None
+    
+    monkeypatch.setattr(main, "contact_validator", None)
+    monkeypatch.setattr(main, "check_spam_blocklist", no_blocklist_match)
+    monkeypatch.setattr(main, "check_for_spam", flagged)
+    monkeypatch.setattr(main, "learn_spam_submission", ignore)
+    monkeypatch.setattr(main, "log_to_google_sheets", ignore)
+
+
+def accept_and_run(monkeypatch, lead):
+    started = []
+    monkeypatch.setattr(main, "start_lead_pipeline", lambda lead_id, lead, received_at=None: started.append(lead_id))
+    
+    async def scenario():
+        response = await main.accept_lead_async(lead)
+        await main.run_lead_pipeline(started[0], lead)
+        return response, await main.get_lead_status(started[0])
+    return asyncio.run(scenario())
+
+
+def test_invalid_spam_lead_gets_no_validation_feedback(monkeypatch, spam_verdict):
+    response, status = accept_and_run(monkeypatch, make_lead(about_case="", email=""))
+    
+    assert response.status_code == 202
+    assert status["status"] == "completed"
+    assert status["error"] is None
+    assert {key: status[key] for key in main.SPAM_LEAD_STATUS_OUTCOME} == main.SPAM_LEAD_STATUS_OUTCOME
+
+
+def test_invalid_legitimate_lead_fails_in_the_pipeline(monkeypatch):
+    response, status = accept_and_run(monkeypatch, make_lead(source="chatbot", case_type=None))
+    
+    assert response.status_code == 202
+    assert status["status"] == "failed"
+    assert "case_type" in status["error"]
@@ -0,0 +1,58 @@
+import pytest
+
+import main
+
+
+@pytest.fixture(scope="module")
+def validator():
+    return main.ContactValidator(main.DISPOSABLE_DOMAINS_PATH)
+
+
+def test_clean_contact_has_no_signals(validator):
+    check = validator.validate("Maria Lopez", "(312) 555-2368", "maria.lopez@gmail.com")
+    assert check == {"score": 0, "signals": [], "parse_issues": [], "reject": False}
+
+
+def test_common_typos_do_not_reject(validator):
+    check = validator.validate("Tom Lee", "212-555-1234 x22", "tom@yahoo")
+    assert check["signals"] == ["email_malformed"]
+    assert check["parse_issues"] == ["phone_extension"]
+    assert not check["reject"]
+
+
+def test_missing_area_code_is_a_parse_issue(validator):
+    check = validator.validate("Tom Lee", "555-1234", "tom@yahoo.com")
+    assert check["signals"] == []
+    assert check["parse_issues"] == ["phone_missing_area_code"]
+
+
+@pytest.mark.parametrize("phone, signal", [
+    ("012-555-2368", "phone_invalid_area_code"),
+    ("312-155-2368", "phone_invalid_exchange"),
+    ("312-555-0123", "phone_fictional"),
+    ("222-222-2222", "phone_filler_digits"),
+    ("12345", "phone_not_nanp"),
+    ("+44 20 7946 0958", "phone_international"),
+])
+def test_phone_signals(validator, phone, signal):
+    assert validator.phone_signal(phone)[0] == signal
+
+
+def test_no_single_signal_rejects(validator, monkeypatch):
+    monkeypatch.setattr(main, "CONTACT_REJECT_SCORE", 0.5)
+    check = validator.validate("Maria Lopez www.example.org", "(312) 555-2368", "maria.lopez@gmail.com")
+    assert check["signals"] == ["name_contains_link"]
+    assert not check["reject"]
+
+
+def test_several_strong_signals_reject(validator):
+    check = validator.validate("www.best-leads.com", "312-555-0123", "x@mailinator.com")
+    assert set(check["signals"]) == {"name_contains_link", "phone_fictional", "email_disposable"}
+    assert check["score"] >= main.CONTACT_REJECT_SCORE
+    assert check["reject"]
+
+
+def test_weak_signals_are_described_for_the_llm(validator):
+    check = validator.validate("Tom Lee", "212-555-1234", "tom@yahoo")
+    assert main.ContactValidator.describe(check) == f"score 0.6 of {main.CONTACT_REJECT_SCORE} (email_malformed)"
+    assert main.ContactValidator.describe(validator.validate("Tom Lee", "212-555-1234", "tom@yahoo.com")) == ""
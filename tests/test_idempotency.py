@@ -0,0 +1,152 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import main
+
+
+def make_request(idempotency_key=None, client_ip="203.0.113.7", path="/submit-lead"):
+    headers = [(b"idempotency-key", idempotency_key.encode())] if idempotency_key else []
+    return Request({
+        "type": "http",
+        "method": "POST",
+        "scheme": "https",
+        "server": ("testserver", 443),
+        "path": path,
+        "query_string": b"",
+        "headers": headers,
+        "client": (client_ip, 50000),
+        "state": {"client_ip": client_ip}
+    })
+
+
+def counting_handler(response=None):
+    calls = []
+    
+    async def handler():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return response if response is not None else {"status": "success", "run": len(calls)}
+    return handler, calls
+
+
+def test_retry_replays_the_first_response():
+    async def scenario():
+        cache = main.IdempotencyCache(100)
+        handler, calls = counting_handler()
+        first = await cache.run("key", 60, handler, "fp")
+        replay = await cache.run("key", 60, handler, "fp")
+        return first, replay, calls, cache
+    
+    first, replay, calls, cache = asyncio.run(scenario())
+    assert first == {"status": "success", "run": 1}
+    assert replay.headers["idempotent-replayed"] == "true"
+    assert len(calls) == 1
+    assert cache.stats()["replays"] == 1
+
+
+def test_concurrent_retries_wait_for_the_first_run():
+    async def scenario():
+        cache = main.IdempotencyCache(100)
+        handler, calls = counting_handler()
+        results = await asyncio.gather(*(cache.run("key", 60, handler, "fp") for _ in range(3)))
+        return results, calls, cache
+    
+    results, calls, cache = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert cache.stats()["waits"] == 2
+    assert results[0] == {"status": "success", "run": 1}
+
+
+def test_key_reused_with_another_payload_is_rejected():
+    async def scenario():
+        cache = main.IdempotencyCache(100)
+        handler, calls = counting_handler()
+        await cache.run("key", 60, handler, "fp-1")
+        with pytest.raises(HTTPException) as rejected:
+            await cache.run("key", 60, handler, "fp-2")
+        return rejected.value, calls, cache
+    
+    error, calls, cache = asyncio.run(scenario())
+    assert error.status_code == 422
+    assert len(calls) == 1
+    assert cache.stats()["mismatches"] == 1
+
+
+def test_server_errors_are_not_stored():
+    async def scenario():
+        cache = main.IdempotencyCache(100)
+        attempts = []
+        
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise HTTPException(status_code=503, detail="try again")
+            return {"status": "success"}
+        
+        with pytest.raises(HTTPException):
+            await cache.run("key", 60, flaky, "fp")
+        return await cache.run("key", 60, flaky, "fp"), attempts
+    
+    result, attempts = asyncio.run(scenario())
+    assert result == {"status": "success"}
+    assert len(attempts) == 2
+
+
+def test_client_errors_are_replayed():
+    async def scenario():
+        cache = main.IdempotencyCache(100)
+        
+        async def invalid():
+            raise HTTPException(status_code=400, detail="bad lead")
+        
+        for _ in range(2):
+            with pytest.raises(HTTPException) as rejected:
+                await cache.run("key", 60, invalid, "fp")
+        return rejected.value
+    
+    error = asyncio.run(scenario())
+    assert error.status_code == 400
+    assert error.headers["Idempotent-Replayed"] == "true"
+
+
+def test_entries_are_bounded_oldest_first():
+    async def scenario():
+        cache = main.IdempotencyCache(2)
+        handler, _ = counting_handler()
+        for key in ("a", "b", "c"):
+            await cache.run(key, 60, handler, "fp")
+        return list(cache._entries)
+    
+    assert asyncio.run(scenario()) == ["b", "c"]
+
+
+def test_trim_drops_expired_entries():
+    async def scenario():
+        cache = main.IdempotencyCache(100)
+        handler, _ = counting_handler()
+        await cache.run("short", 0.05, handler, "fp")
+        await cache.run("long", 60, handler, "fp")
+        await asyncio.sleep(0.06)
+        return cache.trim(), list(cache._entries)
+    
+    trimmed, remaining = asyncio.run(scenario())
+    assert trimmed == 1
+    assert remaining == ["long"]
+
+
+def test_header_keys_are_scoped_per_client():
+    first, ttl, fingerprint = main.get_idempotency_key(make_request("abc", "203.0.113.7"), "payload")
+    other_client, _, _ = main.get_idempotency_key(make_request("abc", "198.51.100.9"), "payload")
+    assert first != other_client
+    assert ttl == main.IDEMPOTENCY_TTL_SECONDS
+    assert fingerprint == main.get_idempotency_key(make_request("xyz"), "payload")[2]
+
+
+def test_payload_derived_keys_are_optional():
+    key, ttl, _ = main.get_idempotency_key(make_request(path="/webhook/opportunity-stage-change"), "payload")
+    assert key.startswith("/webhook/opportunity-stage-change|payload|")
+    assert ttl == main.IDEMPOTENCY_DERIVED_TTL_SECONDS
+    assert main.get_idempotency_key(make_request(), "payload", derive_from_payload=False)[0] is None
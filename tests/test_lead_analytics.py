@@ -0,0 +1,95 @@
+import asyncio
+import time
+import uuid
+
+from starlette.requests import Request
+
+import main
+
+
+def make_lead(**overrides):
+    lead = {
+        "source": "form",
+        "name": "Dana Whitfield",
+        "email": f"{uuid.uuid4().hex[:8]}@example.com",
+        "phone": "3125552368",
+        "about_case": "I slipped on a wet floor at a grocery store and broke my wrist",
+        "case_type": None,
+        "case_state": None,
+        "is_referral": False
+    }
+    lead.update(overrides)
+    return lead
+
+
+def stored_rows(analytics):
+    with analytics._lock:
+        return analytics._connect().execute("SELECT metric, label, count FROM lead_counters").fetchall()
+
+
+def test_counters_stay_in_memory_until_flushed(tmp_path):
+    analytics = main.LeadAnalytics(str(tmp_path / "analytics.db"), 300)
+    for _ in range(5):
+        analytics.record(1000.0, [("submissions", "form")])
+    
+    assert stored_rows(analytics) == []
+    assert analytics.flush() == 1
+    assert stored_rows(analytics) == [("submissions", "form", 5)]
+
+
+def test_flushes_add_up(tmp_path):
+    analytics = main.LeadAnalytics(str(tmp_path / "analytics.db"), 300)
+    analytics.record(time.time(), [("submissions", "form"), ("verdict", "form:spam")])
+    analytics.flush()
+    analytics.record(time.time(), [("submissions", "form")])
+    
+    totals = analytics.totals(time.time() - 3600)  # includes counts not flushed yet
+    assert totals["submissions"] == {"form": 2}
+    assert totals["verdict"] == {"form:spam": 1}
+
+
+def test_counts_survive_a_full_archive_queue(monkeypatch, tmp_path):
+    analytics = main.LeadAnalytics(str(tmp_path / "analytics.db"), 300)
+    monkeypatch.setattr(main, "lead_analytics", analytics)
+    
+    def queue_full(kind, coro, report_failures=True):
+        coro.close()
+        return None
+    
+    monkeypatch.setattr(main.background_tasks, "spawn", queue_full)
+    for _ in range(3):
+        main.archive_submission(make_lead(), {"verdict": "spam"}, time.perf_counter(), result={"status": "success"})
+    
+    totals = analytics.totals(time.time() - 3600)
+    assert totals["submissions"] == {"form": 3}
+    assert totals["verdict"] == {"form:spam": 3}
+
+
+def admin_request():
+    return Request({
+        "type": "http",
+        "method": "GET",
+        "path": "/admin/analytics",
+        "query_string": b"",
+        "headers": [(b"x-admin-key", b"test-admin-key")],
+        "client": ("203.0.113.7", 50000)
+    })
+
+
+def test_early_rejections_are_not_lead_volume(monkeypatch, tmp_path):
+    analytics = main.LeadAnalytics(str(tmp_path / "analytics.db"), 300)
+    monkeypatch.setattr(main, "lead_analytics", analytics)
+    monkeypatch.setattr(main, "submission_archive", None)
+    monkeypatch.setattr(main, "ADMIN_API_KEY", "test-admin-key")
+    
+    main.archive_submission(make_lead(), {"verdict": "spam"}, time.perf_counter(), result={"status": "success"})
+    main.archive_submission(make_lead(), {}, time.perf_counter(), result={"status": "success"})
+    main.archive_rejected_submission(400, "Missing required fields", make_lead(source="unknown"))
+    for _ in range(2):
+        analytics.record(time.time(), [("early_rejection", "rate_limited")])
+    
+    summary = asyncio.run(main.lead_analytics_summary(admin_request(), window="1h", step="5m"))
+    assert summary["submissions"] == 2
+    assert summary["spam_rate"] == 0.5
+    assert summary["early_rejections"] == {"invalid_request": 1, "rate_limited": 2}
+    assert all(set(step) <= {"start", "form", "chatbot"} for step in summary["series"])
@@ -0,0 +1,68 @@
+import asyncio
+import time
+import uuid
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def upstreams(monkeypatch):
+    """Record the upstreams called before the webhook (inline) and the budget the webhook still had"""
+    seen = {"calls": [], "webhook_budget": None}
+    
+    async def webhook(webhook_data):
+        seen["webhook_budget"] = main.remaining_budget()
+        return {"success": True, "response": {"status_code": 200}}
+    
+    monkeypatch.setattr(main, "send_to_webhook", webhook)
+    return seen
+
+
+def fail_upstreams(monkeypatch, seen, errors):
+    async def call_upstream(upstream, func, *args, **kwargs):
+        if seen["webhook_budget"] is None:
+            seen["calls"].append((upstream, main.remaining_budget()))
+        raise errors[upstream](upstream)
+    
+    monkeypatch.setattr(main, "call_upstream", call_upstream)
+
+
+def run_chatbot_lead(deadline_seconds):
+    async def scenario():
+        main.request_deadline.set(time.monotonic() + deadline_seconds)
+        return await main.run_lead_stages(
+            {}, "chatbot", f"Lead {uuid.uuid4().hex[:8]}", f"{uuid.uuid4().hex[:8]}@example.com",
+            "3125552368", "I was rear-ended on the highway last week", "Personal injury", "CA", False
+        )
+    return asyncio.run(scenario())
+
+
+def test_shed_notifications_are_deferred_and_webhook_still_runs(monkeypatch, upstreams):
+    fail_upstreams(monkeypatch, upstreams, {"resend": main.UpstreamOverloaded, "twilio": main.UpstreamOverloaded})
+    result = run_chatbot_lead(20)
+    
+    assert result["email_deferred"] and result["sms_deferred"]
+    assert not result["email_sent"] and not result["sms_sent"]
+    assert upstreams["webhook_budget"] is not None
+
+
+def test_notifications_never_eat_the_webhook_reserve(monkeypatch, upstreams):
+    fail_upstreams(monkeypatch, upstreams, {"resend": main.DeadlineExceeded, "twilio": main.DeadlineExceeded})
+    result = run_chatbot_lead(20)
+    
+    reserve = main.STAGE_MIN_BUDGETS["webhook"]
+    assert [upstream for upstream, _ in upstreams["calls"]] == ["resend", "twilio"]
+    assert all(budget <= 20 - reserve for _, budget in upstreams["calls"])
+    assert upstreams["webhook_budget"] > reserve - 0.5
+    assert result["email_deferred"] and result["sms_deferred"]
+
+
+def test_short_deadline_defers_notifications_up_front(monkeypatch, upstreams):
+    fail_upstreams(monkeypatch, upstreams, {"resend": main.UpstreamOverloaded, "twilio": main.UpstreamOverloaded})
+    result = run_chatbot_lead(main.STAGE_MIN_BUDGETS["webhook"] + 1)
+    
+    assert upstreams["calls"] == []  # deferred without an inline attempt
+    assert result["email_deferred"] and result["sms_deferred"]
+    assert upstreams["webhook_budget"] is not None
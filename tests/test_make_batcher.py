@@ -0,0 +1,91 @@
+import asyncio
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def make(monkeypatch):
+    """Fake Make scenario: records each posted batch and answers per item after a delay"""
+    make = {"posts": [], "delay": 0}
+    
+    async def call_upstream(upstream, func, url, json=None, timeout=None):
+        make["posts"].append(json)
+        await asyncio.sleep(make["delay"])
+        results = [
+            {"item_id": lead["item_id"], "status": lead.get("answer", 200), "message": "done"}
+            for lead in json["leads"]
+        ]
+        return SimpleNamespace(
+            status_code=200,
+            text="",
+            elapsed=timedelta(milliseconds=5),
+            json=lambda: {"results": results}
+        )
+    
+    monkeypatch.setattr(main, "call_upstream", call_upstream)
+    return make
+
+
+def submit_all(batcher, leads, deadline_seconds=10, settle_seconds=0.3):
+    async def submit(lead):
+        main.request_deadline.set(time.monotonic() + deadline_seconds)
+        try:
+            return await batcher.submit(lead)
+        except main.DeadlineExceeded as e:
+            return e
+    
+    async def scenario():
+        results = await asyncio.gather(*(submit(lead) for lead in leads))
+        await asyncio.sleep(settle_seconds)  # let in-flight batches finish
+        return results
+    return asyncio.run(scenario())
+
+
+def test_each_lead_gets_its_own_result(make):
+    batcher = main.MakeWebhookBatcher(0.05, 10)
+    results = submit_all(batcher, [{"name": "Ana"}, {"name": "Ben", "answer": 400}])
+    
+    assert len(make["posts"]) == 1 and make["posts"][0]["count"] == 2
+    assert [result["success"] for result in results] == [True, False]
+    assert results[1]["effective_status_code"] == 400
+
+
+def test_full_batch_flushes_before_the_window(make):
+    batcher = main.MakeWebhookBatcher(60, 2)
+    results = submit_all(batcher, [{"name": "Ana"}, {"name": "Ben"}], settle_seconds=0)
+    
+    assert [result["success"] for result in results] == [True, True]
+    assert len(make["posts"]) == 1
+
+
+def test_deadline_before_the_batch_is_sent_withdraws_the_lead(make):
+    batcher = main.MakeWebhookBatcher(0.2, 10)
+    results = submit_all(batcher, [{"name": "Ana"}], deadline_seconds=0.05)
+    
+    assert isinstance(results[0], main.DeadlineExceeded)
+    assert make["posts"] == []  # never forwarded after the client was told it failed
+    assert batcher.stats()["items_withdrawn"] == 1
+
+
+def test_deadline_after_the_batch_is_sent_reports_pending(make):
+    make["delay"] = 0.2
+    batcher = main.MakeWebhookBatcher(0.01, 10)
+    results = submit_all(batcher, [{"name": "Ana"}], deadline_seconds=0.1)
+    
+    assert results[0]["success"] is True
+    assert results[0]["response"]["status_code"] == 202
+    assert len(make["posts"]) == 1
+    assert batcher.stats()["items_sent"] == 1  # still settled once Make answered
+
+
+def test_batcher_without_send_batch_fails_at_creation():
+    class Incomplete(main.MicroBatcher):
+        pass
+    
+    with pytest.raises(TypeError):
+        Incomplete(1.0)
@@ -0,0 +1,37 @@
+import asyncio
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+
+import main
+
+
+def test_every_batcher_drains_before_the_task_registry():
+    hooks = list(reversed(main.app_shutdown_hooks))  # the order the lifespan runs them
+    order = [hooks.index(batcher.drain) for batcher in (main.spam_batcher, main.make_webhook_batcher, main.lead_digest)]
+    
+    assert order == sorted(order)
+    assert main.stage_email_batcher.drain in hooks
+    assert hooks.index(main.background_tasks.drain) > max(order + [hooks.index(main.stage_email_batcher.drain)])
+
+
+def test_shutdown_sends_a_batch_still_waiting_for_its_window(monkeypatch):
+    posted = []
+    
+    async def call_upstream(upstream, func, url, json=None, timeout=None):
+        posted.append(json["count"])
+        return SimpleNamespace(status_code=200, text="", elapsed=timedelta(0), json=lambda: {})
+    
+    monkeypatch.setattr(main, "call_upstream", call_upstream)
+    batcher = main.MakeWebhookBatcher(60, 10)
+    
+    async def scenario():
+        main.request_deadline.set(time.monotonic() + 5)
+        waiting = asyncio.create_task(batcher.submit({"name": "Ana"}))
+        await asyncio.sleep(0)
+        await batcher.drain()
+        await main.background_tasks.drain()
+        return await waiting
+    
+    assert asyncio.run(scenario())["success"] is True
+    assert posted == [1]
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+def llm_reply(verdicts, finish_reason="stop"):
+    content = json.dumps({"verdicts": [{"id": item_id, "verdict": verdict} for item_id, verdict in verdicts.items()]})
+    return SimpleNamespace(choices=[SimpleNamespace(finish_reason=finish_reason, message=SimpleNamespace(content=content))])
+
+
+@pytest.fixture
+def openai_calls(monkeypatch):
+    """Fake batched classification: answers SPAM for case text mentioning SEO, and drops item 2 if asked"""
+    calls = []
+    
+    async def call_upstream(upstream, func, **kwargs):
+        items = json.loads(kwargs["messages"][1]["content"].split("\n", 1)[1])
+        calls.append(len(items))
+        return llm_reply({
+            item["id"]: "SPAM" if "SEO" in item["case_description"] else "LEGITIMATE"
+            for item in items if not item["case_description"].startswith("drop")
+        })
+    
+    monkeypatch.setattr(main, "call_upstream", call_upstream)
+    monkeypatch.setattr(main, "record_llm_usage", lambda *args: None)
+    return calls
+
+
+def classify_burst(batcher, cases):
+    async def scenario():
+        return await asyncio.gather(*(
+            batcher.classify(f"Lead {index}", "3125552368", f"lead{index}@example.com", case)
+            for index, case in enumerate(cases)
+        ))
+    return asyncio.run(scenario())
+
+
+def test_burst_is_classified_in_one_request(openai_calls):
+    batcher = main.SpamBatcher(0.05, 10)
+    verdicts = classify_burst(batcher, ["We offer SEO for your firm", "I was rear-ended last week", "Cheap SEO backlinks"])
+    
+    assert openai_calls == [3]
+    assert verdicts == [True, False, True]
+
+
+def test_missing_verdict_fails_open_for_that_item_only(openai_calls):
+    batcher = main.SpamBatcher(0.05, 10)
+    verdicts = classify_burst(batcher, ["We offer SEO for your firm", "drop this one", "Cheap SEO backlinks"])
+    
+    assert verdicts == [True, False, True]
+
+
+def test_full_batch_is_sent_without_waiting(openai_calls):
+    batcher = main.SpamBatcher(60, 2)
+    verdicts = classify_burst(batcher, ["SEO offer", "My DUI hearing is next week"])
+    
+    assert openai_calls == [2]
+    assert verdicts == [True, False]
+
+
+def test_lone_submission_uses_the_single_prompt(monkeypatch, openai_calls):
+    async def classify_submission(**submission):
+        return "SEO" in submission["about_case"]
+    
+    monkeypatch.setattr(main, "classify_submission", classify_submission)
+    assert classify_burst(main.SpamBatcher(0.01, 10), ["SEO offer"]) == [True]
+    assert openai_calls == []
+
+
+def test_truncated_reply_keeps_the_complete_verdicts():
+    content = '{"verdicts": [{"id": 0, "verdict": "SPAM"}, {"id": 1, "verdict": "LEGITIMATE"}, {"id": 2, "verd'
+    assert main.parse_batch_verdicts(content) == {0: "SPAM", 1: "LEGITIMATE"}
+    assert main.parse_batch_verdicts(None) == {}
+
+
+def test_shed_batch_lets_each_submission_through(monkeypatch):
+    async def shed(submissions):
+        raise main.UpstreamOverloaded("openai")
+    
+    monkeypatch.setattr(main, "classify_submissions_batch", shed)
+    monkeypatch.setattr(main, "SPAM_BATCHING_ENABLED", True)
+    monkeypatch.setattr(main, "spam_batcher", main.SpamBatcher(0.05, 10))
+    
+    async def scenario():
+        main.request_deadline.set(time.monotonic() + 20)
+        return await asyncio.gather(*(
+            main.check_for_spam(f"Lead {index}", "3125552368", f"lead{index}@example.com", "SEO offer")
+            for index in range(2)
+        ))
+    
+    assert asyncio.run(scenario()) == [False, False]
@@ -0,0 +1,129 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def blocklist(tmp_path):
+    return main.SpamBlocklist(str(tmp_path / "blocklist.db"), 1000, 0.01)
+
+
+def spam_entries(phone="312-555-2368", email="offers@seo-growth.biz"):
+    return main.SpamBlocklist.submission_entries(phone, email, "We offer SEO services to grow your law firm fast, reply now")
+
+
+def actions(blocklist):
+    return {row["kind"]: row["action"] for row in blocklist.entries(None, None, 100)}
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = main.BloomFilter(1000, 0.01)
+    keys = [f"phone:{number}" for number in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+
+
+def test_bloom_filter_false_positive_rate_near_target():
+    bloom = main.BloomFilter(1000, 0.01)
+    for number in range(1000):
+        bloom.add(f"email:{number}@example.com")
+    false_positives = sum(f"email:other{number}@example.com" in bloom for number in range(10000))
+    assert false_positives / 10000 < 0.03
+    assert bloom.false_positive_rate() == pytest.approx(0.01, abs=0.01)
+
+
+def test_single_spam_verdict_only_watches(blocklist):
+    entries = spam_entries()
+    blocklist.learn(entries, "sample")
+    assert set(actions(blocklist).values()) == {"watch"}
+    assert blocklist.candidates(entries) == []
+
+
+def test_repeat_spam_waits_for_review(blocklist, monkeypatch):
+    monkeypatch.setattr(main, "SPAM_BLOCKLIST_AUTO_DENY", False)
+    entries = spam_entries()
+    blocklist.learn(entries, "sample")
+    blocklist.learn(entries, "sample")
+    learned = actions(blocklist)
+    assert learned["phone"] == learned["email"] == learned["content"] == "review"
+    assert learned["domain"] == "watch"  # domains need SPAM_BLOCKLIST_DOMAIN_STRIKES senders
+    assert blocklist.review_count() == 3
+    assert blocklist.candidates(entries) == []  # nothing enforced until an admin approves
+
+
+def test_auto_deny_rejects_after_strikes(blocklist, monkeypatch):
+    monkeypatch.setattr(main, "SPAM_BLOCKLIST_AUTO_DENY", True)
+    entries = spam_entries()
+    blocklist.learn(entries, "sample")
+    blocklist.learn(entries, "sample")
+    hits = blocklist.candidates(entries)
+    assert {kind for kind, _ in hits} == {"phone", "email", "content"}
+    match = blocklist.confirm(hits)
+    assert match["origin"] == "learned" and match["strikes"] == 2
+    assert blocklist.rejections == 1
+
+
+def test_manual_deny_is_confirmed(blocklist):
+    blocklist.set_manual("phone", "3125552368", "deny")
+    entries = spam_entries()
+    match = blocklist.confirm(blocklist.candidates(entries))
+    assert match == {"kind": "phone", "value": "3125552368", "origin": "manual", "strikes": 0}
+
+
+def test_confirm_ignores_entries_no_longer_denied(blocklist):
+    blocklist.set_manual("phone", "3125552368", "deny")
+    entries = spam_entries()
+    hits = blocklist.candidates(entries)
+    assert blocklist.remove("phone", "3125552368")
+    assert blocklist.confirm(hits) is None  # the filter bit stays until a rebuild
+
+
+def test_allow_listed_submission_skips_the_blocklist(blocklist):
+    blocklist.set_manual("email", "offers@seo-growth.biz", "deny")
+    blocklist.set_manual("phone", "3125552368", "allow")
+    assert blocklist.candidates(spam_entries()) is None
+
+
+def test_free_mail_domains_are_never_learned():
+    entries = main.SpamBlocklist.submission_entries("312-555-2368", "someone@gmail.com", "")
+    assert ("domain", "gmail.com") not in entries
+    assert ("email", "someone@gmail.com") in entries
+
+
+def test_learned_entries_lapse_but_manual_ones_stay(blocklist, monkeypatch):
+    entries = spam_entries()
+    blocklist.learn(entries, "sample")
+    blocklist.set_manual("domain", "seo-growth.biz", "deny")
+    monkeypatch.setattr(main, "SPAM_BLOCKLIST_LEARNED_TTL_DAYS", -1)
+    assert blocklist.expire_learned() == 3
+    remaining = actions(blocklist)
+    assert remaining == {"phone": "removed", "email": "removed", "content": "removed", "domain": "deny"}
+
+
+def test_domain_strikes_count_distinct_senders(blocklist, monkeypatch):
+    monkeypatch.setattr(main, "SPAM_BLOCKLIST_DOMAIN_STRIKES", 3)
+    for _ in range(3):
+        blocklist.learn(spam_entries(), "sample")
+    blocklist.learn(spam_entries(phone="312-555-2368", email="sales@seo-growth.biz"), "sample")  # same phone
+    assert actions(blocklist)["domain"] == "watch"
+    
+    blocklist.learn(spam_entries(phone="415-555-0199", email="sales@seo-growth.biz"), "sample")  # same address
+    blocklist.learn(spam_entries(phone="415-555-0142", email="deals@seo-growth.biz"), "sample")
+    blocklist.learn(spam_entries(phone="646-555-0175", email="promo@seo-growth.biz"), "sample")
+    assert actions(blocklist)["domain"] == "review"
+
+
+def test_confirmed_hits_keep_learned_entries_alive(blocklist, monkeypatch):
+    monkeypatch.setattr(main, "SPAM_BLOCKLIST_AUTO_DENY", True)
+    entries = [("phone", "3125552368")]
+    blocklist.learn(entries, "sample")
+    blocklist.learn(entries, "sample")
+    with blocklist._lock:
+        blocklist._connect().execute("UPDATE spam_blocklist SET updated_at = updated_at - 40 * 86400")
+        blocklist._connect().commit()
+    
+    assert blocklist.confirm(entries)["value"] == "3125552368"
+    monkeypatch.setattr(main, "SPAM_BLOCKLIST_LEARNED_TTL_DAYS", 30)
+    assert blocklist.expire_learned() == 0
+    assert actions(blocklist)["phone"] == "deny"
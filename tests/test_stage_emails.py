@@ -0,0 +1,74 @@
+import asyncio
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def resend(monkeypatch):
+    """Fake Resend batch endpoint: answers are taken from the queue, then 200 with one id per email"""
+    resend = {"batches": [], "answers": [], "alerts": []}
+    
+    async def call_upstream(upstream, func, url, headers=None, json=None, timeout=None):
+        resend["batches"].append(len(json))
+        answer = resend["answers"].pop(0) if resend["answers"] else 200
+        if isinstance(answer, Exception):
+            raise answer
+        data = [{"id": f"re_{index}"} for index in range(len(json))]
+        return SimpleNamespace(status_code=answer, text="error", json=lambda: {"data": data})
+    
+    async def send_error_alert(message, endpoint):
+        resend["alerts"].append(message)
+    
+    monkeypatch.setattr(main, "call_upstream", call_upstream)
+    monkeypatch.setattr(main, "send_error_alert", send_error_alert)
+    return resend
+
+
+def send_burst(batcher, count):
+    message_ids = [uuid.uuid4().hex for _ in range(count)]
+    
+    async def scenario():
+        for index, message_id in enumerate(message_ids):
+            email = {"to_email": f"client{index}@example.com", "subject": "Case update", "html_content": "<p>Update</p>"}
+            main.stage_email_store.create(message_id, email)
+            batcher.enqueue(message_id, email)
+        await asyncio.sleep(0.2)
+        await main.background_tasks.drain()
+    
+    asyncio.run(scenario())
+    return [main.stage_email_store.get(message_id) for message_id in message_ids]
+
+
+def test_burst_goes_out_as_one_resend_batch(resend):
+    records = send_burst(main.StageEmailBatcher(0.05, 100), 3)
+    
+    assert resend["batches"] == [3]
+    assert [record["status"] for record in records] == ["sent"] * 3
+    assert [record["resend_id"] for record in records] == ["re_0", "re_1", "re_2"]
+
+
+def test_batches_are_capped_at_max_size(resend):
+    records = send_burst(main.StageEmailBatcher(0.05, 2), 4)
+    
+    assert resend["batches"] == [2, 2]
+    assert [record["status"] for record in records] == ["sent"] * 4
+
+
+def test_shed_batch_is_retried_in_the_next_window(resend):
+    resend["answers"] = [main.UpstreamOverloaded("resend")]
+    records = send_burst(main.StageEmailBatcher(0.05, 100), 2)
+    
+    assert resend["batches"] == [2, 2]
+    assert [(record["status"], record["attempts"]) for record in records] == [("sent", 2)] * 2
+
+
+def test_failed_batch_marks_every_email_and_alerts_once(resend):
+    resend["answers"] = [500]
+    records = send_burst(main.StageEmailBatcher(0.05, 100), 2)
+    
+    assert [record["status"] for record in records] == ["failed"] * 2
+    assert len(resend["alerts"]) == 1
@@ -0,0 +1,44 @@
+import os
+
+import main
+
+
+def key(index):
+    return f"{index:064x}"
+
+
+def test_append_waits_for_flush(tmp_path):
+    log = main.PersistentStateLog(str(tmp_path))
+    log.append(log.DUPLICATE, key(1), 100.0)
+    
+    assert not os.path.exists(log.log_path)
+    assert log.flush() == 1
+    assert log.load() == [(log.DUPLICATE, key(1), 100.0)]
+
+
+def test_compaction_drops_expired_records(tmp_path):
+    log = main.PersistentStateLog(str(tmp_path))
+    log.append(log.DUPLICATE, key(1), 100.0)
+    log.append(log.RATE_LIMIT, key(2), 990.0)
+    
+    assert log.compact({log.DUPLICATE: 60, log.RATE_LIMIT: 60}, now=1000.0) == (1, 1)
+    assert os.path.getsize(log.log_path) == 0
+    assert log.load() == [(log.RATE_LIMIT, key(2), 990.0)]
+
+
+def test_compaction_keeps_records_appended_while_it_runs(tmp_path, monkeypatch):
+    log = main.PersistentStateLog(str(tmp_path))
+    other_worker = main.PersistentStateLog(str(tmp_path))
+    log.append(log.DUPLICATE, key(1), 990.0)
+    real_fsync = os.fsync
+    
+    def fsync_while_another_worker_appends(fd):
+        other_worker.append(log.DUPLICATE, key(2), 995.0)
+        other_worker.flush()  # would block if compaction held the log lock here
+        real_fsync(fd)
+    
+    monkeypatch.setattr(main.os, "fsync", fsync_while_another_worker_appends)
+    assert log.compact({log.DUPLICATE: 60}, now=1000.0) == (1, 0)
+    
+    assert sorted(log.load()) == [(log.DUPLICATE, key(1), 990.0), (log.DUPLICATE, key(2), 995.0)]
+    assert os.path.getsize(log.log_path) == log.RECORD.size
@@ -0,0 +1,71 @@
+import asyncio
+import time
+import uuid
+from datetime import datetime
+
+import main
+
+
+def make_lead(**overrides):
+    lead = {
+        "source": "form",
+        "name": "Dana Whitfield",
+        "email": f"{uuid.uuid4().hex[:8]}@example.com",
+        "phone": "3125552368",
+        "about_case": "I slipped on a wet floor at a grocery store and broke my wrist",
+        "case_type": None,
+        "case_state": None,
+        "is_referral": False
+    }
+    lead.update(overrides)
+    return lead
+
+
+def send_through_admission(headers):
+    sent = []
+    
+    async def app(scope, receive, send):
+        raise AssertionError("rejected requests must not reach the app")
+    
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+    
+    async def send(message):
+        sent.append(message)
+    
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/submit-lead",
+        "headers": headers,
+        "client": ("203.0.113.9", 50000)
+    }
+    asyncio.run(main.AdmissionControlMiddleware(app)(scope, receive, send))
+    return sent[0]["status"]
+
+
+def test_admission_rejections_are_counted_not_archived(monkeypatch):
+    archived = []
+    monkeypatch.setattr(main, "archive_submission", lambda *args, **kwargs: archived.append(args))
+    before = main.lead_admission_rejections["body_too_large"]
+    
+    for _ in range(3):
+        assert send_through_admission([(b"content-length", b"999999999")]) == 413
+    
+    assert main.lead_admission_rejections["body_too_large"] == before + 3
+    assert archived == []
+
+
+def test_submissions_are_archived_under_their_arrival_time():
+    lead = make_lead()
+    arrived = time.time() - 30
+    
+    async def scenario():
+        main.request_received_at.set(arrived)
+        main.archive_submission(lead, {"verdict": "spam"}, time.perf_counter(), result={"status": "success"})
+        await main.background_tasks.drain()
+    
+    asyncio.run(scenario())
+    rows = main.submission_archive.query(email=lead["email"])
+    assert [row["verdict"] for row in rows] == ["spam"]
+    assert rows[0]["submitted_at"] == datetime.fromtimestamp(arrived).isoformat()